@@ -0,0 +1,122 @@
+"""Local harness for lambda_function.lambda_handler backed by moto.
+
+Uploads a batch of synthetic JPEGs to an in-process S3 stand-in and times the
+handler on one event carrying all of them, first with a single worker and
+then with MAX_WORKERS workers. moto answers instantly, so --latency-ms adds a
+per-request delay to approximate the round trip to the real S3 endpoint.
+
+    pip3 install -r requirements-dev.txt
+    python3 bench_batch.py --records 10 --latency-ms 40
+"""
+
+import argparse
+import json
+import os
+import time
+from io import BytesIO
+
+# moto must patch botocore before lambda_function builds its client
+from moto import mock_aws
+from PIL import Image
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+BUCKET = "bench-images"
+
+
+def make_jpeg(width, height, seed):
+    image = Image.merge(
+        "RGB",
+        [
+            Image.effect_noise((width, height), 40 + seed),
+            Image.linear_gradient("L").resize((width, height)),
+            Image.radial_gradient("L").resize((width, height)),
+        ],
+    )
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_event(keys, bad_keys=()):
+    # S3 notifications delivered through SQS, one message per object: only
+    # those get per-record failures back, a direct S3 event fails as a whole
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:sqs",
+                "messageId": key,
+                "body": json.dumps(
+                    {
+                        "Records": [
+                            {"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}
+                        ]
+                    }
+                ),
+            }
+            for key in list(keys) + list(bad_keys)
+        ]
+    }
+
+
+def add_latency(client, latency_ms):
+    def delay(**kwargs):
+        time.sleep(latency_ms / 1000.0)
+
+    client.meta.events.register("before-send.s3", delay, unique_id="bench-latency")
+
+
+def run(lambda_function, event, workers):
+    lambda_function.MAX_WORKERS = workers
+    start = time.perf_counter()
+    result = lambda_function.lambda_handler(event, None)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--width", type=int, default=2400)
+    parser.add_argument("--height", type=int, default=1600)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with mock_aws():
+        import lambda_function
+
+        # Both runs resize the same objects, keep the second one from being
+        # served out of the dedup index
+        lambda_function.dedup_index = None
+        s3 = lambda_function.s3_client
+        s3.create_bucket(Bucket=BUCKET)
+        s3.create_bucket(Bucket="{}-resized".format(BUCKET))
+        keys = []
+        for i in range(args.records):
+            key = "photos/image-{:03d}.jpg".format(i)
+            s3.put_object(
+                Bucket=BUCKET, Key=key, Body=make_jpeg(args.width, args.height, i)
+            )
+            keys.append(key)
+        # One object that is not an image and one that does not exist, to show
+        # that only those two are reported back for a retry
+        s3.put_object(Bucket=BUCKET, Key="photos/not-an-image.jpg", Body=b"oops")
+        event = make_event(keys, ["photos/not-an-image.jpg", "photos/missing.jpg"])
+
+        if args.latency_ms:
+            add_latency(s3, args.latency_ms)
+
+        serial, result = run(lambda_function, event, 1)
+        print("Failed records ", result["batchItemFailures"])
+        concurrent, _ = run(lambda_function, event, args.workers)
+
+    print("Records per event   ", len(event["Records"]))
+    print("Serial (1 worker)    {:.3f}s".format(serial))
+    print("Concurrent ({} workers) {:.3f}s".format(args.workers, concurrent))
+    print("Speedup              {:.2f}x".format(serial / concurrent))
+
+
+if __name__ == "__main__":
+    main()
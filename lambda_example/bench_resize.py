@@ -0,0 +1,321 @@
+"""Benchmark for resize_image and lambda_handler.
+
+Generates a synthetic corpus of JPEG/PNG/GIF images (cached in --corpus) and
+times every image under every combination of resampling filter and JPEG
+decode mode, either through resize_image alone or through the full handler
+against moto. Each combination runs in a fresh process so that the peak RSS
+reported is that of a single Lambda sized workload.
+
+    pip3 install -r requirements-dev.txt
+    python3 bench_resize.py --filters bicubic,lanczos --draft on,off -o run.json
+    python3 bench_resize.py --compare base.json run.json
+
+Reported per image: images/sec, p50/p95/p99 latency, peak RSS and the bytes
+the handler spilled to /tmp.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUCKET = "bench-images"
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif"}
+
+
+def make_image(megapixels, image_format):
+    """Gradients plus noise, which compresses about like a photo does."""
+    width = int((megapixels * 1e6 * 1.5) ** 0.5)
+    height = int(width / 1.5)
+    noise = Image.effect_noise((width, height), 24)
+    image = Image.merge(
+        "RGB",
+        [
+            Image.linear_gradient("L").resize((width, height)),
+            Image.radial_gradient("L").resize((width, height)),
+            noise,
+        ],
+    )
+    if image_format == "GIF":
+        image = image.quantize(256)
+    return image
+
+
+def build_corpus(directory, megapixels, formats):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for mp, image_format in itertools.product(megapixels, formats):
+        path = os.path.join(directory, "{}mp.{}".format(mp, EXTENSIONS[image_format]))
+        if not os.path.exists(path):
+            make_image(mp, image_format).save(path, image_format, quality=90)
+        paths.append(path)
+    return paths
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    # Nearest rank
+    rank = int(round(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+class CountingTempfile:
+    """Stands in for the tempfile module inside lambda_function."""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def TemporaryFile(self, *args, **kwargs):
+        spill = tempfile.TemporaryFile(*args, **kwargs)
+        write = spill.write
+
+        def counting_write(data):
+            self.bytes_written += len(data)
+            return write(data)
+
+        spill.write = counting_write
+        return spill
+
+
+def run_resize(lambda_function, path, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lambda_function.resize_image(path, BytesIO())
+        latencies.append(time.perf_counter() - start)
+    return latencies, 0
+
+
+def run_handler(lambda_function, path, repeat):
+    s3 = lambda_function.s3_client
+    s3.create_bucket(Bucket=BUCKET)
+    s3.create_bucket(Bucket="{}-resized".format(BUCKET))
+    key = os.path.basename(path)
+    with open(path, "rb") as source:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=source.read())
+    event = {
+        "Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]
+    }
+    spill = CountingTempfile()
+    lambda_function.tempfile = spill
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = lambda_function.lambda_handler(event, None)
+        latencies.append(time.perf_counter() - start)
+        if result["batchItemFailures"]:
+            raise RuntimeError("Handler failed on {}".format(path))
+    return latencies, spill.bytes_written
+
+
+def peak_rss_mb():
+    """Peak RSS of this process.
+
+    VmHWM starts over with exec(); ru_maxrss is carried over from the parent,
+    which may have rendered the whole corpus before starting the worker.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+def worker(config):
+    """Runs one (image, filter, decode mode) combination in this process."""
+    os.environ["RESAMPLE"] = config["filter"]
+    os.environ["JPEG_DRAFT"] = "true" if config["draft"] else "false"
+    # Every repetition has to do the full work
+    os.environ["DEDUP_INDEX"] = "off"
+    if config["max_in_memory_bytes"] is not None:
+        os.environ["MAX_IN_MEMORY_BYTES"] = str(config["max_in_memory_bytes"])
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    sys.path.insert(0, HERE)
+
+    from moto import mock_aws
+
+    with mock_aws():
+        import lambda_function
+
+        if config["renditions"] == "half":
+            lambda_function.RENDITIONS = [lambda_function.HALF_SIZE]
+        run = run_handler if config["mode"] == "handler" else run_resize
+        latencies, tmp_bytes = run(
+            lambda_function, config["path"], config["repeat"]
+        )
+
+    with Image.open(config["path"]) as image:
+        megapixels = round(image.size[0] * image.size[1] / 1e6, 2)
+    return {
+        "mode": config["mode"],
+        "image": os.path.basename(config["path"]),
+        "format": os.path.splitext(config["path"])[1][1:],
+        "megapixels": megapixels,
+        "source_bytes": os.path.getsize(config["path"]),
+        "filter": config["filter"],
+        "draft": config["draft"],
+        "renditions": config["renditions"],
+        "runs": len(latencies),
+        "images_per_sec": len(latencies) / sum(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+        "tmp_bytes_written": tmp_bytes,
+    }
+
+
+def result_key(result):
+    return (
+        result["mode"],
+        result["image"],
+        result["filter"],
+        result["draft"],
+        result["renditions"],
+    )
+
+
+COLUMNS = [
+    # (title, result field, width, format spec)
+    ("mode", "mode", 8, ""),
+    ("image", "image", 14, ""),
+    ("filter", "filter", 8, ""),
+    ("draft", "draft", 5, ""),
+    ("img/s", "images_per_sec", 9, ".2f"),
+    ("p50 ms", "p50_ms", 9, ".1f"),
+    ("p95 ms", "p95_ms", 9, ".1f"),
+    ("p99 ms", "p99_ms", 9, ".1f"),
+    ("RSS MB", "peak_rss_mb", 9, ".1f"),
+    ("/tmp bytes", "tmp_bytes_written", 12, ""),
+]
+
+
+def print_header():
+    print(" ".join(title.ljust(width) for title, _, width, _ in COLUMNS))
+
+
+def print_row(result):
+    print(
+        " ".join(
+            format(str(result[field]) if not spec else result[field], spec).ljust(
+                width
+            )
+            for _, field, width, spec in COLUMNS
+        )
+    )
+
+
+def compare(base_path, new_path):
+    """Print the relative change of every result in new against base."""
+    with open(base_path) as f:
+        base = dict((result_key(r), r) for r in json.load(f)["results"])
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    for r in new:
+        old = base.get(result_key(r))
+        if old is None:
+            continue
+        print(
+            "{:8} {:14} {:8} {!s:5} img/s {:+6.1f}% p99 {:+6.1f}% RSS {:+6.1f}%".format(
+                *result_key(r)[:4],
+                100.0 * (r["images_per_sec"] / old["images_per_sec"] - 1),
+                100.0 * (r["p99_ms"] / old["p99_ms"] - 1),
+                100.0 * (r["peak_rss_mb"] / old["peak_rss_mb"] - 1),
+            )
+        )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=HERE, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--corpus", default=os.path.join(tempfile.gettempdir(), "resize-corpus")
+    )
+    parser.add_argument("--megapixels", default="0.3,2,12,50")
+    parser.add_argument("--formats", default="jpeg,png,gif")
+    parser.add_argument("--modes", default="resize,handler")
+    parser.add_argument("--filters", default="bicubic")
+    parser.add_argument("--draft", default="on,off")
+    parser.add_argument("--renditions", choices=["half", "all"], default="all")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-in-memory-bytes", type=int)
+    parser.add_argument("-o", "--output", help="write the results as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"))
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(json.loads(args.worker))))
+        return
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    paths = build_corpus(
+        args.corpus,
+        [float(mp) for mp in args.megapixels.split(",")],
+        [f.upper() for f in args.formats.split(",")],
+    )
+    print_header()
+    results = []
+    for mode, path, filter_name, draft in itertools.product(
+        args.modes.split(","), paths, args.filters.split(","), args.draft.split(",")
+    ):
+        config = {
+            "mode": mode,
+            "path": path,
+            "filter": filter_name,
+            "draft": draft == "on",
+            "renditions": args.renditions,
+            "repeat": args.repeat,
+            "max_in_memory_bytes": args.max_in_memory_bytes,
+        }
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "--worker", json.dumps(config)]
+        )
+        results.append(json.loads(output.decode().splitlines()[-1]))
+        print_row(results[-1])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "python": platform.python_version(),
+                    "pillow": Image.__version__,
+                    "cpus": os.cpu_count(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Dedup index for the image resizer.
+
+Maps a fingerprint of the source image (its ETag or a content hash) combined
+with the rendition spec to the S3 object whose renditions were already
+rendered from it. A hit lets the handler copy those renditions server side
+instead of decoding, encoding and uploading them again.
+
+Two backends share the same interface: LRUIndex lives in the process and
+survives between invocations of a warm container, DynamoDBIndex is shared by
+every container and can be pointed at DynamoDB Local for testing:
+
+    java -Djava.library.path=./DynamoDBLocal_lib -jar DynamoDBLocal.jar -inMemory
+    python3 dedup.py http://localhost:8000
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+
+
+def fingerprint(source_id, spec):
+    """Fingerprint of a source (ETag or content hash) rendered with spec."""
+    spec_json = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256("{}\n{}".format(source_id, spec_json).encode()).hexdigest()
+
+
+class DedupIndex:
+    """Base class keeping the hit/miss counters, backends do the storage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stale": 0, "stores": 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, fingerprint):
+        """Return the {"bucket", "key"} entry for fingerprint or None."""
+        entry = self._load(fingerprint)
+        self._count("misses" if entry is None else "hits")
+        return entry
+
+    def put(self, fingerprint, bucket, key):
+        self._store(fingerprint, {"bucket": bucket, "key": key})
+        self._count("stores")
+
+    def discard(self, fingerprint):
+        """Forget an entry whose renditions turned out to be gone."""
+        self._delete(fingerprint)
+        self._count("stale")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class LRUIndex(DedupIndex):
+    def __init__(self, max_entries=4096):
+        super().__init__()
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def _load(self, fingerprint):
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is not None:
+                self._entries.move_to_end(fingerprint)
+            return entry
+
+    def _store(self, fingerprint, entry):
+        with self._lock:
+            self._entries[fingerprint] = entry
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _delete(self, fingerprint):
+        with self._lock:
+            self._entries.pop(fingerprint, None)
+
+
+class DynamoDBIndex(DedupIndex):
+    def __init__(self, table_name, endpoint_url=None, ttl_days=None):
+        super().__init__()
+        self.ttl_days = ttl_days
+        self.table = boto3.resource("dynamodb", endpoint_url=endpoint_url).Table(
+            table_name
+        )
+
+    def create_table(self):
+        table = self.table.meta.client.create_table(
+            TableName=self.table.name,
+            KeySchema=[{"AttributeName": "fingerprint", "KeyType": "HASH"}],
+            AttributeDefinitions=[
+                {"AttributeName": "fingerprint", "AttributeType": "S"}
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        self.table.meta.client.get_waiter("table_exists").wait(
+            TableName=self.table.name
+        )
+        return table
+
+    def _load(self, fingerprint):
+        item = self.table.get_item(Key={"fingerprint": fingerprint}).get("Item")
+        if item is None:
+            return None
+        return {"bucket": item["source_bucket"], "key": item["source_key"]}
+
+    def _store(self, fingerprint, entry):
+        item = {
+            "fingerprint": fingerprint,
+            "source_bucket": entry["bucket"],
+            "source_key": entry["key"],
+        }
+        if self.ttl_days:
+            # Only takes effect once TTL is enabled on expires_at for the table
+            item["expires_at"] = int(time.time()) + self.ttl_days * 86400
+        self.table.put_item(Item=item)
+
+    def _delete(self, fingerprint):
+        self.table.delete_item(Key={"fingerprint": fingerprint})
+
+
+def from_env():
+    """Build the index selected by DEDUP_INDEX (lru, dynamodb or off)."""
+    backend = os.environ.get("DEDUP_INDEX", "lru").lower()
+    if backend == "off":
+        return None
+    if backend == "dynamodb":
+        ttl_days = os.environ.get("DEDUP_TTL_DAYS")
+        return DynamoDBIndex(
+            os.environ.get("DEDUP_TABLE", "image-dedup"),
+            endpoint_url=os.environ.get("DEDUP_DYNAMODB_ENDPOINT"),
+            ttl_days=int(ttl_days) if ttl_days else None,
+        )
+    if backend == "lru":
+        return LRUIndex(int(os.environ.get("DEDUP_LRU_SIZE", 4096)))
+    raise ValueError("Unknown DEDUP_INDEX {}".format(backend))
+
+
+def main():
+    # Smoke test of the DynamoDB backend, e.g. against DynamoDB Local
+    endpoint = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    # DynamoDB Local accepts any region and credentials
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    index = DynamoDBIndex("image-dedup-test", endpoint_url=endpoint)
+    try:
+        index.create_table()
+    except index.table.meta.client.exceptions.ResourceInUseException:
+        pass
+    key = fingerprint('"d41d8cd98f00b204e9800998ecf8427e"', [{"scale": 0.5}])
+    print("Lookup before store ", index.get(key))
+    index.put(key, "photos", "cat.jpg")
+    print("Lookup after store  ", index.get(key))
+    index.discard(key)
+    print("Counters            ", index.stats())
+
+
+if __name__ == "__main__":
+    main()
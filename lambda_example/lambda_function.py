@@ -1,26 +1,397 @@
+import time
+
+# Cold start breakdown, logged as one JSON line by the first invocation
+init_timings = {}
+_init_started = time.perf_counter()
+
 import boto3
-import uuid
+import dedup
+import functools
+import hashlib
+import importlib
+import json
+import logging
+import os
+import tempfile
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
 from urllib.parse import unquote_plus
 from PIL import Image
 
-s3_client = boto3.client("s3")
+init_timings["import_ms"] = (time.perf_counter() - _init_started) * 1000
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Records of one event are resized concurrently and every record encodes its
+# renditions concurrently; the client is thread safe and its connection pool
+# is sized so that no worker waits for a connection
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", 8))
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", 4))
+_started = time.perf_counter()
+s3_client = boto3.client(
+    "s3", config=Config(max_pool_connections=MAX_WORKERS * ENCODE_WORKERS)
+)
+
+# Renditions already produced from the same source are copied instead of being
+# rendered again. DEDUP_KEY picks the source fingerprint: the S3 ETag (no
+# download needed) or a SHA-256 of the content (catches identical images
+# uploaded with a different ETag, e.g. multipart uploads).
+dedup_index = dedup.from_env()
+DEDUP_KEY = os.environ.get("DEDUP_KEY", "etag").lower()
+init_timings["client_ms"] = (time.perf_counter() - _started) * 1000
+
+# A bucket the function reads from; HeadBucket on it during init resolves the
+# credentials and opens the first TLS connection before the first request
+PRELOAD_BUCKET = os.environ.get("PRELOAD_BUCKET")
+
+# Objects up to this size are resized entirely in memory; anything larger is
+# spilled to an anonymous file in /tmp that is removed as soon as it is closed
+MAX_IN_MEMORY_BYTES = int(os.environ.get("MAX_IN_MEMORY_BYTES", 64 * 1024 * 1024))
+SPILL_CHUNK_BYTES = 1024 * 1024
+# Let the JPEG decoder do the first downscale (DCT scaling) instead of
+# decoding the full size image
+JPEG_DRAFT = os.environ.get("JPEG_DRAFT", "true").lower() == "true"
+# Resampling filter for every downscale step (NEAREST, BILINEAR, BICUBIC, LANCZOS...)
+RESAMPLE = Image.Resampling[os.environ.get("RESAMPLE", "BICUBIC").upper()]
+
+# Every upload is rendered into each of these. "scale" is relative to the
+# source and "size" is a bounding box in pixels (never upscaled). The "source"
+# format keeps the format of the upload, other formats get their extension
+# appended to the output key. Override with a JSON list in RENDITIONS.
+HALF_SIZE = {
+    "name": "resized",
+    "scale": 0.5,
+    "formats": ["source"],
+    "prefix": "resized-",
+}
+DEFAULT_RENDITIONS = [
+    HALF_SIZE,
+    {"name": "medium", "size": [1024, 1024], "formats": ["source", "webp", "avif"]},
+    {"name": "small", "size": [512, 512], "formats": ["source", "webp", "avif"]},
+    {"name": "thumb", "size": [128, 128], "formats": ["source", "webp", "avif"]},
+]
+RENDITIONS = json.loads(os.environ.get("RENDITIONS", "null")) or DEFAULT_RENDITIONS
+
+# format in the spec -> (Pillow format, content type, save options)
+ENCODERS = {
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True}),
+    "png": ("PNG", "image/png", {"optimize": True}),
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "avif": ("AVIF", "image/avif", {"quality": 60, "speed": 8}),
+}
+# Encoder plugins imported on demand, first one that imports wins. The common
+# decoders (JPEG, PNG, GIF...) are loaded by Image.preinit(); rarely seen
+# formats are left to Image.open, which only imports every plugin when none
+# of those match.
+CODEC_PLUGINS = {
+    "jpeg": ["PIL.JpegImagePlugin"],
+    "png": ["PIL.PngImagePlugin"],
+    "webp": ["PIL.WebPImagePlugin"],
+    "avif": ["PIL.AvifImagePlugin", "pillow_avif"],
+}
+
+
+def target_size(rendition, size):
+    width, height = size
+    if "scale" in rendition:
+        return (
+            max(1, int(width * rendition["scale"])),
+            max(1, int(height * rendition["scale"])),
+        )
+    box_width, box_height = rendition["size"]
+    ratio = min(box_width / width, box_height / height, 1)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def rendition_key(rendition, key, fmt):
+    prefix = rendition.get("prefix", "resized-{}-".format(rendition["name"]))
+    if fmt == "source":
+        return prefix + key
+    return "{}{}.{}".format(prefix, key, fmt)
+
+
+def render(source, renditions):
+    """Decode source once and scale it down to every rendition.
+
+    Renditions are produced from the largest to the smallest, each one
+    resampled from the previous instead of from the full size image.
+    Returns the source format and a list of (rendition, image).
+    """
+    with Image.open(source) as image:
+        source_format = image.format
+        plan = sorted(
+            ((target_size(r, image.size), r) for r in renditions),
+            key=lambda step: step[0][0] * step[0][1],
+            reverse=True,
+        )
+        if JPEG_DRAFT:
+            # No-op for anything that is not a JPEG
+            image.draft(image.mode, plan[0][0])
+        current = image.convert("RGBA") if image.mode == "P" else image
+        rendered = []
+        for size, rendition in plan:
+            current = current.resize(size, RESAMPLE)
+            rendered.append((rendition, current))
+    return source_format, rendered
+
+
+def encode(image, fmt, source_format):
+    if fmt == "source":
+        fmt = source_format.lower()
+    pil_format, content_type, options = ENCODERS.get(
+        fmt, (source_format, Image.MIME.get(source_format), {})
+    )
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, pil_format, **options)
+    buffer.seek(0)
+    return buffer, content_type
+
+
+@functools.lru_cache(maxsize=None)
+def supported(fmt):
+    if fmt == "source" or fmt not in ENCODERS:
+        return True
+    for module in CODEC_PLUGINS.get(fmt, []):
+        try:
+            importlib.import_module(module)
+            break
+        except ImportError:
+            continue
+    if ENCODERS[fmt][0] in Image.SAVE:
+        return True
+    logger.warning("Skipping %s renditions, Pillow has no encoder for it", fmt)
+    return False
 
 
 def resize_image(image_path, resized_path):
-    with Image.open(image_path) as image:
-        image.thumbnail(tuple(x / 2 for x in image.size))
-        image.save(resized_path)
+    # Both arguments may be paths or file objects
+    source_format, [(_, image)] = render(image_path, [HALF_SIZE])
+    image.save(resized_path, format=source_format)
 
 
-def lambda_handler(event, context):
+@contextmanager
+def open_source(bucket, key):
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    body = response["Body"]
+    try:
+        if response["ContentLength"] <= MAX_IN_MEMORY_BYTES:
+            yield BytesIO(body.read())
+        else:
+            # TemporaryFile is unlinked on creation, so nothing is left behind
+            # in /tmp even if the resize fails part way through
+            with tempfile.TemporaryFile() as spill:
+                for chunk in body.iter_chunks(SPILL_CHUNK_BYTES):
+                    spill.write(chunk)
+                spill.seek(0)
+                yield spill
+    finally:
+        body.close()
+
+
+def planned_outputs(renditions):
+    return [
+        (rendition, fmt)
+        for rendition in renditions
+        for fmt in rendition["formats"]
+        if supported(fmt)
+    ]
+
+
+def content_digest(source):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: source.read(SPILL_CHUNK_BYTES), b""):
+        digest.update(chunk)
+    source.seek(0)
+    return digest.hexdigest()
+
+
+def output_spec():
+    """Every setting the renditions depend on, part of the dedup fingerprint:
+    a change to any of them has the renditions rendered again."""
+    return {
+        "renditions": RENDITIONS,
+        "encoders": ENCODERS,
+        "resample": RESAMPLE.name,
+        "jpeg_draft": JPEG_DRAFT,
+        # Encoders and filters change output between releases
+        "pillow": Image.__version__,
+    }
+
+
+def reuse_outputs(fingerprint, bucket, key):
+    """Copy the renditions of an already processed source, True on success."""
+    entry = dedup_index.get(fingerprint)
+    if entry is None:
+        return False
+    outputs = planned_outputs(RENDITIONS)
+    try:
+        if (entry["bucket"], entry["key"]) == (bucket, key):
+            # The same object uploaded again, its renditions are in place
+            rendition, fmt = outputs[0]
+            s3_client.head_object(
+                Bucket="{}-resized".format(bucket),
+                Key=rendition_key(rendition, key, fmt),
+            )
+            return True
+
+        def copy(output):
+            rendition, fmt = output
+            s3_client.copy_object(
+                CopySource={
+                    "Bucket": "{}-resized".format(entry["bucket"]),
+                    "Key": rendition_key(rendition, entry["key"], fmt),
+                },
+                Bucket="{}-resized".format(bucket),
+                Key=rendition_key(rendition, key, fmt),
+            )
+
+        with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as pool:
+            list(pool.map(copy, outputs))
+    except ClientError:
+        # The renditions were removed since, render them again
+        dedup_index.discard(fingerprint)
+        return False
+    return True
+
+
+def process_object(bucket, key, etag=None):
+    fingerprint = None
+    if dedup_index and DEDUP_KEY == "etag":
+        etag = etag or s3_client.head_object(Bucket=bucket, Key=key)["ETag"]
+        # Events carry the ETag without the quotes HeadObject returns
+        fingerprint = dedup.fingerprint(etag.strip('"'), output_spec())
+        if reuse_outputs(fingerprint, bucket, key):
+            return
+
+    with open_source(bucket, key) as source:
+        if dedup_index and DEDUP_KEY == "sha256":
+            fingerprint = dedup.fingerprint(content_digest(source), output_spec())
+            if reuse_outputs(fingerprint, bucket, key):
+                return
+        source_format, rendered = render(source, RENDITIONS)
+    images = {rendition["name"]: image for rendition, image in rendered}
+
+    def publish(output):
+        rendition, fmt = output
+        body, content_type = encode(images[rendition["name"]], fmt, source_format)
+        s3_client.upload_fileobj(
+            body,
+            "{}-resized".format(bucket),
+            rendition_key(rendition, key, fmt),
+            ExtraArgs={"ContentType": content_type} if content_type else None,
+        )
+
+    with ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as pool:
+        # list() re-raises the first encode or upload error
+        list(pool.map(publish, planned_outputs(RENDITIONS)))
+    if fingerprint:
+        dedup_index.put(fingerprint, bucket, key)
+
+
+def s3_records(event):
+    """Yield (item identifier, S3 record) for every object in the event.
+
+    Direct S3 notifications are identified by their key, S3 notifications
+    delivered through SQS by the message id so that SQS can redrive them. A
+    message that is not an S3 notification comes out with a None record, to
+    be reported as failed on its own instead of failing the whole batch.
+    """
     for record in event["Records"]:
+        if record.get("eventSource") == "aws:sqs":
+            try:
+                body = json.loads(record["body"])
+                # S3 sends a test event without records when the queue is
+                # wired up
+                s3_records = list(body.get("Records", []))
+            except (TypeError, ValueError, AttributeError):
+                logger.exception("Unreadable SQS message %s", record["messageId"])
+                yield record["messageId"], None
+                continue
+            for s3_record in s3_records:
+                yield record["messageId"], s3_record
+        else:
+            yield record["s3"]["object"]["key"], record
+
+
+def process_record(identifier, record):
+    if record is None:
+        return identifier
+    try:
         bucket = record["s3"]["bucket"]["name"]
         key = unquote_plus(record["s3"]["object"]["key"])
-        tmpkey = key.replace("/", "")
-        download_path = "/tmp/{}{}".format(uuid.uuid4(), tmpkey)
-        upload_path = "/tmp/resized-{}".format(tmpkey)
-        s3_client.download_file(bucket, key, download_path)
-        resize_image(download_path, upload_path)
-        s3_client.upload_file(
-            upload_path, "{}-resized".format(bucket), "resized-{}".format(key)
+    except (TypeError, KeyError):
+        logger.exception("Not an S3 notification record in %s", identifier)
+        return identifier
+    try:
+        process_object(bucket, key, record["s3"]["object"].get("eTag"))
+    except Exception:
+        logger.exception("Failed to resize s3://%s/%s", bucket, key)
+        return identifier
+    return None
+
+
+def preload():
+    """Front load work of the first request into the init phase."""
+    Image.preinit()
+    for rendition in RENDITIONS:
+        for fmt in rendition["formats"]:
+            supported(fmt)
+    if PRELOAD_BUCKET:
+        try:
+            s3_client.head_bucket(Bucket=PRELOAD_BUCKET)
+        except ClientError as e:
+            logger.warning("Preloading %s failed: %s", PRELOAD_BUCKET, e)
+
+
+_started = time.perf_counter()
+preload()
+init_timings["preload_ms"] = (time.perf_counter() - _started) * 1000
+init_timings["init_ms"] = (time.perf_counter() - _init_started) * 1000
+_init_finished = time.perf_counter()
+_cold_start = True
+
+
+def log_cold_start(context, invoked_at, first_invocation_ms):
+    timings = dict(
+        init_timings,
+        first_invocation_ms=first_invocation_ms,
+        # Large gaps mean the environment was initialized ahead of time
+        # (provisioned concurrency, proactive init)
+        init_to_invoke_ms=(invoked_at - _init_finished) * 1000,
+    )
+    line = {"metric": "cold_start", "function": getattr(context, "function_name", None)}
+    line.update((name, round(ms, 1)) for name, ms in timings.items())
+    print(json.dumps(line))
+
+
+def lambda_handler(event, context):
+    global _cold_start
+    started = time.perf_counter()
+    records = list(s3_records(event))
+    workers = max(1, min(MAX_WORKERS, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        failed = pool.map(lambda args: process_record(*args), records)
+        # Several S3 records can share one SQS message; report it only once
+        failures = sorted(set(identifier for identifier in failed if identifier))
+    if dedup_index:
+        logger.info("Dedup index %s", json.dumps(dedup_index.stats()))
+    if _cold_start:
+        _cold_start = False
+        log_cold_start(context, started, (time.perf_counter() - started) * 1000)
+    if any(r.get("eventSource") == "aws:sqs" for r in event["Records"]):
+        return {"batchItemFailures": [{"itemIdentifier": i} for i in failures]}
+    if failures:
+        # S3 invokes asynchronously and ignores the response: only an error
+        # gets the event retried and then sent to the DLQ or failure destination
+        raise RuntimeError(
+            "Failed to resize {} of {} objects: {}".format(
+                len(failures), len(records), ", ".join(failures)
+            )
         )
+    return {"batchItemFailures": []}
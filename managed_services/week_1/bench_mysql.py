@@ -0,0 +1,301 @@
+# *********************************************************************************************************************
+# MySQL benchmark against a local server (settings as in db_pool: db.ini or DB_HOST, DB_USER...)
+#   connect  every query opens its own connection and closes it afterwards, like rds-1.py used to
+#   pool     every query borrows a connection from the pool
+# The latency of each query includes getting the connection, which is what the pool saves.
+#   bulk     rows/sec of db_bulk.bulk_insert for each --batch-size (1 is row by row)
+#   infile   rows/sec of LOAD DATA LOCAL INFILE (local_infile=ON on the server)
+# The bulk modes load ccspend.csv --repeat times into --table, emptied first.
+#   drivers  point lookups and 100 row range scans of employees, and single row inserts into --table, as plain
+#            text queries and as cached prepared statements (db_statements); latency percentiles and the client
+#            CPU time per query, on one connection
+#
+#   python3 bench_mysql.py --queries 1000 --threads 4
+#   python3 bench_mysql.py --mode pool --driver mysql.connector --query "SELECT 1"
+#   python3 bench_mysql.py --mode bulk --mode infile --repeat 50 --batch-size 1 --batch-size 500
+#   python3 bench_mysql.py --mode drivers --queries 5000
+# *********************************************************************************************************************
+
+import argparse
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db_bulk
+import db_pool
+import db_statements
+
+DEFAULT_QUERY = "SELECT employee_id, employee_name FROM employees limit 10"
+POINT_QUERY = "SELECT employee_id, employee_name FROM employees WHERE employee_id = %s"
+RANGE_QUERY = (
+    "SELECT employee_id, employee_name FROM employees"
+    " WHERE employee_id BETWEEN %s AND %s"
+)
+RANGE_ROWS = 100
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ccspend.csv")
+
+
+def percentile(ordered, pct):
+    """Nearest rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+def report(name, latencies, elapsed):
+    ordered = sorted(latencies)
+    print(
+        " {:28} {:8.0f} queries/s  mean {:7.2f} ms  p50 {:7.2f} ms"
+        "  p99 {:7.2f} ms".format(
+            name,
+            len(ordered) / elapsed,
+            sum(ordered) / max(len(ordered), 1) * 1000,
+            percentile(ordered, 50) * 1000,
+            percentile(ordered, 99) * 1000,
+        )
+    )
+
+
+def run_query(conn, query):
+    cur = conn.cursor()
+    cur.execute(query)
+    cur.fetchall()
+    cur.close()
+
+
+def bench(name, one_query, queries, threads):
+    def timed(_):
+        started = time.perf_counter()
+        one_query()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(timed, range(queries)))
+    report(name, latencies, time.perf_counter() - started)
+
+
+def bench_connect(driver, settings, args):
+    params = dict(
+        (k, settings[k]) for k in ("host", "port", "user", "password", "database")
+    )
+
+    def one_query():
+        conn = db_pool.connect(driver, **params)
+        try:
+            run_query(conn, args.query)
+        finally:
+            conn.close()
+
+    bench("{} connect".format(driver), one_query, args.queries, args.threads)
+
+
+def bench_pool(driver, settings, args):
+    pool = db_pool.ConnectionPool(
+        driver, **dict(settings, min_size=args.threads, max_size=args.threads)
+    )
+
+    def one_query():
+        with pool.connection() as conn:
+            run_query(conn, args.query)
+
+    try:
+        bench("{} pool".format(driver), one_query, args.queries, args.threads)
+        print("  pool ", pool.stats())
+    finally:
+        pool.close()
+
+
+def report_rows(name, rows, elapsed):
+    print(
+        " {:28} {:8.0f} rows/s  {} rows in {:.2f}s".format(
+            name, rows / elapsed, rows, elapsed
+        )
+    )
+
+
+def empty_table(pool, table):
+    with pool.connection() as conn:
+        db_bulk.create_orders_table(conn, table)
+        cur = conn.cursor()
+        cur.execute("TRUNCATE TABLE `{}`".format(table))
+        cur.close()
+
+
+def bench_bulk(driver, settings, args):
+    rows = list(db_bulk.read_rows(args.csv)) * args.repeat
+    pool = db_pool.ConnectionPool(driver, **dict(settings, min_size=1, max_size=1))
+    try:
+        for batch_size in args.batch_size or (1, 100, 1000):
+            empty_table(pool, args.table)
+            started = time.perf_counter()
+            count = db_bulk.bulk_insert(
+                pool,
+                rows,
+                table=args.table,
+                batch_size=batch_size,
+                commit_every=args.commit_every,
+            )
+            report_rows(
+                "{} insert x{}".format(driver, batch_size),
+                count,
+                time.perf_counter() - started,
+            )
+    finally:
+        pool.close()
+
+
+def bench_infile(driver, settings, args):
+    params = dict(settings, min_size=1, max_size=1, **db_bulk.LOCAL_INFILE[driver])
+    pool = db_pool.ConnectionPool(driver, **params)
+    with tempfile.NamedTemporaryFile("wb", suffix=".csv", delete=False) as f:
+        for _ in range(args.repeat):
+            with open(args.csv, "rb") as fixture:
+                shutil.copyfileobj(fixture, f)
+    try:
+        empty_table(pool, args.table)
+        started = time.perf_counter()
+        count = db_bulk.load_infile(pool, f.name, args.table)
+        report_rows("{} load data".format(driver), count, time.perf_counter() - started)
+    finally:
+        os.remove(f.name)
+        pool.close()
+
+
+def report_cpu(name, latencies, cpu, elapsed):
+    ordered = sorted(latencies)
+    print(
+        " {:36} {:8.0f} q/s  p50 {:6.3f} ms  p99 {:6.3f} ms  p99.9 {:6.3f} ms"
+        "  cpu {:5.0f} us/q".format(
+            name,
+            len(ordered) / elapsed,
+            percentile(ordered, 50) * 1000,
+            percentile(ordered, 99) * 1000,
+            percentile(ordered, 99.9) * 1000,
+            cpu / max(len(ordered), 1) * 1e6,
+        )
+    )
+
+
+def timed_loop(name, run, params, commit=None):
+    """Run every params through run(), timing each call and the CPU used."""
+    latencies = []
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    for number, p in enumerate(params, 1):
+        call_started = time.perf_counter()
+        run(p)
+        latencies.append(time.perf_counter() - call_started)
+        # Inserts are committed in groups, outside of the timings
+        if commit is not None and number % 100 == 0:
+            cpu_paused = time.process_time()
+            commit()
+            cpu_started += time.process_time() - cpu_paused
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    if commit is not None:
+        commit()
+    report_cpu(name, latencies, cpu, elapsed)
+
+
+def bench_drivers(driver, settings, args):
+    print(" " + db_pool.describe(driver))
+    pool = db_pool.ConnectionPool(driver, **dict(settings, min_size=1, max_size=1))
+    try:
+        empty_table(pool, args.table)
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT MIN(employee_id), MAX(employee_id) FROM employees")
+            low, high = cur.fetchall()[0]
+            if low is None:
+                raise RuntimeError("The employees table is empty")
+            rng = random.Random(1)
+            points = [(rng.randint(low, high),) for _ in range(args.queries)]
+            ranges = []
+            for _ in range(args.queries):
+                start = rng.randint(low, max(low, high - RANGE_ROWS))
+                ranges.append((start, start + RANGE_ROWS - 1))
+            fixture = list(db_bulk.read_rows(args.csv))
+            rows = [fixture[i % len(fixture)] for i in range(args.queries)]
+            insert = db_bulk.insert_sql(args.table, db_bulk.COLUMN_NAMES, 1)
+
+            def text(sql):
+                def run(params):
+                    cur.execute(sql, params)
+                    if cur.description:
+                        cur.fetchall()
+
+                return run
+
+            def prepared(sql):
+                return lambda params: db_statements.statements(conn).run(sql, params)
+
+            for style, make in (("text", text), ("prepared", prepared)):
+                for workload, sql, params in (
+                    ("point", POINT_QUERY, points),
+                    ("range", RANGE_QUERY, ranges),
+                    ("insert", insert, rows),
+                ):
+                    timed_loop(
+                        "{} {} {}".format(driver, style, workload),
+                        make(sql),
+                        params,
+                        conn.commit if workload == "insert" else None,
+                    )
+            cache = db_statements.statements(conn)
+            print(
+                "  {} statements prepared, {} executions from the cache".format(
+                    cache.prepared, cache.hits
+                )
+            )
+            cur.close()
+    finally:
+        pool.close()
+
+
+MODES = {
+    "connect": bench_connect,
+    "pool": bench_pool,
+    "bulk": bench_bulk,
+    "infile": bench_infile,
+    "drivers": bench_drivers,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MySQL query latency benchmark")
+    parser.add_argument("--mode", choices=sorted(MODES), action="append")
+    parser.add_argument("--driver", choices=db_pool.DRIVERS, action="append")
+    parser.add_argument("--query", default=DEFAULT_QUERY)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--csv", default=FIXTURE, help="rows of the bulk modes")
+    parser.add_argument("--repeat", type=int, default=10, help="times to load --csv")
+    parser.add_argument("--table", default="orders_bench")
+    parser.add_argument("--batch-size", type=int, action="append")
+    parser.add_argument("--commit-every", type=int, default=5000)
+    args = parser.parse_args()
+
+    settings = db_pool.settings()
+    print(
+        "{} queries on {}@{}:{}/{}, {} threads".format(
+            args.queries,
+            settings["user"],
+            settings["host"],
+            settings["port"],
+            settings["database"],
+            args.threads,
+        )
+    )
+    for driver in args.driver or db_pool.DRIVERS:
+        for mode in args.mode or ("connect", "pool"):
+            MODES[mode](driver, settings, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# *********************************************************************************************************************
+# Bulk loading of orders into MySQL, with pymysql or mysql.connector
+# Rows are streamed from a CSV file (ccspend.csv is the reference: no header, the 10 columns of COLUMNS) and written
+# with multi-row INSERT ... VALUES statements of batch_size rows, one round trip and one parse per batch instead of
+# per row. A transaction is committed every commit_every rows; a chunk that fails on a deadlock, a lock wait timeout
+# or a lost connection is rolled back and written again, on a fresh connection when the old one is gone.
+# LOAD DATA LOCAL INFILE is the fast path: the server parses the file itself, in a single statement and transaction.
+# It has to be enabled on the server (local_infile=ON) and on the connection (LOCAL_INFILE params of the driver).
+#
+#   pool = get_pool("pymysql")
+#   with pool.connection() as conn:
+#       create_orders_table(conn)
+#   bulk_insert(pool, read_rows("ccspend.csv"), batch_size=500, commit_every=5000)
+# *********************************************************************************************************************
+
+import csv
+import functools
+import itertools
+import random
+import time
+from decimal import Decimal
+
+ORDERS = "orders"
+
+ORDERS_DDL = """CREATE TABLE IF NOT EXISTS `{}` (
+    order_id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    period INT NOT NULL,
+    agency_number INT NOT NULL,
+    last_name VARCHAR(64) NOT NULL,
+    first_initial CHAR(1) NOT NULL,
+    description VARCHAR(128) NOT NULL,
+    amount DECIMAL(12, 2) NOT NULL,
+    vendor VARCHAR(64) NOT NULL,
+    transaction_date DATETIME NOT NULL,
+    posted_date DATETIME NOT NULL,
+    merchant_category VARCHAR(128) NOT NULL
+)"""
+
+# Connection parameters that allow LOAD DATA LOCAL INFILE, per driver
+LOCAL_INFILE = {
+    "pymysql": {"local_infile": True},
+    "mysql.connector": {"allow_local_infile": True},
+}
+
+# Errors worth another attempt: lock wait timeout, deadlock, and the server
+# going away (2006, 2013 with both drivers, 2055 with mysql.connector)
+RETRYABLE_ERRORS = {1205, 1213, 2006, 2013, 2055}
+CONNECTION_ERRORS = {2006, 2013, 2055}
+
+
+def mysql_timestamp(text):
+    """"07/30/2013 01:05:00 PM" -> "2013-07-30 13:05:00", without strptime."""
+    if len(text) != 22 or text[20:] not in ("AM", "PM"):
+        raise ValueError("Unexpected timestamp {!r}".format(text))
+    hour = int(text[11:13]) % 12 + (12 if text[20:] == "PM" else 0)
+    return "{}-{}-{} {:02d}{}".format(
+        text[6:10], text[:2], text[3:5], hour, text[13:19]
+    )
+
+
+# The columns of the CSV file, in order, and how to convert them
+COLUMNS = (
+    ("period", int),
+    ("agency_number", int),
+    ("last_name", str),
+    ("first_initial", str),
+    ("description", str),
+    ("amount", Decimal),
+    ("vendor", str),
+    ("transaction_date", mysql_timestamp),
+    ("posted_date", mysql_timestamp),
+    ("merchant_category", str),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+
+
+def create_orders_table(conn, table=ORDERS):
+    cur = conn.cursor()
+    cur.execute(ORDERS_DDL.format(table))
+    cur.close()
+    conn.commit()
+
+
+def read_rows(path):
+    """Stream the rows of a CSV file as tuples of converted values."""
+    converters = [convert for _, convert in COLUMNS]
+    with open(path, newline="") as f:
+        for number, fields in enumerate(csv.reader(f), 1):
+            if len(fields) != len(converters):
+                raise ValueError(
+                    "{}:{} has {} columns, expected {}".format(
+                        path, number, len(fields), len(converters)
+                    )
+                )
+            yield tuple(convert(v) for convert, v in zip(converters, fields))
+
+
+@functools.lru_cache(maxsize=32)
+def insert_sql(table, columns, rows):
+    """INSERT of rows rows at once; cached, batches are mostly full ones."""
+    values = "({})".format(", ".join(["%s"] * len(columns)))
+    return "INSERT INTO `{}` ({}) VALUES {}".format(
+        table,
+        ", ".join("`{}`".format(c) for c in columns),
+        ", ".join([values] * rows),
+    )
+
+
+def error_code(error):
+    # mysql.connector sets errno, pymysql passes the code as first argument
+    code = getattr(error, "errno", None)
+    if code is None and error.args and isinstance(error.args[0], int):
+        code = error.args[0]
+    return code
+
+
+def backoff(attempt, base=0.1, cap=5.0):
+    time.sleep(random.uniform(0, min(cap, base * 2**attempt)))
+
+
+def _write_chunk(pool, table, columns, chunk, batch_size, max_attempts):
+    for attempt in range(max_attempts):
+        conn = pool.borrow()
+        try:
+            cur = conn.cursor()
+            for start in range(0, len(chunk), batch_size):
+                batch = chunk[start : start + batch_size]
+                cur.execute(
+                    insert_sql(table, columns, len(batch)),
+                    [value for row in batch for value in row],
+                )
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            code = error_code(e)
+            # release() rolls the chunk back, or closes a connection that died
+            pool.release(conn, discard=code in CONNECTION_ERRORS)
+            if code not in RETRYABLE_ERRORS or attempt == max_attempts - 1:
+                raise
+            backoff(attempt)
+        else:
+            pool.release(conn)
+            return
+
+
+def bulk_insert(
+    pool,
+    rows,
+    table=ORDERS,
+    columns=COLUMN_NAMES,
+    batch_size=500,
+    commit_every=5000,
+    max_attempts=5,
+):
+    """Insert rows (tuples in the order of columns), returns the row count.
+
+    A chunk retried after a lost connection may have been committed before
+    the connection died; load into a table with a unique key to be safe.
+    """
+    rows = iter(rows)
+    commit_every = max(commit_every, batch_size)
+    total = 0
+    while True:
+        chunk = list(itertools.islice(rows, commit_every))
+        if not chunk:
+            return total
+        _write_chunk(pool, table, tuple(columns), chunk, batch_size, max_attempts)
+        total += len(chunk)
+
+
+def load_infile(pool, path, table=ORDERS):
+    """LOAD DATA LOCAL INFILE of a ccspend.csv style file, returns the rows
+    loaded. The pool must be opened with the LOCAL_INFILE params."""
+    columns = [
+        "@" + name if convert is mysql_timestamp else "`{}`".format(name)
+        for name, convert in COLUMNS
+    ]
+    # %r is hh:mm:ss AM/PM in STR_TO_DATE
+    dates = ", ".join(
+        "`{0}` = STR_TO_DATE(@{0}, '%m/%d/%Y %r')".format(name)
+        for name, convert in COLUMNS
+        if convert is mysql_timestamp
+    )
+    # No query parameters: the drivers disagree on how "%%" comes out of
+    # parameter substitution, so the path is quoted here
+    quoted = "'{}'".format(path.replace("\\", "\\\\").replace("'", "\\'"))
+    sql = (
+        "LOAD DATA LOCAL INFILE {} INTO TABLE `{}` CHARACTER SET utf8mb4"
+        " FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"'"
+        " LINES TERMINATED BY '\\n' ({}) SET {}".format(
+            quoted, table, ", ".join(columns), dates
+        )
+    )
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql)
+        loaded = cur.rowcount
+        conn.commit()
+        cur.close()
+    return loaded
@@ -0,0 +1,381 @@
+# *********************************************************************************************************************
+# Connection pool for MySQL, with pymysql or mysql.connector
+# Opening a connection costs a TCP handshake, TLS and authentication, several round trips before the first query;
+# the pool keeps connections open and hands them out again:
+#  - min_size connections are opened upfront, at most max_size are open at any time, borrowers wait up to timeout
+#  - a connection idle for more than check_after seconds is pinged before it is handed out, a dead one is replaced
+#  - connections are closed after max_lifetime seconds (before the server's wait_timeout or a failover does it), and
+#    after idle_timeout seconds without use, down to min_size
+#  - an uncommitted transaction is rolled back when a connection comes back
+#
+# Settings come from the [database] section of $DB_CONFIG (default db.ini) and the environment, which wins:
+#   DB_HOST, DB_PORT [3306], DB_USER, DB_PASSWORD, DB_NAME
+#   DB_POOL_MIN [1], DB_POOL_MAX [8], DB_POOL_TIMEOUT [10], DB_POOL_MAX_LIFETIME [1800], DB_POOL_IDLE_TIMEOUT [300],
+#   DB_POOL_CHECK_AFTER [0.5]
+#
+#   pool = get_pool("pymysql")
+#   with pool.connection() as conn:
+#       cur = conn.cursor()
+#       ...
+# *********************************************************************************************************************
+
+import collections
+import configparser
+import contextlib
+import os
+import threading
+import time
+
+DRIVERS = ("pymysql", "mysql.connector")
+
+# Setting name -> (environment variable, db.ini option, default, type)
+_SETTINGS = {
+    "host": ("DB_HOST", "host", "localhost", str),
+    "port": ("DB_PORT", "port", "3306", int),
+    "user": ("DB_USER", "user", "root", str),
+    "password": ("DB_PASSWORD", "password", "password", str),
+    "database": ("DB_NAME", "database", "employees", str),
+    "min_size": ("DB_POOL_MIN", "pool_min", "1", int),
+    "max_size": ("DB_POOL_MAX", "pool_max", "8", int),
+    "timeout": ("DB_POOL_TIMEOUT", "pool_timeout", "10", float),
+    "max_lifetime": ("DB_POOL_MAX_LIFETIME", "pool_max_lifetime", "1800", float),
+    "idle_timeout": ("DB_POOL_IDLE_TIMEOUT", "pool_idle_timeout", "300", float),
+    "check_after": ("DB_POOL_CHECK_AFTER", "pool_check_after", "0.5", float),
+}
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the pool timeout."""
+
+
+def settings(path=None):
+    """Pool and connection settings from the config file and the environment."""
+    parser = configparser.ConfigParser()
+    parser.read(path or os.environ.get("DB_CONFIG", "db.ini"))
+    section = parser["database"] if parser.has_section("database") else {}
+    values = {}
+    for name, (variable, option, default, kind) in _SETTINGS.items():
+        values[name] = kind(os.environ.get(variable, section.get(option, default)))
+    return values
+
+
+def connect(driver, **params):
+    """Open a connection with one of DRIVERS.
+
+    params (host, port, user, password, database...) go to the driver as they are.
+    """
+    if driver == "pymysql":
+        import pymysql
+
+        return pymysql.connect(**params)
+    if driver == "mysql.connector":
+        import mysql.connector
+
+        # The C extension parses the protocol in C, use it whenever it is
+        # installed (it ships in the mysql-connector-python wheels)
+        params.setdefault("use_pure", not mysql.connector.HAVE_CEXT)
+        return mysql.connector.connect(**params)
+    raise ValueError("Unknown driver {!r}, use one of {}".format(driver, DRIVERS))
+
+
+def describe(driver):
+    """Driver name, version and implementation, e.g. for benchmark reports."""
+    if driver == "pymysql":
+        import pymysql
+
+        return "pymysql {}".format(pymysql.__version__)
+    import mysql.connector
+
+    return "mysql.connector {} ({})".format(
+        mysql.connector.__version__,
+        "C extension" if mysql.connector.HAVE_CEXT else "pure Python",
+    )
+
+
+def _ping(conn):
+    # Both drivers raise when the server is gone; no silent reconnect here, a
+    # reconnected session would have lost its state
+    conn.ping(reconnect=False)
+
+
+class _Pooled:
+    __slots__ = ("conn", "created", "used")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = self.used = time.monotonic()
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        driver="pymysql",
+        min_size=1,
+        max_size=8,
+        timeout=10.0,
+        max_lifetime=1800.0,
+        idle_timeout=300.0,
+        check_after=0.5,
+        **params
+    ):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("Need 0 <= min_size <= max_size and max_size >= 1")
+        self.driver = driver
+        self.params = params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        # Most recently used last: borrowing from the end keeps the warm
+        # connections busy and lets the others reach idle_timeout
+        self._idle = []
+        self._borrowed = {}
+        # Tickets of the callers waiting in borrow(), in arrival order
+        self._queue = collections.deque()
+        # Connections being opened or checked, outside the lock
+        self._pending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = dict(
+            opened=0, closed=0, borrowed=0, waited=0, wait_seconds=0.0, failed_checks=0
+        )
+        for _ in range(min_size):
+            self._idle.append(self._open())
+        self._stopped = threading.Event()
+        if idle_timeout or max_lifetime:
+            reaper = threading.Thread(target=self._reap, name="db-pool-reaper")
+            reaper.daemon = True
+            reaper.start()
+
+    @classmethod
+    def from_settings(cls, driver="pymysql", **overrides):
+        values = settings()
+        values.update(overrides)
+        return cls(driver, **values)
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._borrowed) + self._pending
+
+    def _open(self):
+        pooled = _Pooled(connect(self.driver, **self.params))
+        with self._cond:
+            self._stats["opened"] += 1
+        return pooled
+
+    def _discard(self, pooled):
+        with self._cond:
+            self._stats["closed"] += 1
+        try:
+            pooled.conn.close()
+        except Exception:
+            # Already dead, which is usually why it is discarded
+            pass
+
+    def _expired(self, pooled, now):
+        return self.max_lifetime and now - pooled.created >= self.max_lifetime
+
+    # Borrow / release
+
+    def borrow(self):
+        """A connection for the caller's exclusive use, give it back with
+        release(). Raises PoolTimeout when none is available in time."""
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+        while True:
+            pooled, open_new = None, False
+            with self._cond:
+                try:
+                    while True:
+                        if self._closed:
+                            raise RuntimeError("The pool is closed")
+                        # First come, first served: a caller arriving while
+                        # others wait does not overtake them
+                        if self._queue[0] is ticket:
+                            if self._idle:
+                                pooled = self._idle.pop()
+                                self._pending += 1
+                                break
+                            if self.size < self.max_size:
+                                self._pending += 1
+                                open_new = True
+                                break
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise PoolTimeout(
+                                "No connection available in {}s ({} in use)".format(
+                                    self.timeout, len(self._borrowed)
+                                )
+                            )
+                        if not waited:
+                            waited = True
+                            self._stats["waited"] += 1
+                        started = time.monotonic()
+                        self._cond.wait(remaining)
+                        self._stats["wait_seconds"] += time.monotonic() - started
+                finally:
+                    self._queue.remove(ticket)
+                    # The next in line may be able to go now
+                    self._cond.notify_all()
+            # Network round trips happen outside the lock, the connection is
+            # counted as pending meanwhile
+            try:
+                if open_new:
+                    pooled = self._open()
+                elif not self._usable(pooled):
+                    self._discard(pooled)
+                    pooled = None
+            except Exception:
+                self._settle(None)
+                raise
+            conn = self._settle(pooled)
+            if conn is not None:
+                return conn
+            # Back to the head of the line for another connection
+            with self._cond:
+                self._queue.appendleft(ticket)
+
+    def _usable(self, pooled):
+        now = time.monotonic()
+        if self._expired(pooled, now):
+            return False
+        if now - pooled.used >= self.check_after:
+            try:
+                _ping(pooled.conn)
+            except Exception:
+                with self._cond:
+                    self._stats["failed_checks"] += 1
+                return False
+        return True
+
+    def _settle(self, pooled):
+        with self._cond:
+            self._pending -= 1
+            if pooled is None:
+                # Room for another connection, let a waiter open it
+                self._cond.notify_all()
+                return None
+            return self._lend(pooled)
+
+    def _lend(self, pooled):
+        self._borrowed[id(pooled.conn)] = pooled
+        self._stats["borrowed"] += 1
+        return pooled.conn
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def release(self, conn, discard=False):
+        """Give a borrowed connection back; discard=True closes it instead."""
+        with self._cond:
+            pooled = self._borrowed.pop(id(conn))
+        if not discard and not self._closed:
+            try:
+                # Whatever the borrower left uncommitted does not leak into
+                # the next one's transaction
+                conn.rollback()
+            except Exception:
+                discard = True
+        now = time.monotonic()
+        if discard or self._closed or self._expired(pooled, now):
+            self._discard(pooled)
+            self._wake()
+            return
+        pooled.used = now
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.borrow()
+        try:
+            yield conn
+        except Exception:
+            # rollback() in release tells whether the connection survived
+            self.release(conn)
+            raise
+        self.release(conn)
+
+    # Maintenance
+
+    def evict(self):
+        """Close the connections past max_lifetime, and the ones idle for
+        longer than idle_timeout beyond min_size."""
+        now = time.monotonic()
+        with self._cond:
+            keep, evicted = [], []
+            # Oldest use first, those are the ones to let go
+            for pooled in self._idle:
+                idle_for = now - pooled.used
+                surplus = self.size - len(evicted) > self.min_size
+                if self._expired(pooled, now) or (
+                    self.idle_timeout and idle_for >= self.idle_timeout and surplus
+                ):
+                    evicted.append(pooled)
+                else:
+                    keep.append(pooled)
+            self._idle = keep
+        for pooled in evicted:
+            self._discard(pooled)
+        # Top up to min_size, e.g. after expired connections were closed
+        while not self._closed:
+            with self._cond:
+                if self.size >= self.min_size:
+                    break
+                self._pending += 1
+            try:
+                pooled = self._open()
+            finally:
+                with self._cond:
+                    self._pending -= 1
+            with self._cond:
+                self._idle.insert(0, pooled)
+                self._cond.notify_all()
+        return len(evicted)
+
+    def _reap(self):
+        interval = min(t for t in (self.idle_timeout, self.max_lifetime) if t) / 4.0
+        while not self._stopped.wait(max(interval, 0.1)):
+            try:
+                self.evict()
+            except Exception:
+                # The database is down, borrowers will see it
+                pass
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                self._stats,
+                size=self.size,
+                idle=len(self._idle),
+                in_use=len(self._borrowed),
+            )
+
+    def close(self):
+        """Close the idle connections now, borrowed ones when released."""
+        self._stopped.set()
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(driver="pymysql"):
+    """The shared pool of a driver, created from settings() on first use."""
+    with _pools_lock:
+        if driver not in _pools:
+            _pools[driver] = ConnectionPool.from_settings(driver)
+        return _pools[driver]
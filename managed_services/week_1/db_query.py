@@ -0,0 +1,92 @@
+# *********************************************************************************************************************
+# Reading large results from MySQL with flat memory, with pymysql or mysql.connector
+# stream_rows: an unbuffered (server side) cursor, pymysql's SSCursor or mysql.connector's buffered=False, read in
+# fetchmany() batches. Only one batch is in client memory at a time, but the connection is busy until the result is
+# read to the end; leaving early still reads (and drops) the rest of the result off the wire.
+# keyset_rows: pages of "WHERE key > last key ORDER BY key LIMIT n". Each page is an index range seek, so page 10000
+# costs the same as page 1 (LIMIT n OFFSET m reads and throws away m rows), the connection is free between pages
+# and an export can stop or resume anywhere from the last key it saw.
+#
+#   with get_pool("pymysql").connection() as conn:
+#       for row in stream_rows(conn, "SELECT * FROM employees"):
+#           ...
+#       for row in keyset_rows(conn, "employees", "employee_id", ["employee_id", "employee_name"]):
+#           ...
+# *********************************************************************************************************************
+
+
+def _is_pymysql(conn):
+    return type(conn).__module__.startswith("pymysql")
+
+
+def server_cursor(conn):
+    """A cursor that leaves the result on the server until it is fetched."""
+    if _is_pymysql(conn):
+        import pymysql.cursors
+
+        return conn.cursor(pymysql.cursors.SSCursor)
+    return conn.cursor(buffered=False)
+
+
+def stream_rows(conn, query, params=None, batch_size=1000):
+    """Yield the rows of a query, fetching batch_size rows at a time."""
+    cur = server_cursor(conn)
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+    finally:
+        if not _is_pymysql(conn):
+            # SSCursor.close() reads the rest of the result itself,
+            # mysql.connector would raise "Unread result found" instead
+            conn.consume_results()
+        cur.close()
+
+
+def keyset_pages(
+    conn, table, key, columns, page_size=1000, where=None, params=(), start_after=None
+):
+    """Yield pages (lists of rows) of a table in key order.
+
+    key must be unique and indexed (the primary key is), it is added to the
+    columns when missing. where is an extra condition with %s parameters.
+    start_after resumes after that key.
+    """
+    columns = list(columns)
+    if key not in columns:
+        columns.append(key)
+    position = columns.index(key)
+    select = "SELECT {} FROM `{}`".format(
+        ", ".join("`{}`".format(c) for c in columns), table
+    )
+    order = " ORDER BY `{}` LIMIT %s".format(key)
+    extra = " AND ({})".format(where) if where else ""
+    # The first page has no lower bound, the key may be negative or a string
+    first = select + (" WHERE ({})".format(where) if where else "") + order
+    query = select + " WHERE `{}` > %s".format(key) + extra + order
+    last = start_after
+    while True:
+        cur = conn.cursor()
+        if last is None:
+            cur.execute(first, tuple(params) + (page_size,))
+        else:
+            cur.execute(query, (last,) + tuple(params) + (page_size,))
+        page = cur.fetchall()
+        cur.close()
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1][position]
+
+
+def keyset_rows(conn, table, key, columns, page_size=1000, **kwargs):
+    """Yield the rows of keyset_pages one by one."""
+    for page in keyset_pages(conn, table, key, columns, page_size, **kwargs):
+        for row in page:
+            yield row
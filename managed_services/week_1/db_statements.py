@@ -0,0 +1,130 @@
+# *********************************************************************************************************************
+# Prepared statement cache, per connection, for pymysql and mysql.connector
+# A plain execute() sends the SQL text with the values inlined, and the server parses and plans it every time. Here
+# every distinct SQL text is prepared once per connection and executed again with new values:
+#  - mysql.connector: one prepared cursor (binary protocol, COM_STMT_PREPARE/EXECUTE) per statement; the values travel
+#    in binary form and the C extension cursor is used when the extension is installed
+#  - pymysql has no binary protocol: the statement is prepared with SQL PREPARE, the values go to user variables
+#    (SET @p0 = ..., ...) and EXECUTE ... USING runs it. That is two round trips instead of one, which only pays
+#    off for statements that are expensive to parse; the benchmark in bench_mysql.py tells.
+# Statements use %s placeholders, as with the plain cursors. The least recently used statement is deallocated when a
+# connection holds max_statements of them (the server caps them at max_prepared_stmt_count).
+#
+#   with get_pool("mysql.connector").connection() as conn:
+#       rows = query(conn, "SELECT employee_name FROM employees WHERE employee_id = %s", (10001,))
+#       execute(conn, "UPDATE employees SET employee_name = %s WHERE employee_id = %s", ("Kirk", 10001))
+# *********************************************************************************************************************
+
+import collections
+
+MAX_STATEMENTS = 64
+
+
+class StatementCache:
+    """The prepared statements of one connection, by SQL text."""
+
+    def __init__(self, conn, max_statements=MAX_STATEMENTS):
+        self.conn = conn
+        self.max_statements = max_statements
+        self.pymysql = type(conn).__module__.startswith("pymysql")
+        # SQL -> (SQL, prepared cursor) with mysql.connector, (statement
+        # name, number of placeholders) with pymysql
+        self._statements = collections.OrderedDict()
+        self._names = 0
+        self.prepared = 0
+        self.hits = 0
+
+    def run(self, sql, params=()):
+        """Execute a statement, returns (rows or None, rowcount)."""
+        statement = self._statements.get(sql)
+        if statement is None:
+            statement = self._prepare(sql)
+        else:
+            self.hits += 1
+            self._statements.move_to_end(sql)
+        if self.pymysql:
+            return self._run_pymysql(statement, params)
+        # The cursor prepares again unless it gets the very str it prepared
+        sql, cur = statement
+        cur.execute(sql, tuple(params))
+        rows = cur.fetchall() if cur.description else None
+        return rows, cur.rowcount
+
+    def _prepare(self, sql):
+        if len(self._statements) >= self.max_statements:
+            _, oldest = self._statements.popitem(last=False)
+            self._deallocate(oldest)
+        if self.pymysql:
+            self._names += 1
+            name = "stmt_{}".format(self._names)
+            placeholders = sql.count("%s")
+            cur = self.conn.cursor()
+            # PREPARE takes ? placeholders, and the statement as a string
+            text = sql.replace("%s", "?").replace("%%", "%")
+            cur.execute("PREPARE {} FROM %s".format(name), (text,))
+            cur.close()
+            statement = (name, placeholders)
+        else:
+            statement = (sql, self.conn.cursor(prepared=True))
+        self._statements[sql] = statement
+        self.prepared += 1
+        return statement
+
+    def _run_pymysql(self, statement, params):
+        name, placeholders = statement
+        if len(params) != placeholders:
+            raise ValueError(
+                "{} parameters for {} placeholders".format(len(params), placeholders)
+            )
+        cur = self.conn.cursor()
+        try:
+            if placeholders:
+                variables = ["@p{}".format(i) for i in range(placeholders)]
+                cur.execute(
+                    "SET " + ", ".join(v + " = %s" for v in variables), tuple(params)
+                )
+                cur.execute("EXECUTE {} USING {}".format(name, ", ".join(variables)))
+            else:
+                cur.execute("EXECUTE " + name)
+            rows = cur.fetchall() if cur.description else None
+            return rows, cur.rowcount
+        finally:
+            cur.close()
+
+    def _deallocate(self, statement):
+        try:
+            if self.pymysql:
+                cur = self.conn.cursor()
+                cur.execute("DEALLOCATE PREPARE " + statement[0])
+                cur.close()
+            else:
+                # Closing a prepared cursor closes its statement on the server
+                statement[1].close()
+        except Exception:
+            # Gone with the connection already
+            pass
+
+    def clear(self):
+        while self._statements:
+            _, statement = self._statements.popitem(last=False)
+            self._deallocate(statement)
+
+
+def statements(conn):
+    """The StatementCache of a connection, created on first use."""
+    cache = getattr(conn, "_statement_cache", None)
+    if cache is None:
+        # Kept on the connection itself, so that it goes away with it (a
+        # connection is only used by the thread that borrowed it)
+        cache = conn._statement_cache = StatementCache(conn)
+    return cache
+
+
+def query(conn, sql, params=()):
+    """Rows of a prepared SELECT."""
+    return statements(conn).run(sql, params)[0]
+
+
+def execute(conn, sql, params=()):
+    """Run a prepared INSERT/UPDATE/DELETE, returns the affected row count."""
+    return statements(conn).run(sql, params)[1]
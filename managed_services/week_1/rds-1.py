@@ -2,62 +2,77 @@
 # Author - Nirmallya Mukherjee
 # This script will connect to a MySQL DB using multiple driver options
 # *********************************************************************************************************************
-import pymysql
-import mysql.connector
+import os
+import time
 
-hostname = "mydb.123456789012.us-east-1.rds.amazonaws.com"
-# hostname = 'localhost'
-username = "root"
-password = "password"
-database = "employees"
+from db_bulk import bulk_insert, create_orders_table, read_rows
+from db_pool import get_pool
+from db_query import keyset_pages, stream_rows
+
+# Host and credentials come from db.ini ([database] section) or the environment, e.g.
+#   export DB_HOST=mydb.123456789012.us-east-1.rds.amazonaws.com DB_USER=root DB_PASSWORD=... DB_NAME=employees
+# Every driver gets a pool of open connections, so a query no longer pays for the TCP handshake and the authentication
+ORDERS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ccspend.csv")
 
 
 # Simple routine to run a query on a database and print the results:
-def doQuery(conn):
-    cur = conn.cursor()
-    cur.execute("SELECT employee_id, employee_name FROM employees limit 10")
-    for emp_name in cur.fetchall():
-        print(emp_name)
+def doQuery(pool):
+    # The connection goes back to the pool, open, when the block ends
+    with pool.connection() as conn:
+        # Rows come off an unbuffered cursor in batches instead of all at once with fetchall()
+        query = "SELECT employee_id, employee_name FROM employees limit 10"
+        for emp_name in stream_rows(conn, query):
+            print(emp_name)
+
+
+def exportEmployees(pool, page_size=1000):
+    print("\n\nExporting the employees table page by page")
+    print("------------------------------------------")
+    # Keyset pagination on employee_id: every page is an index seek, however deep into the table it is
+    count = pages = 0
+    columns = ["employee_id", "employee_name"]
+    with pool.connection() as conn:
+        for page in keyset_pages(conn, "employees", "employee_id", columns, page_size):
+            count += len(page)
+            pages += 1
+    print(" {} employees in {} pages".format(count, pages))
 
 
 def pymysqlConnector():
     print("Using pymysql")
     print("-------------")
-    myConnection = pymysql.connect(
-        host=hostname, user=username, passwd=password, db=database
-    )
-    doQuery(myConnection)
-    myConnection.close()
+    doQuery(get_pool("pymysql"))
 
 
 def mysqlConnector():
     print("\n\nUsing mysql.connector")
     print("---------------------")
-    myConnection = mysql.connector.connect(
-        host=hostname, user=username, passwd=password, db=database
-    )
-    doQuery(myConnection)
-    myConnection.close()
+    doQuery(get_pool("mysql.connector"))
 
 
 def createOrder():
     print(
-        "\n\nUsing any of the above connectors, insert a new record in the orders table"
+        "\n\nUsing any of the above connectors, load the orders of ccspend.csv in the"
+        " orders table"
     )
-    conn = mysql.connector.connect(
-        host=hostname, user=username, passwd=password, db=database
+    pool = get_pool("mysql.connector")
+    with pool.connection() as conn:
+        create_orders_table(conn)
+    started = time.perf_counter()
+    # Multi-row INSERTs of 500 orders, committed every 5000; the fast path is load_infile(pool, path)
+    count = bulk_insert(pool, read_rows(ORDERS_CSV), batch_size=500, commit_every=5000)
+    elapsed = time.perf_counter() - started
+    print(
+        " Inserted {} orders in {:.2f}s ({:.0f} rows/sec)".format(
+            count, elapsed, count / elapsed
+        )
     )
-    cur = conn.cursor()
-    # TBD:You have to write this code and submit as part of the lab
-
-    conn.commit()
-    cur.close()
-    conn.close()
 
 
 def main():
     pymysqlConnector()
     mysqlConnector()
+    exportEmployees(get_pool("pymysql"))
     createOrder()
 
 
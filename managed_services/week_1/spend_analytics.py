@@ -0,0 +1,413 @@
+# *********************************************************************************************************************
+# Card spend analytics over ccspend.csv style files (no header, the 10 columns of db_bulk.COLUMNS), in bounded memory
+# The file is read chunk_rows rows at a time; each chunk becomes NumPy columns and is folded into the aggregates, so
+# memory depends on the chunk size and the number of distinct groups, not on the size of the file:
+#  - every dimension (cardholder = last name and first initial, vendor, merchant category, period) maps its strings
+#    to int codes with a vocabulary shared by all chunks; totals and counts are np.bincount over the codes
+#  - percentiles come from a histogram per group with log-spaced bins (BINS_PER_DECADE per power of ten, refunds
+#    in bins of their own), kept sparse: only the cells seen hold memory. The value of a bin is its geometric middle,
+#    within about 6% of the exact percentile
+#  - transaction and posted dates ("07/30/2013 01:05:00 PM") are parsed by column, as fixed-width bytes
+#
+#   python3 spend_analytics.py report ccspend.csv --top 10 --sort total
+#   python3 spend_analytics.py report ccspend.csv --dimension vendor --sort p90 --percentile 50 --percentile 90
+#   python3 spend_analytics.py bench ccspend.csv --repeat 1000 --chunk-rows 20000
+#
+#   analytics = SpendAnalytics()
+#   analytics.process("ccspend.csv")
+#   for name, count, total in analytics.top("vendor", 5, by="total", columns=("count", "total")):
+#       ...
+# *********************************************************************************************************************
+
+import argparse
+import csv
+import gc
+import itertools
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from db_bulk import COLUMN_NAMES
+
+CHUNK_ROWS = 50000
+DIMENSIONS = ("cardholder", "vendor", "merchant_category", "period")
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ccspend.csv")
+
+# Amount histogram: |amount| from MIN_AMOUNT to MAX_AMOUNT in log-spaced bins,
+# smaller amounts in a zero bin, larger ones in the last bin. Bins are laid
+# out in value order: refunds (largest first), zero, purchases.
+BINS_PER_DECADE = 20
+MIN_AMOUNT = 0.01
+MAX_AMOUNT = 1e8
+_SIDE = int(round(np.log10(MAX_AMOUNT / MIN_AMOUNT) * BINS_PER_DECADE))
+HISTOGRAM_BINS = 2 * _SIDE + 1
+_MIDDLES = MIN_AMOUNT * 10 ** ((np.arange(_SIDE) + 0.5) / BINS_PER_DECADE)
+BIN_VALUES = np.concatenate([-_MIDDLES[::-1], [0.0], _MIDDLES])
+
+_COLUMN = dict((name, i) for i, name in enumerate(COLUMN_NAMES))
+
+
+def amount_bins(amounts):
+    """Histogram bin of each amount, in 0 .. HISTOGRAM_BINS - 1."""
+    magnitude = np.abs(amounts)
+    with np.errstate(divide="ignore"):
+        steps = np.floor(np.log10(magnitude / MIN_AMOUNT) * BINS_PER_DECADE)
+    steps = np.clip(steps, -1, _SIDE - 1).astype(np.int64)
+    bins = np.where(amounts < 0, _SIDE - 1 - steps, _SIDE + 1 + steps)
+    bins[steps < 0] = _SIDE
+    return bins
+
+
+# "MM/DD/YYYY HH:MM:SS AM": byte offsets of the fields and of the separators
+_TIMESTAMP_WIDTH = 22
+_DIGITS = [0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15, 17, 18]
+_SEPARATORS = {2: b"/", 5: b"/", 10: b" ", 13: b":", 16: b":", 19: b" ", 21: b"M"}
+
+
+def parse_timestamps(values):
+    """datetime64[s] array of "07/30/2013 01:05:00 PM" strings, without
+    strptime: the strings are viewed as a matrix of bytes."""
+    raw = np.array(values, dtype="S{}".format(_TIMESTAMP_WIDTH + 1))
+    chars = raw.view(np.uint8).reshape(len(raw), _TIMESTAMP_WIDTH + 1)
+    digits = chars[:, _DIGITS].astype(np.int64) - ord("0")
+    valid = (chars[:, _TIMESTAMP_WIDTH] == 0) & np.all((digits >= 0) & (digits <= 9), 1)
+    for offset, separator in _SEPARATORS.items():
+        valid &= chars[:, offset] == ord(separator)
+    pm = chars[:, 20] == ord("P")
+    valid &= pm | (chars[:, 20] == ord("A"))
+    if not valid.all():
+        bad = int(np.argmin(valid))
+        raise ValueError(
+            "Unexpected timestamp {!r} ({} in the chunk)".format(
+                values[bad], int(np.count_nonzero(~valid))
+            )
+        )
+
+    def number(*positions):
+        value = 0
+        for p in positions:
+            value = value * 10 + digits[:, _DIGITS.index(p)]
+        return value
+
+    months = (number(6, 7, 8, 9) - 1970) * 12 + number(0, 1) - 1
+    days = months.astype("datetime64[M]").astype("datetime64[D]") + (number(3, 4) - 1)
+    hours = number(11, 12) % 12 + np.where(pm, 12, 0)
+    seconds = hours * 3600 + number(14, 15) * 60 + number(17, 18)
+    return days.astype("datetime64[s]") + seconds
+
+
+def read_chunks(path, chunk_rows=CHUNK_ROWS):
+    """Yield the rows of a CSV file as tuples of column values (strings),
+    chunk_rows rows at a time."""
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        first = 1
+        while True:
+            # Millions of new lists and strings would set the cyclic garbage
+            # collector off again and again, for nothing: rows hold no cycles
+            enabled = gc.isenabled()
+            gc.disable()
+            try:
+                rows = list(itertools.islice(reader, chunk_rows))
+            finally:
+                if enabled:
+                    gc.enable()
+            if not rows:
+                return
+            widths = set(map(len, rows))
+            if widths != {len(COLUMN_NAMES)}:
+                bad = next(i for i, r in enumerate(rows) if len(r) != len(COLUMN_NAMES))
+                raise ValueError(
+                    "{}:{} has {} columns, expected {}".format(
+                        path, first + bad, len(rows[bad]), len(COLUMN_NAMES)
+                    )
+                )
+            first += len(rows)
+            yield tuple(zip(*rows))
+
+
+class Vocabulary:
+    """Strings to int codes, in order of first appearance."""
+
+    def __init__(self):
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, values):
+        codes = self.codes
+        # Codes are handed out as len(codes) grows with every new string
+        return np.fromiter(
+            (codes.setdefault(v, len(codes)) for v in values), np.int64, len(values)
+        )
+
+    def names(self):
+        return list(self.codes)
+
+
+class Dimension:
+    """Count, total and amount histogram of every group of one dimension."""
+
+    def __init__(self, name):
+        self.name = name
+        self.vocabulary = Vocabulary()
+        self.counts = np.zeros(0, np.int64)
+        self.totals = np.zeros(0, np.float64)
+        # Non-empty cells (group * HISTOGRAM_BINS + bin), sorted, and their counts
+        self.cells = np.zeros(0, np.int64)
+        self.cell_counts = np.zeros(0, np.int64)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def add(self, codes, amounts, bins):
+        """Fold rows in: codes from the vocabulary, amounts and their bins."""
+        groups = len(self.vocabulary)
+        self.counts = _grow(self.counts, groups) + np.bincount(codes, minlength=groups)
+        self.totals = _grow(self.totals, groups) + np.bincount(
+            codes, weights=amounts, minlength=groups
+        )
+        cells, counts = np.unique(codes * HISTOGRAM_BINS + bins, return_counts=True)
+        self._merge(cells, counts)
+
+    def _merge(self, cells, counts):
+        positions = np.searchsorted(self.cells, cells)
+        known = positions < len(self.cells)
+        known[known] = self.cells[positions[known]] == cells[known]
+        self.cell_counts[positions[known]] += counts[known]
+        new = ~known
+        if new.any():
+            self.cells = np.insert(self.cells, positions[new], cells[new])
+            self.cell_counts = np.insert(self.cell_counts, positions[new], counts[new])
+
+    def percentiles(self, pcts):
+        """(groups, len(pcts)) array of nearest rank percentiles, from the
+        histograms."""
+        groups = len(self.counts)
+        result = np.zeros((groups, len(pcts)))
+        if not groups:
+            return result
+        owners = self.cells // HISTOGRAM_BINS
+        bins = self.cells % HISTOGRAM_BINS
+        cumulative = np.cumsum(self.cell_counts)
+        # Cells counted before each group's first cell
+        first = np.searchsorted(owners, np.arange(groups))
+        before = np.where(first > 0, cumulative[first - 1], 0)
+        for column, pct in enumerate(pcts):
+            rank = np.maximum(np.ceil(pct / 100.0 * self.counts), 1).astype(np.int64)
+            cell = np.searchsorted(cumulative, before + rank)
+            result[:, column] = BIN_VALUES[bins[cell]]
+        return result
+
+    def values(self, column):
+        """One value per group: count, total, mean or pNN (e.g. p90)."""
+        if column == "count":
+            return self.counts
+        if column == "total":
+            return self.totals
+        if column == "mean":
+            return self.totals / np.maximum(self.counts, 1)
+        if column.startswith("p"):
+            return self.percentiles([float(column[1:])])[:, 0]
+        raise ValueError("Unknown column {!r}".format(column))
+
+    def top(self, k=10, by="total", columns=("count", "total", "mean")):
+        """Rows (name, *columns) of the k groups with the largest by, largest
+        first."""
+        keys = self.values(by)
+        k = min(k, len(keys))
+        if k <= 0:
+            return []
+        chosen = np.argpartition(-keys, k - 1)[:k]
+        chosen = chosen[np.argsort(-keys[chosen], kind="stable")]
+        names = self.vocabulary.names()
+        data = [self.values(c)[chosen] for c in columns]
+        return [
+            (names[g],) + tuple(v[i].item() for v in data) for i, g in enumerate(chosen)
+        ]
+
+
+def cardholders(last_names, first_initials):
+    """Cardholder keys, "Last, F"."""
+    return ["{}, {}".format(*names) for names in zip(last_names, first_initials)]
+
+
+def _grow(array, size):
+    if len(array) >= size:
+        return array
+    return np.concatenate([array, np.zeros(size - len(array), array.dtype)])
+
+
+class SpendAnalytics:
+    def __init__(self, dimensions=DIMENSIONS):
+        self.dimensions = dict((name, Dimension(name)) for name in dimensions)
+        self.rows = 0
+        self.total = 0.0
+        self.first_transaction = None
+        self.last_transaction = None
+        self.lag_seconds = 0
+        # Seconds spent reading/splitting the CSV, converting, aggregating
+        self.timings = dict(parse=0.0, convert=0.0, aggregate=0.0)
+
+    def add_chunk(self, columns):
+        """Fold a chunk (tuple of columns, as from read_chunks) into the
+        aggregates."""
+        started = time.perf_counter()
+        amounts = np.array(columns[_COLUMN["amount"]], dtype=np.float64)
+        transactions = parse_timestamps(columns[_COLUMN["transaction_date"]])
+        posted = parse_timestamps(columns[_COLUMN["posted_date"]])
+        codes = {}
+        for name, dimension in self.dimensions.items():
+            if name == "cardholder":
+                values = cardholders(
+                    columns[_COLUMN["last_name"]], columns[_COLUMN["first_initial"]]
+                )
+            else:
+                values = columns[_COLUMN[name]]
+            codes[name] = dimension.vocabulary.encode(values)
+        self.timings["convert"] += time.perf_counter() - started
+        self.add_columns(amounts, transactions, posted, codes)
+
+    def add_columns(self, amounts, transactions, posted, codes):
+        """Fold converted columns into the aggregates: amounts, datetime64
+        dates and, for every dimension, the codes of its vocabulary."""
+        started = time.perf_counter()
+        bins = amount_bins(amounts)
+        for name, dimension in self.dimensions.items():
+            dimension.add(codes[name], amounts, bins)
+        self.rows += len(amounts)
+        self.total += float(amounts.sum())
+        self.lag_seconds += int((posted - transactions).astype(np.int64).sum())
+        low, high = transactions.min(), transactions.max()
+        if self.first_transaction is None or low < self.first_transaction:
+            self.first_transaction = low
+        if self.last_transaction is None or high > self.last_transaction:
+            self.last_transaction = high
+        self.timings["aggregate"] += time.perf_counter() - started
+
+    def process(self, path, chunk_rows=CHUNK_ROWS):
+        """Aggregate a whole file, returns the number of rows read."""
+        rows = self.rows
+        chunks = read_chunks(path, chunk_rows)
+        while True:
+            started = time.perf_counter()
+            columns = next(chunks, None)
+            self.timings["parse"] += time.perf_counter() - started
+            if columns is None:
+                return self.rows - rows
+            self.add_chunk(columns)
+
+    def top(self, dimension, k=10, by="total", columns=("count", "total", "mean")):
+        return self.dimensions[dimension].top(k, by, columns)
+
+    def summary(self):
+        return dict(
+            rows=self.rows,
+            total=round(self.total, 2),
+            first_transaction=str(self.first_transaction),
+            last_transaction=str(self.last_transaction),
+            mean_posting_lag_days=round(
+                self.lag_seconds / max(self.rows, 1) / 86400.0, 2
+            ),
+            groups=dict((name, len(d)) for name, d in self.dimensions.items()),
+        )
+
+
+def max_rss_mb():
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+def print_top(analytics, dimension, k, by, pcts):
+    columns = ("count", "total", "mean") + tuple("p{:g}".format(p) for p in pcts)
+    print("{} by {}, top {}".format(dimension, by, k))
+    print(
+        "  {:40} {:>8}".format("", "count")
+        + "".join(" {:>12}".format(c) for c in columns[1:])
+    )
+    for row in analytics.top(dimension, k, by, columns):
+        print(
+            "  {:40} {:8d}".format(str(row[0])[:40], row[1])
+            + "".join(" {:12.2f}".format(v) for v in row[2:])
+        )
+
+
+def report(args):
+    analytics = SpendAnalytics()
+    analytics.process(args.csv, args.chunk_rows)
+    for key, value in analytics.summary().items():
+        print("{}: {}".format(key, value))
+    for dimension in args.dimension or DIMENSIONS:
+        print_top(
+            analytics, dimension, args.top, args.sort, args.percentile or (50, 90, 99)
+        )
+
+
+def bench(args):
+    # --repeat copies of the file, like an extract of that many rows
+    with tempfile.NamedTemporaryFile("wb", suffix=".csv", delete=False) as f:
+        for _ in range(args.repeat):
+            with open(args.csv, "rb") as fixture:
+                shutil.copyfileobj(fixture, f)
+    try:
+        size = os.path.getsize(f.name)
+        analytics = SpendAnalytics()
+        started = time.perf_counter()
+        rows = analytics.process(f.name, args.chunk_rows)
+        for dimension in DIMENSIONS:
+            analytics.top(dimension, args.top, "p90")
+        elapsed = time.perf_counter() - started
+    finally:
+        os.remove(f.name)
+    print(
+        "{} rows ({:.0f} MB) in {:.2f}s: {:.0f} rows/s, {:.1f} MB/s,"
+        " max RSS {:.0f} MB".format(
+            rows,
+            size / 1e6,
+            elapsed,
+            rows / elapsed,
+            size / 1e6 / elapsed,
+            max_rss_mb(),
+        )
+    )
+    print(
+        "  "
+        + "  ".join(
+            "{} {:.2f}s".format(phase, seconds)
+            for phase, seconds in analytics.timings.items()
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Card spend analytics")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    for name, run in (("report", report), ("bench", bench)):
+        command = commands.add_parser(name)
+        command.set_defaults(run=run)
+        command.add_argument("csv", nargs="?", default=FIXTURE)
+        command.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+        command.add_argument("--top", type=int, default=10)
+    report_parser = commands.choices["report"]
+    report_parser.add_argument("--dimension", choices=DIMENSIONS, action="append")
+    report_parser.add_argument(
+        "--sort", default="total", help="count, total, mean or pNN, e.g. p90"
+    )
+    report_parser.add_argument("--percentile", type=float, action="append")
+    commands.choices["bench"].add_argument(
+        "--repeat", type=int, default=100, help="copies of the file to process"
+    )
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
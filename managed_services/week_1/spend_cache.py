@@ -0,0 +1,418 @@
+# *********************************************************************************************************************
+# Columnar cache of a ccspend.csv style file, for spend_analytics
+# The CSV is parsed once into a directory of .npy files, one per column:
+#  - period and agency_number as int32, amount as float64
+#  - transaction_date and posted_date as int64 seconds since the epoch
+#  - last_name, first_initial, description, vendor, merchant_category and cardholder ("Last, F") as int32 codes into
+#    a dictionary of their strings (<column>.dict.json, read on first use)
+# and opened with np.load(mmap_mode="r"): opening reads the headers only, pages come from the page cache as they are
+# touched, and processes working on the same cache share them. meta.json records the size and mtime of the source;
+# when they no longer match, open_cache() builds the cache again. meta.json is written last and removed first, a
+# cache left half built by a crash is never used.
+#
+#   python3 spend_cache.py build ccspend.csv
+#   python3 spend_cache.py report ccspend.csv --dimension vendor --sort p90
+#   python3 spend_cache.py bench ccspend.csv --repeat 1000
+#
+#   table = open_cache("ccspend.csv")
+#   amounts = table.columns["amount"]
+#   vendors = table.decode("vendor", table.columns["vendor"][:10])
+#   analytics = analyze(table)
+# *********************************************************************************************************************
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import spend_analytics
+from db_bulk import COLUMN_NAMES
+from spend_analytics import (
+    CHUNK_ROWS,
+    FIXTURE,
+    SpendAnalytics,
+    Vocabulary,
+    cardholders,
+    parse_timestamps,
+    read_chunks,
+)
+
+FORMAT_VERSION = 1
+META = "meta.json"
+
+# Column -> dtype in the cache
+NUMBERS = {"period": "<i4", "agency_number": "<i4", "amount": "<f8"}
+DATES = ("transaction_date", "posted_date")
+STRINGS = (
+    "last_name",
+    "first_initial",
+    "description",
+    "vendor",
+    "merchant_category",
+    "cardholder",
+)
+COLUMNS = dict(NUMBERS, **dict((name, "<i8") for name in DATES))
+COLUMNS.update((name, "<i4") for name in STRINGS)
+
+
+class StaleCache(Exception):
+    """The cache is missing or older than its source, and may not be rebuilt."""
+
+
+def cache_directory(source):
+    """Default cache of a source file: ccspend.csv -> ccspend.cache/"""
+    return os.path.splitext(source)[0] + ".cache"
+
+
+def _fingerprint(source):
+    stat = os.stat(source)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def convert(columns, vocabularies):
+    """The columns of a read_chunks chunk as arrays of the cache's dtypes,
+    strings encoded with vocabularies (one per STRINGS column)."""
+    source = dict(zip(COLUMN_NAMES, columns))
+    source["cardholder"] = cardholders(source["last_name"], source["first_initial"])
+    arrays = {}
+    for name, dtype in NUMBERS.items():
+        arrays[name] = np.array(source[name], dtype=dtype)
+    for name in DATES:
+        arrays[name] = parse_timestamps(source[name]).astype(np.int64)
+    for name in STRINGS:
+        arrays[name] = vocabularies[name].encode(source[name]).astype(np.int32)
+    return arrays
+
+
+def _write_json(path, data):
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "w") as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+def build(source, directory=None, chunk_rows=CHUNK_ROWS):
+    """Parse source into a cache, returns its metadata."""
+    directory = directory or cache_directory(source)
+    # Taken before reading: a source changed meanwhile is seen as stale
+    fingerprint = _fingerprint(source)
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, META)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    suffix = ".{}.tmp".format(os.getpid())
+    raw = dict((name, os.path.join(directory, name + suffix)) for name in COLUMNS)
+    files = dict((name, open(path, "wb")) for name, path in raw.items())
+    vocabularies = dict((name, Vocabulary()) for name in STRINGS)
+    rows = 0
+    try:
+        # Column data goes to raw files chunk by chunk, the row count (and
+        # so the .npy header) is only known at the end
+        for columns in read_chunks(source, chunk_rows):
+            for name, array in convert(columns, vocabularies).items():
+                array.tofile(files[name])
+            rows += len(columns[0])
+        for f in files.values():
+            f.close()
+        for name, dtype in COLUMNS.items():
+            npy = os.path.join(directory, name + ".npy")
+            with open(npy + suffix, "wb") as f:
+                header = {"descr": dtype, "fortran_order": False, "shape": (rows,)}
+                np.lib.format.write_array_header_1_0(f, header)
+                with open(raw[name], "rb") as data:
+                    shutil.copyfileobj(data, f, 1 << 20)
+            # A process mapping the old file keeps it until it closes it
+            os.replace(npy + suffix, npy)
+        for name, vocabulary in vocabularies.items():
+            _write_json(
+                os.path.join(directory, name + ".dict.json"), vocabulary.names()
+            )
+        meta = dict(
+            fingerprint,
+            version=FORMAT_VERSION,
+            source=os.path.abspath(source),
+            rows=rows,
+            columns=COLUMNS,
+        )
+        _write_json(meta_path, meta)
+        return meta
+    finally:
+        for name, f in files.items():
+            f.close()
+            for path in (raw[name], os.path.join(directory, name + ".npy" + suffix)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def read_meta(directory):
+    try:
+        with open(os.path.join(directory, META)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def is_fresh(meta, source):
+    return (
+        meta is not None
+        and meta.get("version") == FORMAT_VERSION
+        and meta.get("columns") == COLUMNS
+        and dict((k, meta.get(k)) for k in ("size", "mtime_ns")) == _fingerprint(source)
+    )
+
+
+class SpendTable:
+    """The memory-mapped columns of a cache."""
+
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.meta = meta
+        self.columns = {}
+        for name in meta["columns"]:
+            path = os.path.join(directory, name + ".npy")
+            # An empty file cannot be mapped
+            self.columns[name] = np.load(path, mmap_mode="r" if meta["rows"] else None)
+        self._dictionaries = {}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def dictionary(self, name):
+        """The strings of a dictionary-encoded column, by code."""
+        if name not in self._dictionaries:
+            with open(os.path.join(self.directory, name + ".dict.json")) as f:
+                self._dictionaries[name] = json.load(f)
+        return self._dictionaries[name]
+
+    def decode(self, name, codes):
+        dictionary = self.dictionary(name)
+        return [dictionary[code] for code in codes]
+
+    def timestamps(self, name):
+        """A date column as datetime64[s], without a copy."""
+        return self.columns[name].view("datetime64[s]")
+
+
+def open_cache(source, directory=None, rebuild=True, chunk_rows=CHUNK_ROWS):
+    """The SpendTable of source, built first when missing or stale. With
+    rebuild=False a missing or stale cache raises StaleCache instead."""
+    directory = directory or cache_directory(source)
+    meta = read_meta(directory)
+    if not is_fresh(meta, source):
+        if not rebuild:
+            raise StaleCache(
+                "No up to date cache of {} in {}".format(source, directory)
+            )
+        meta = build(source, directory, chunk_rows)
+    return SpendTable(directory, meta)
+
+
+def analyze(table, analytics=None, chunk_rows=CHUNK_ROWS):
+    """Fold a SpendTable into a SpendAnalytics, chunk_rows rows at a time."""
+    if analytics is None:
+        analytics = SpendAnalytics()
+    # Cache codes -> analytics codes, one lookup array per dictionary
+    mappings = {}
+    for name, dimension in analytics.dimensions.items():
+        if name in STRINGS:
+            mappings[name] = dimension.vocabulary.encode(table.dictionary(name))
+    transactions = table.timestamps("transaction_date")
+    posted = table.timestamps("posted_date")
+    for start in range(0, len(table), chunk_rows):
+        started = time.perf_counter()
+        chunk = slice(start, start + chunk_rows)
+        codes = {}
+        for name, dimension in analytics.dimensions.items():
+            column = table.columns[name][chunk]
+            if name in mappings:
+                codes[name] = mappings[name][column]
+            else:
+                # Numbers (period) are grouped by their text, as from the CSV
+                values, inverse = np.unique(column, return_inverse=True)
+                encoded = dimension.vocabulary.encode([str(v) for v in values])
+                codes[name] = encoded[inverse]
+        amounts = np.asarray(table.columns["amount"][chunk])
+        analytics.timings["convert"] += time.perf_counter() - started
+        analytics.add_columns(
+            amounts, np.asarray(transactions[chunk]), np.asarray(posted[chunk]), codes
+        )
+    return analytics
+
+
+def memory_mb():
+    """Peak, private (anonymous) and file-backed resident memory, from
+    /proc/self/status; None where there is no such file.
+
+    The peak is VmHWM, which starts over with exec(): ru_maxrss is carried
+    over from the parent, a child of bench would report the peak of bench.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except IOError:
+        return None, None, None
+    return tuple(
+        int(fields[name].split()[0]) / 1024.0 if name in fields else None
+        for name in ("VmHWM", "RssAnon", "RssFile")
+    )
+
+
+def _load_csv(path, chunk_rows):
+    vocabularies = dict((name, Vocabulary()) for name in STRINGS)
+    chunks = [convert(c, vocabularies) for c in read_chunks(path, chunk_rows)]
+    return dict(
+        (name, np.concatenate([chunk[name] for chunk in chunks])) for name in COLUMNS
+    )
+
+
+def _load_cache(path, chunk_rows):
+    table = open_cache(path, rebuild=False)
+    # Touch every page, the mapping alone reads nothing
+    for column in table.columns.values():
+        column.sum()
+    return table
+
+
+# What bench measures, each in a fresh interpreter
+MEASURES = {
+    "csv-load": _load_csv,
+    "cache-load": _load_cache,
+    "csv-analyze": lambda path, chunk_rows: SpendAnalytics().process(path, chunk_rows),
+    "cache-analyze": lambda path, chunk_rows: analyze(
+        open_cache(path, rebuild=False), chunk_rows=chunk_rows
+    ),
+}
+
+
+def measure(args):
+    started = time.perf_counter()
+    result = MEASURES[args.what](args.csv, args.chunk_rows)
+    elapsed = time.perf_counter() - started
+    # Measured while the result is still referenced
+    peak, anonymous, mapped = memory_mb()
+    print(
+        json.dumps(
+            dict(
+                seconds=elapsed,
+                max_rss=spend_analytics.max_rss_mb() if peak is None else peak,
+                anonymous=anonymous,
+                mapped=mapped,
+            )
+        )
+    )
+    del result
+
+
+def bench(args):
+    directory = tempfile.mkdtemp(prefix="spend-cache-")
+    try:
+        # --repeat copies of the file, like an extract of that many rows
+        path = os.path.join(directory, "ccspend.csv")
+        with open(path, "wb") as f:
+            for _ in range(args.repeat):
+                with open(args.csv, "rb") as fixture:
+                    shutil.copyfileobj(fixture, f)
+        started = time.perf_counter()
+        meta = build(path, chunk_rows=args.chunk_rows)
+        elapsed = time.perf_counter() - started
+        cache = cache_directory(path)
+        size = sum(os.path.getsize(os.path.join(cache, n)) for n in os.listdir(cache))
+        print(
+            "{} rows, CSV {:.0f} MB, cache {:.0f} MB built in {:.2f}s".format(
+                meta["rows"], os.path.getsize(path) / 1e6, size / 1e6, elapsed
+            )
+        )
+        for what in args.measure or sorted(MEASURES):
+            output = subprocess.check_output(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "measure",
+                    what,
+                    path,
+                    "--chunk-rows",
+                    str(args.chunk_rows),
+                ]
+            )
+            result = json.loads(output.decode().splitlines()[-1])
+            print(
+                " {:14} {:7.2f}s  max RSS {:6.0f} MB  private {:>6} MB"
+                "  mapped {:>6} MB".format(
+                    what,
+                    result["seconds"],
+                    result["max_rss"],
+                    "{:.0f}".format(result["anonymous"] or 0),
+                    "{:.0f}".format(result["mapped"] or 0),
+                )
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+def build_command(args):
+    started = time.perf_counter()
+    meta = build(args.csv, args.cache, args.chunk_rows)
+    print(
+        "{} rows of {} cached in {} in {:.2f}s".format(
+            meta["rows"],
+            args.csv,
+            args.cache or cache_directory(args.csv),
+            time.perf_counter() - started,
+        )
+    )
+
+
+def report(args):
+    analytics = analyze(open_cache(args.csv, args.cache), chunk_rows=args.chunk_rows)
+    for key, value in analytics.summary().items():
+        print("{}: {}".format(key, value))
+    for dimension in args.dimension or spend_analytics.DIMENSIONS:
+        spend_analytics.print_top(
+            analytics, dimension, args.top, args.sort, args.percentile or (50, 90, 99)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar cache of card spend CSV")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    for name, run in (
+        ("build", build_command),
+        ("report", report),
+        ("bench", bench),
+        ("measure", measure),
+    ):
+        command = commands.add_parser(name)
+        command.set_defaults(run=run)
+        if name == "measure":
+            command.add_argument("what", choices=sorted(MEASURES))
+        command.add_argument("csv", nargs="?", default=FIXTURE)
+        command.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+        if name in ("build", "report"):
+            command.add_argument("--cache", help="directory, default <csv>.cache")
+    report_parser = commands.choices["report"]
+    report_parser.add_argument(
+        "--dimension", choices=spend_analytics.DIMENSIONS, action="append"
+    )
+    report_parser.add_argument("--top", type=int, default=10)
+    report_parser.add_argument(
+        "--sort", default="total", help="count, total, mean or pNN, e.g. p90"
+    )
+    report_parser.add_argument("--percentile", type=float, action="append")
+    bench_parser = commands.choices["bench"]
+    bench_parser.add_argument(
+        "--repeat", type=int, default=100, help="copies of the file to process"
+    )
+    bench_parser.add_argument("--measure", choices=sorted(MEASURES), action="append")
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,38 @@ Returns:
     string: Static response message
 """
 
+import time
+
+_init_started = time.perf_counter()
+
+import json
+
+_import_ms = (time.perf_counter() - _init_started) * 1000
+_init_finished = time.perf_counter()
+_cold_start = True
+
+
+def log_cold_start(context, invoked_at):
+    """Emit one structured line with the init breakdown per environment."""
+    print(
+        json.dumps(
+            {
+                "metric": "cold_start",
+                "function": getattr(context, "function_name", None),
+                "import_ms": round(_import_ms, 1),
+                "init_ms": round((_init_finished - _init_started) * 1000, 1),
+                "init_to_invoke_ms": round((invoked_at - _init_finished) * 1000, 1),
+                "first_invocation_ms": round(
+                    (time.perf_counter() - invoked_at) * 1000, 1
+                ),
+            }
+        )
+    )
+
 
 def lambda_handler(event, context):
+    global _cold_start
+    started = time.perf_counter()
     response = {
         "statusCode": 200,
         "statusDescription": "200 OK",
@@ -36,4 +66,7 @@ def lambda_handler(event, context):
     </html>
     """
 
+    if _cold_start:
+        _cold_start = False
+        log_cold_start(context, started)
     return response
@@ -3,45 +3,65 @@
 #This script will operate on AWS DynamoDB to showcase alternate fetch criteria using index
 #*********************************************************************************************************************
 
-import boto3
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
-
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1', endpoint_url='http://localhost:8000')
+import ddb_dal
+from ddb_counter import CountedTable
+from ddb_iter import query_items
+from ddb_metrics import install
+from ddb_shard import query_shards, shard_of, sharded_value
+
+# Always DynamoDB local, whatever DDB_ENDPOINT_URL says
+ddb_dal.configure(endpoint_url='http://localhost:8000')
+# Capacity, latency and throttles of every call made through it
+metrics = install(ddb_dal.resource())
+
+# Keeps the number of orders in a counter item, updated in the same transaction as each insert
+orders = CountedTable(ddb_dal.table('orders'))
+
+CITY_IDX_ATTRIBUTES = ['user_id', 'order_id', 'city', 'price', 'tax']
+# Opt-in write sharding of the city index: with CITY_SHARDS > 1 every order also
+# gets city_shard = '<city>#<n>' and is indexed by city_shard_idx instead of
+# city_idx, spreading a busy city over CITY_SHARDS index partitions. Use
+# 'python3 ddb_shard.py orders city' to pick a value; the table has to be
+# recreated when it changes.
+CITY_SHARDS = 0
+
+
+
+def city_index():
+    if CITY_SHARDS > 1:
+        return { 'IndexName': 'city_shard_idx',
+                 'KeySchema': [
+                       { 'AttributeName': 'city_shard', 'KeyType': 'HASH' }
+                 ],
+                 'Projection': {
+                       'ProjectionType': 'INCLUDE',
+                       'NonKeyAttributes': ['city', 'price', 'tax']
+                 },
+                 'ProvisionedThroughput': { 'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1 }
+               }
+    #This is a very poor choice of index due to very low cardinality
+    return { 'IndexName': 'city_idx',
+             'KeySchema': [
+                   { 'AttributeName': 'city', 'KeyType': 'HASH' }
+             ],
+             'Projection': {
+                   #In addition to the base table primary key
+                   'ProjectionType': 'INCLUDE',
+                   'NonKeyAttributes': ['price', 'tax']
+             },
+             'ProvisionedThroughput': { 'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1 }
+           }
 
 
 def create_table():
     print ('\n*************************************************************************')
     print ('Creating table orders')
     try:
-        table = dynamodb.create_table(
-            TableName='orders',
-            KeySchema=[
-                { 'AttributeName': 'user_id', 'KeyType': 'HASH' },
-                { 'AttributeName': 'order_id', 'KeyType': 'RANGE' }
-            ],
-            AttributeDefinitions=[
-                { 'AttributeName': 'user_id', 'AttributeType': 'S' },
-                { 'AttributeName': 'order_id', 'AttributeType': 'S' },
-                { 'AttributeName': 'city', 'AttributeType': 'S' }
-            ],
-            GlobalSecondaryIndexes=[
-                #This is a very poor choice of index due to very low cardinality
-                { 'IndexName': 'city_idx',
-                  'KeySchema': [
-                        { 'AttributeName': 'city', 'KeyType': 'HASH' }
-                  ],
-                  'Projection': {
-                        #In addition to the base table primary key
-                        'ProjectionType': 'INCLUDE',
-                        'NonKeyAttributes': ['price', 'tax']
-                  },
-                  'ProvisionedThroughput': { 'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1 }
-                }
-            ],
-            ProvisionedThroughput={ 'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1 }
-        )
-        table.meta.client.get_waiter('table_exists').wait(TableName='orders')
+        index = city_index()
+        index_key = index['KeySchema'][0]['AttributeName']
+        ddb_dal.create_orders([index], { index_key: 'S' })
         print (' DONE')
 
     except ClientError as e:
@@ -55,58 +75,53 @@ def insert_data(user_id, order_id, address, city, order_details, price, tax=None
     print ('\n*************************************************************************')
     print ('Inserting data in the table')
     # A map which contains all the KV that represents the data to be inserted
-    order_data = {
-        'user_id': user_id,
-        'order_id': order_id,
-        'address': address,
-        'city': city,
-        'order_details': order_details,
-        'price': price
-    }
-    if tax:
-        order_data['tax'] = tax
-
-    table = dynamodb.Table('orders')
+    order_data = ddb_dal.order_item(user_id, order_id, address, city, order_details, price, tax)
+    if CITY_SHARDS > 1:
+        # Stable across processes, so the order always lands on the same shard
+        shard = shard_of((user_id, order_id), CITY_SHARDS)
+        order_data['city_shard'] = sharded_value(city, shard)
+
     try:
-        ret_val = table.put_item(
-            Item=order_data,
-            #Let us force a read before write - exercise caution wrt performance
-            ConditionExpression='attribute_not_exists(user_id) AND attribute_not_exists(order_id)',
-            ReturnConsumedCapacity='TOTAL',
-            ReturnValues='ALL_OLD'
-        )
+        ret_val = ddb_dal.insert_order(order_data, orders)
         print (ret_val)
     except ClientError as e:
         print (' Skipped due to exception ', e.response['Error']['Code'])
         print (' Reason ', e.response['Error']['Message'])
 
-    print ('Total items in the table are ', table.item_count)
+    # A GetItem on the counter, rather than DescribeTable and a count up to 6 hours old
+    print ('Total items in the table are ', orders.item_count)
 
 
 
-def fetch_all():
+def fetch_all(segments=1):
     print ('\n*************************************************************************')
     print ('Getting all data from the table (not suited for production envs)')
-    table = dynamodb.Table('orders')
-    response = table.scan()
-    print ('Total items in the table are ', response['Count'])
-    for item in response['Items']:
+    # Follows LastEvaluatedKey page by page, segments > 1 scans in parallel
+    count = 0
+    for item in ddb_dal.fetch_all('orders', segments):
         print (item)
+        count += 1
+    print ('Total items in the table are ', count)
 
 
 
-def fetch_by_index(city):
+def fetch_by_index(city, limit=None):
     print ('\n*************************************************************************')
     print ('Getting data from the table based on the index')
-    table = dynamodb.Table('orders')
-    response = table.query(
-        IndexName='city_idx',
-        Select='ALL_PROJECTED_ATTRIBUTES',
-        KeyConditionExpression=Key('city').eq(city)
-    )
-    print (' Total items for this index value is ', response['Count'])
-    for item in response['Items']:
+    table = ddb_dal.table('orders')
+    if CITY_SHARDS > 1:
+        # Scatter-gather: every shard of the city is queried in parallel
+        items = query_shards(table, 'city_shard_idx', 'city_shard', city, CITY_SHARDS,
+                             projection=CITY_IDX_ATTRIBUTES, limit=limit)
+    else:
+        # Ask only for what city_idx projects (table keys, index key, price and tax)
+        items = query_items(table, Key('city').eq(city), index='city_idx',
+                            projection=CITY_IDX_ATTRIBUTES, limit=limit)
+    count = 0
+    for item in items:
         print (item)
+        count += 1
+    print (' Total items for this index value is ', count)
 
 
 
@@ -123,5 +138,7 @@ def main():
     fetch_by_index('Bangalore')
     fetch_by_index('HighlandPark')
 
+    print ('\nDynamoDB metrics\n' + metrics.summary())
+
 
 main()
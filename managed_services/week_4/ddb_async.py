@@ -0,0 +1,436 @@
+# *********************************************************************************************************************
+# asyncio engine for the week_4 tables, on top of aiobotocore
+# Thousands of gets/puts can be in flight from a single thread: every call awaits on the shared aiohttp connection
+# pool, and a semaphore bounds how many requests are outstanding at any time. Cancelling the calling task cancels
+# the requests in flight; run_all() cancels the remaining work as soon as one call fails.
+# aiobotocore only has the low level client, so items are (de)serialized here with boto3's TypeSerializer.
+#
+#   async with AsyncDynamoDB(concurrency=64) as db:
+#       await db.put_item("orders", {...})
+#       async for item in db.query("orders", Key("user_id").eq("scotty")):
+#           ...
+#
+#   python3 ddb_async.py bench --items 2000 --concurrency 64 --threads 16
+# *********************************************************************************************************************
+
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import ddb_dal
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+from ddb_batch import (
+    BATCH_SIZE,
+    GET_BATCH_SIZE,
+    MAX_ATTEMPTS,
+    MISSING,
+    THROTTLE_ERRORS,
+    batches,
+)
+from ddb_iter import projection_args
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def serialize(item):
+    return dict((k, _serializer.serialize(v)) for k, v in item.items())
+
+
+def deserialize(item):
+    return dict((k, _deserializer.deserialize(v)) for k, v in item.items())
+
+
+def _expressions(params):
+    """Turn boto3 condition objects into expression strings, in place."""
+    builder = ConditionExpressionBuilder()
+    names = dict(params.get("ExpressionAttributeNames", {}))
+    values = dict(params.get("ExpressionAttributeValues", {}))
+    for field in ("KeyConditionExpression", "ConditionExpression", "FilterExpression"):
+        if isinstance(params.get(field), ConditionBase):
+            built = builder.build_expression(
+                params[field], is_key_condition=field == "KeyConditionExpression"
+            )
+            params[field] = built.condition_expression
+            names.update(built.attribute_name_placeholders)
+            values.update(built.attribute_value_placeholders)
+    if names:
+        params["ExpressionAttributeNames"] = names
+    if values:
+        params["ExpressionAttributeValues"] = serialize(values)
+    return params
+
+
+async def backoff(attempt, base=0.05, cap=5.0):
+    await asyncio.sleep(random.uniform(0, min(cap, base * 2**attempt)))
+
+
+async def run_all(coroutines, timeout=None):
+    """Run coroutines concurrently, returns their results in order.
+
+    On the first failure (or the timeout) the others are cancelled and the
+    error is raised, unlike asyncio.gather which leaves them running.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coroutines]
+    if not tasks:
+        return []
+    try:
+        done, pending = await asyncio.wait(
+            tasks, timeout=timeout, return_when=asyncio.FIRST_EXCEPTION
+        )
+        for t in done:
+            if not t.cancelled() and t.exception() is not None:
+                raise t.exception()
+        if pending:
+            raise asyncio.TimeoutError()
+        return [t.result() for t in tasks]
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class AsyncDynamoDB:
+    def __init__(self, concurrency=64, **overrides):
+        """overrides take the ddb_dal settings (endpoint_url, region...)."""
+        self.concurrency = concurrency
+        self.settings = ddb_dal.settings()
+        self.settings.update((k, v) for k, v in overrides.items() if v is not None)
+        self._semaphore = None
+        self._context = None
+        self.client = None
+
+    async def __aenter__(self):
+        s = self.settings
+        config = AioConfig(
+            max_pool_connections=self.concurrency,
+            connect_timeout=s["connect_timeout"],
+            read_timeout=s["read_timeout"],
+            retries={"total_max_attempts": s["max_attempts"], "mode": s["retry_mode"]},
+        )
+        self._context = get_session().create_client(
+            "dynamodb",
+            region_name=s["region"],
+            endpoint_url=s["endpoint_url"] or None,
+            config=config,
+        )
+        self.client = await self._context.__aenter__()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._context.__aexit__(*exc_info)
+        self.client = None
+
+    async def call(self, operation, **params):
+        """One request; waits while `concurrency` requests are in flight."""
+        async with self._semaphore:
+            return await getattr(self.client, operation)(**params)
+
+    # Single items
+
+    async def put_item(self, table, item, **kwargs):
+        params = _expressions(dict(kwargs, TableName=table, Item=serialize(item)))
+        return await self.call("put_item", **params)
+
+    async def insert(self, table, item, key_names):
+        """Put an item unless one with the same key exists, True if it was put."""
+        condition = " AND ".join(
+            "attribute_not_exists(#k{})".format(i) for i in range(len(key_names))
+        )
+        names = dict(("#k{}".format(i), k) for i, k in enumerate(key_names))
+        try:
+            await self.put_item(
+                table,
+                item,
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
+
+    async def get_item(self, table, key, projection=None, consistent=False):
+        """The item, or None when it does not exist."""
+        params = {"TableName": table, "Key": serialize(key)}
+        params["ConsistentRead"] = consistent
+        if projection:
+            params.update(projection_args(projection))
+        response = await self.call("get_item", **params)
+        return deserialize(response["Item"]) if "Item" in response else None
+
+    async def delete_item(self, table, key, **kwargs):
+        params = _expressions(dict(kwargs, TableName=table, Key=serialize(key)))
+        return await self.call("delete_item", **params)
+
+    # Paginated reads, as async iterators
+
+    async def _pages(self, operation, params, limit=None):
+        remaining = limit
+        while True:
+            if remaining is not None:
+                params["Limit"] = min(params.get("Limit", remaining), remaining)
+            page = await self.call(operation, **params)
+            for item in page["Items"]:
+                yield deserialize(item)
+                if remaining is not None:
+                    remaining -= 1
+                    if remaining == 0:
+                        return
+            if "LastEvaluatedKey" not in page:
+                return
+            params["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    async def query(
+        self,
+        table,
+        key_condition,
+        index=None,
+        projection=None,
+        limit=None,
+        page_size=None,
+        **kwargs
+    ):
+        """Async iterator over the items matching key_condition (see query_items)."""
+        params = dict(kwargs, TableName=table, KeyConditionExpression=key_condition)
+        if projection:
+            extra = projection_args(projection)
+            params["ProjectionExpression"] = extra["ProjectionExpression"]
+            params["ExpressionAttributeNames"] = dict(
+                params.get("ExpressionAttributeNames", {}),
+                **extra["ExpressionAttributeNames"]
+            )
+        if index:
+            params["IndexName"] = index
+        if page_size:
+            params["Limit"] = page_size
+        async for item in self._pages("query", _expressions(params), limit):
+            yield item
+
+    async def scan(self, table, segments=1, projection=None, page_size=None, **kwargs):
+        """Async iterator over every item, segments > 1 scans in parallel."""
+        params = dict(kwargs, TableName=table)
+        if projection:
+            params.update(projection_args(projection))
+        if page_size:
+            params["Limit"] = page_size
+        params = _expressions(params)
+        if segments <= 1:
+            async for item in self._pages("scan", params):
+                yield item
+            return
+
+        # At most two pages per segment are buffered
+        items = asyncio.Queue(maxsize=segments * 2)
+        done = object()
+
+        async def read_segment(segment):
+            segment_params = dict(params, Segment=segment, TotalSegments=segments)
+            async for item in self._pages("scan", segment_params):
+                await items.put(item)
+            await items.put(done)
+
+        readers = [asyncio.ensure_future(read_segment(s)) for s in range(segments)]
+        try:
+            remaining = segments
+            while remaining:
+                getter = asyncio.ensure_future(items.get())
+                # Wake up for a failed reader as well as for the next item
+                await asyncio.wait(
+                    [getter] + [r for r in readers if not r.done()],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for reader in readers:
+                    if reader.done() and reader.exception():
+                        getter.cancel()
+                        raise reader.exception()
+                item = await getter
+                if item is done:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+
+    # Batches
+
+    async def write_batch(self, table, items):
+        """Write up to 25 items, retrying whatever DynamoDB leaves unprocessed."""
+        requests = [{"PutRequest": {"Item": serialize(item)}} for item in items]
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = await self.call(
+                    "batch_write_item", RequestItems={table: requests}
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in THROTTLE_ERRORS:
+                    raise
+            else:
+                requests = response.get("UnprocessedItems", {}).get(table)
+                if not requests:
+                    return
+            await backoff(attempt)
+        raise RuntimeError(
+            "{} items unprocessed after {} attempts".format(len(requests), MAX_ATTEMPTS)
+        )
+
+    async def batch_write(self, table, items, key_names):
+        """Write any number of items, 25 per request, returns the item count."""
+        chunks = list(batches(items, key_names, BATCH_SIZE))
+        await run_all(self.write_batch(table, chunk) for chunk in chunks)
+        return sum(len(chunk) for chunk in chunks)
+
+    async def _get_batch(self, table, keys, projection, consistent):
+        key_names = sorted(keys[0])
+        request = {"Keys": [serialize(k) for k in keys], "ConsistentRead": consistent}
+        if projection:
+            request.update(projection_args(key_names + list(projection)))
+        found = {}
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = await self.call(
+                    "batch_get_item", RequestItems={table: request}
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in THROTTLE_ERRORS:
+                    raise
+            else:
+                for item in response["Responses"].get(table, []):
+                    item = deserialize(item)
+                    found[tuple(item[k] for k in key_names)] = item
+                request = response.get("UnprocessedKeys", {}).get(table)
+                if not request:
+                    return found
+            await backoff(attempt)
+        raise RuntimeError(
+            "{} keys unprocessed after {} attempts".format(
+                len(request["Keys"]), MAX_ATTEMPTS
+            )
+        )
+
+    async def batch_get(self, table, keys, projection=None, consistent=False):
+        """Look up any number of keys, items in the order of keys (or MISSING)."""
+        if not keys:
+            return []
+        key_names = sorted(keys[0])
+        wanted = [tuple(k[n] for n in key_names) for k in keys]
+        unique = list(dict.fromkeys(wanted))
+        chunks = [
+            [dict(zip(key_names, k)) for k in unique[i : i + GET_BATCH_SIZE]]
+            for i in range(0, len(unique), GET_BATCH_SIZE)
+        ]
+        found = {}
+        for part in await run_all(
+            self._get_batch(table, chunk, projection, consistent) for chunk in chunks
+        ):
+            found.update(part)
+        return [found.get(k, MISSING) for k in wanted]
+
+
+# Benchmark against the thread based path
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+def report(name, latencies, elapsed):
+    print(
+        " {:24} {:9.0f} ops/s  p50 {:7.1f} ms  p99 {:7.1f} ms".format(
+            name,
+            len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+        )
+    )
+
+
+async def bench_async(table, items, concurrency):
+    async with AsyncDynamoDB(concurrency=concurrency) as db:
+        for name, make in (
+            ("put_item", lambda item: db.put_item(table, item)),
+            ("get_item", lambda item: db.get_item(table, {"pk": item["pk"]})),
+        ):
+            # concurrency workers share the items, like the threads of a pool
+            # do, so that the latencies do not include the time spent queued
+            pending = iter(items)
+            latencies = []
+
+            async def worker():
+                for item in pending:
+                    started = time.perf_counter()
+                    await make(item)
+                    latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            await run_all(worker() for _ in range(concurrency))
+            report("asyncio " + name, latencies, time.perf_counter() - started)
+
+
+def bench_threads(table, items, threads):
+    # Each thread looks up its own Table handle, they are not thread safe
+    for name, call in (
+        ("put_item", lambda item: ddb_dal.table(table).put_item(Item=item)),
+        (
+            "get_item",
+            lambda item: ddb_dal.table(table).get_item(Key={"pk": item["pk"]}),
+        ),
+    ):
+
+        def timed(item):
+            started = time.perf_counter()
+            call(item)
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            latencies = list(pool.map(timed, items))
+        report("threads " + name, latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio DynamoDB engine")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("bench", help="compare asyncio with threads")
+    bench.add_argument("--table", default="async_bench")
+    bench.add_argument("--items", type=int, default=2000)
+    bench.add_argument("--concurrency", type=int, default=64)
+    bench.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    ddb_dal.configure(max_pool_connections=max(args.threads, args.concurrency))
+    try:
+        ddb_dal.create_table(
+            args.table, [("pk", "HASH")], {"pk": "S"}, read=10000, write=10000
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceInUseException":
+            raise
+    items = [
+        {"pk": "item{:07d}".format(i), "price": Decimal(i), "pad": "x" * 200}
+        for i in range(args.items)
+    ]
+    print(
+        "{} items, {} coroutines vs {} threads".format(
+            args.items, args.concurrency, args.threads
+        )
+    )
+    bench_threads(args.table, items, args.threads)
+    asyncio.run(bench_async(args.table, items, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
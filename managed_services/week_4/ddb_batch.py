@@ -0,0 +1,308 @@
+# *********************************************************************************************************************
+# Batch operations for the orders/inventory tables
+# Bulk loading: rows are streamed from a CSV or JSONL file, grouped into batches of 25 items (the BatchWriteItem
+# limit) and written by a pool of workers.
+# Multi-key lookups: any number of keys is split into BatchGetItem requests of 100 keys, fetched concurrently.
+# Unprocessed items/keys are retried with jittered exponential backoff.
+#
+#   python3 ddb_batch.py load orders orders.jsonl --workers 8
+#   python3 ddb_batch.py load inventory inventory.csv --numeric price,items
+#   python3 ddb_batch.py get-bench inventory --keys 500
+# *********************************************************************************************************************
+
+import argparse
+import csv
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import ddb_dal
+from botocore.exceptions import ClientError
+from ddb_governor import install as install_governor
+from ddb_iter import projection_args, scan_items
+from ddb_metrics import THROTTLE_ERRORS, install
+
+# BatchWriteItem accepts at most 25 put/delete requests, BatchGetItem 100 keys
+BATCH_SIZE = 25
+GET_BATCH_SIZE = 100
+MAX_ATTEMPTS = 10
+
+
+def backoff(attempt, base=0.05, cap=5.0):
+    # "Full jitter" keeps retrying workers from synchronizing on the table
+    time.sleep(random.uniform(0, min(cap, base * 2**attempt)))
+
+
+def read_rows(path, numeric=()):
+    """Stream rows out of a .jsonl or .csv file as dicts."""
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl") or path.endswith(".json"):
+            for line in f:
+                if line.strip():
+                    # DynamoDB has no float type, numbers have to be Decimals
+                    yield json.loads(line, parse_float=Decimal)
+        else:
+            for row in csv.DictReader(f):
+                # DynamoDB does not accept empty strings for key attributes
+                item = dict((k, v) for k, v in row.items() if v != "")
+                for column in numeric:
+                    if column in item:
+                        item[column] = Decimal(item[column])
+                yield item
+
+
+def batches(items, key_names, size=BATCH_SIZE):
+    """Group items in batches, a batch may not contain the same key twice."""
+    batch = {}
+    for item in items:
+        # The last row for a key wins, like with consecutive put_item calls
+        batch[tuple(item[k] for k in key_names)] = item
+        if len(batch) == size:
+            yield list(batch.values())
+            batch = {}
+    if batch:
+        yield list(batch.values())
+
+
+def write_batch(dynamodb, table_name, items):
+    """Write up to 25 items, retrying whatever DynamoDB leaves unprocessed."""
+    requests = [{"PutRequest": {"Item": item}} for item in items]
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            # The service resource and its client take and return plain
+            # Python values
+            response = dynamodb.batch_write_item(RequestItems={table_name: requests})
+        except ClientError as e:
+            # Every item of the batch was throttled
+            if e.response["Error"]["Code"] not in THROTTLE_ERRORS:
+                raise
+        else:
+            requests = response.get("UnprocessedItems", {}).get(table_name)
+            if not requests:
+                return
+        backoff(attempt)
+    raise RuntimeError(
+        "{} items unprocessed after {} attempts".format(len(requests), MAX_ATTEMPTS)
+    )
+
+
+class _Missing:
+    def __repr__(self):
+        return "MISSING"
+
+    def __bool__(self):
+        return False
+
+
+# Stands in for the items batch_get could not find
+MISSING = _Missing()
+
+
+def _key(item, key_names):
+    return tuple(item[k] for k in key_names)
+
+
+def get_batch(dynamodb, table_name, keys, projection=None, consistent=False):
+    """Fetch up to 100 keys, retrying UnprocessedKeys. Returns {key: item}."""
+    key_names = sorted(keys[0])
+    request = {"Keys": keys, "ConsistentRead": consistent}
+    if projection:
+        # The keys are needed to match the items back to what was asked for
+        request.update(projection_args(key_names + list(projection)))
+    found = {}
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = dynamodb.batch_get_item(RequestItems={table_name: request})
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in THROTTLE_ERRORS:
+                raise
+        else:
+            for item in response["Responses"].get(table_name, []):
+                found[_key(item, key_names)] = item
+            request = response.get("UnprocessedKeys", {}).get(table_name)
+            if not request:
+                return found
+        backoff(attempt)
+    raise RuntimeError(
+        "{} keys unprocessed after {} attempts".format(
+            len(request["Keys"]), MAX_ATTEMPTS
+        )
+    )
+
+
+def batch_get(dynamodb, table_name, keys, projection=None, consistent=False, workers=4):
+    """Look up any number of keys, returns the items in the order of keys.
+
+    keys are dicts holding the full primary key, e.g.
+    {"category": "tv", "sku": "sku00001"}. Keys that do not exist come back
+    as MISSING.
+    """
+    if not keys:
+        return []
+    key_names = sorted(keys[0])
+    wanted = [_key(k, key_names) for k in keys]
+    # BatchGetItem rejects a request that names the same key twice
+    unique = list(dict.fromkeys(wanted))
+    chunks = [
+        [dict(zip(key_names, k)) for k in unique[i : i + GET_BATCH_SIZE]]
+        for i in range(0, len(unique), GET_BATCH_SIZE)
+    ]
+
+    # Resources are not thread safe, their clients are
+    client = getattr(dynamodb.meta, "client", dynamodb)
+
+    def fetch(chunk):
+        return get_batch(client, table_name, chunk, projection, consistent)
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as pool:
+        for part in pool.map(fetch, chunks):
+            found.update(part)
+    return [found.get(k, MISSING) for k in wanted]
+
+
+class Progress:
+    def __init__(self, every=5.0):
+        self.every = every
+        self.rows = 0
+        self.started = self.reported = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, rows):
+        with self._lock:
+            self.rows += rows
+            now = time.monotonic()
+            if now - self.reported >= self.every:
+                self.reported = now
+                print(" {} rows, {:.0f} rows/sec".format(self.rows, self.rate()))
+
+    def rate(self):
+        return self.rows / max(time.monotonic() - self.started, 1e-9)
+
+
+def load(dynamodb, table_name, rows, key_names, workers=4):
+    """Write rows to the table with a pool of workers, returns the row count."""
+    progress = Progress()
+    # Bound the batches in flight so memory does not grow with the file size
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    errors = []
+    # Resources are not thread safe, their clients are
+    client = getattr(dynamodb.meta, "client", dynamodb)
+
+    def write(batch):
+        try:
+            write_batch(client, table_name, batch)
+            progress.add(len(batch))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in batches(rows, key_names):
+            # Stop reading the file as soon as a batch failed for good
+            if errors:
+                break
+            in_flight.acquire()
+            pool.submit(write, batch)
+    if errors:
+        raise errors[0]
+    elapsed = time.monotonic() - progress.started
+    print(
+        "Loaded {} rows into {} in {:.1f}s ({:.0f} rows/sec)".format(
+            progress.rows, table_name, elapsed, progress.rate()
+        )
+    )
+    return progress.rows
+
+
+def get_bench(dynamodb, table_name, count, workers):
+    """Time count get_item calls against one batch_get of the same keys."""
+    table = dynamodb.Table(table_name)
+    key_names = [k["AttributeName"] for k in table.key_schema]
+    keys = []
+    for item in scan_items(table, projection=key_names):
+        keys.append(item)
+        if len(keys) == count:
+            break
+    print("Looking up {} keys of {}".format(len(keys), table_name))
+
+    started = time.perf_counter()
+    for key in keys:
+        table.get_item(Key=key)
+    serial = time.perf_counter() - started
+    print(" get_item     {:8.3f}s  {} round trips".format(serial, len(keys)))
+
+    started = time.perf_counter()
+    items = batch_get(dynamodb, table_name, keys, workers=workers)
+    batched = time.perf_counter() - started
+    requests = (len(keys) + GET_BATCH_SIZE - 1) // GET_BATCH_SIZE
+    print(" batch_get    {:8.3f}s  {} requests".format(batched, requests))
+    print(" Speedup      {:8.1f}x".format(serial / batched))
+    print(" Missing      {:8}".format(sum(1 for item in items if item is MISSING)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk DynamoDB loader")
+    parser.add_argument("--endpoint-url", help="default $DDB_ENDPOINT_URL or local")
+    parser.add_argument("--region", help="default $DDB_REGION or us-east-1")
+    parser.add_argument(
+        "--metrics", help="write call metrics here (.prom for Prometheus text)"
+    )
+    parser.add_argument(
+        "--governor",
+        action="store_true",
+        help="pace requests to the provisioned throughput of the table",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    load_cmd = commands.add_parser("load", help="load a CSV or JSONL file")
+    load_cmd.add_argument("table")
+    load_cmd.add_argument("path")
+    load_cmd.add_argument("--workers", type=int, default=4)
+    load_cmd.add_argument(
+        "--numeric", default="", help="comma separated CSV columns holding numbers"
+    )
+    bench_cmd = commands.add_parser(
+        "get-bench", help="compare get_item round trips with batch_get"
+    )
+    bench_cmd.add_argument("table")
+    bench_cmd.add_argument("--keys", type=int, default=500)
+    bench_cmd.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    # Every worker keeps its own connection to DynamoDB
+    pool_size = max(ddb_dal.settings()["max_pool_connections"], args.workers)
+    ddb_dal.configure(
+        endpoint_url=args.endpoint_url,
+        region=args.region,
+        max_pool_connections=pool_size,
+    )
+    dynamodb = ddb_dal.resource()
+    metrics = install(dynamodb)
+    governor = install_governor(dynamodb) if args.governor else None
+    if args.command == "get-bench":
+        get_bench(dynamodb, args.table, args.keys, args.workers)
+    else:
+        table = ddb_dal.table(args.table)
+        key_names = [k["AttributeName"] for k in table.key_schema]
+        numeric = [c for c in args.numeric.split(",") if c]
+        load(
+            dynamodb,
+            args.table,
+            read_rows(args.path, numeric),
+            key_names,
+            workers=args.workers,
+        )
+    print(metrics.summary())
+    if governor is not None:
+        print("Governed rates ", governor.rates())
+    if args.metrics:
+        metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
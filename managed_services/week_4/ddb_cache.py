@@ -0,0 +1,217 @@
+# *********************************************************************************************************************
+# In-process read-through cache for a DynamoDB table (a small DAX-like layer)
+# get_item and query results are kept in a bounded LRU with a per-entry TTL; keys that do not exist are cached too
+# (negative caching) with a shorter TTL. Writes made through the cache update or invalidate the affected entries, so a
+# caller never reads back stale data after its own write. Writes made by anybody else are only seen once the entry
+# expires, so pick the TTL according to how stale a read may be.
+# *********************************************************************************************************************
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from boto3.dynamodb.conditions import AttributeBase, ConditionBase, Key
+from ddb_iter import query_items
+
+# Cached in place of an item that does not exist
+_ABSENT = object()
+
+
+def _freeze(value):
+    """Hashable form of request parameters, boto3 conditions included."""
+    if isinstance(value, ConditionBase):
+        expression = value.get_expression()
+        return (expression["operator"],) + tuple(
+            _freeze(v) for v in expression["values"]
+        )
+    if isinstance(value, AttributeBase):
+        return ("attribute", value.name)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class CachedTable:
+    def __init__(
+        self, table, max_entries=1024, ttl=60.0, negative_ttl=5.0, key_names=None
+    ):
+        """key_names, if given, lists the partition key before the sort key."""
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._key_names = key_names
+        # ("item", key) -> (expires, item) and ("query", partition, params) ->
+        # (expires, items), in least recently used order
+        self._entries = OrderedDict()
+        # partition value -> cache keys of the queries that read it
+        self._queries = {}
+        self._lock = threading.Lock()
+        # Bumped by every write; a read only fills the cache if no write went
+        # through while it was talking to DynamoDB
+        self._writes = 0
+        self._stats = dict.fromkeys(
+            [
+                "hits",
+                "misses",
+                "negative_hits",
+                "evictions",
+                "expirations",
+                "invalidations",
+            ],
+            0,
+        )
+
+    def __getattr__(self, name):
+        # Everything that is not cached (item_count, scan...) goes to the table
+        return getattr(self.table, name)
+
+    @property
+    def key_names(self):
+        if self._key_names is None:
+            # Resolved on first use, the table may not exist yet at construction
+            schema = sorted(self.table.key_schema, key=lambda k: k["KeyType"])
+            self._key_names = [k["AttributeName"] for k in schema]
+        return self._key_names
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        hits = stats["hits"] + stats["negative_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_ratio"] = hits / lookups if lookups else 0.0
+        return stats
+
+    # Cache bookkeeping, callers hold the lock
+
+    def _lookup(self, cache_key):
+        entry = self._entries.get(cache_key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self._drop(cache_key)
+            self._stats["expirations"] += 1
+            return None
+        self._entries.move_to_end(cache_key)
+        return value
+
+    def _store(self, cache_key, value, ttl):
+        self._entries[cache_key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(cache_key)
+        if cache_key[0] == "query":
+            self._queries.setdefault(cache_key[1], set()).add(cache_key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def _drop(self, cache_key):
+        self._entries.pop(cache_key, None)
+        if cache_key[0] == "query":
+            queries = self._queries.get(cache_key[1])
+            if queries is not None:
+                queries.discard(cache_key)
+                if not queries:
+                    del self._queries[cache_key[1]]
+
+    def _invalidate(self, key):
+        """Forget an item and every cached query over its partition."""
+        self._drop(("item", key))
+        for cache_key in list(self._queries.get(key[0], ())):
+            self._drop(cache_key)
+        self._writes += 1
+        self._stats["invalidations"] += 1
+
+    def _key(self, item):
+        return tuple(item[k] for k in self.key_names)
+
+    # Reads
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        key = self._key(Key)
+        # Projections are not cached; a consistent read skips the cache but
+        # refreshes it
+        cacheable = not kwargs
+        with self._lock:
+            writes = self._writes
+            if cacheable and not ConsistentRead:
+                item = self._lookup(("item", key))
+                if item is _ABSENT:
+                    self._stats["negative_hits"] += 1
+                    return {}
+                if item is not None:
+                    self._stats["hits"] += 1
+                    return {"Item": copy.deepcopy(item)}
+                self._stats["misses"] += 1
+        response = self.table.get_item(
+            Key=Key, ConsistentRead=ConsistentRead, **kwargs
+        )
+        item = response.get("Item")
+        with self._lock:
+            if cacheable and self._writes == writes:
+                if item is None:
+                    self._store(("item", key), _ABSENT, self.negative_ttl)
+                else:
+                    self._store(("item", key), copy.deepcopy(item), self.ttl)
+        return response
+
+    def query(self, partition, sort_condition=None, **kwargs):
+        """All items of a partition, optionally narrowed by a sort key condition."""
+        cache_key = ("query", partition, _freeze((sort_condition, kwargs)))
+        with self._lock:
+            items = self._lookup(cache_key)
+            if items is not None:
+                self._stats["hits"] += 1
+                return copy.deepcopy(items)
+            self._stats["misses"] += 1
+            writes = self._writes
+        condition = Key(self.key_names[0]).eq(partition)
+        if sort_condition is not None:
+            condition = condition & sort_condition
+        items = list(query_items(self.table, condition, **kwargs))
+        with self._lock:
+            if self._writes == writes:
+                self._store(cache_key, copy.deepcopy(items), self.ttl)
+        return items
+
+    # Writes, the affected entries are updated or invalidated
+
+    def put_item(self, Item, **kwargs):
+        key = self._key(Item)
+        try:
+            response = self.table.put_item(Item=Item, **kwargs)
+        finally:
+            with self._lock:
+                self._invalidate(key)
+        with self._lock:
+            self._store(("item", key), copy.deepcopy(Item), self.ttl)
+        return response
+
+    def update_item(self, Key, **kwargs):
+        key = self._key(Key)
+        # The new image of the item comes back for free, keep it
+        wants_new_image = kwargs.setdefault("ReturnValues", "ALL_NEW") == "ALL_NEW"
+        try:
+            response = self.table.update_item(Key=Key, **kwargs)
+        finally:
+            with self._lock:
+                self._invalidate(key)
+        if wants_new_image:
+            item = copy.deepcopy(response["Attributes"])
+            with self._lock:
+                self._store(("item", key), item, self.ttl)
+        return response
+
+    def delete_item(self, Key, **kwargs):
+        key = self._key(Key)
+        try:
+            response = self.table.delete_item(Key=Key, **kwargs)
+        finally:
+            with self._lock:
+                self._invalidate(key)
+        with self._lock:
+            self._store(("item", key), _ABSENT, self.negative_ttl)
+        return response
@@ -0,0 +1,212 @@
+# *********************************************************************************************************************
+# Maintained item counts
+# Table.item_count comes from DescribeTable, a control plane call that DynamoDB refreshes only about every six hours.
+# CountedTable keeps the count of a table in a counter item of the item_counts table instead:
+#  - by default every put/delete runs as a transaction together with an ADD on the counter, so the count is exact
+#    (a transactional write costs twice the write units)
+#  - buffered=True writes the item on its own, learns from ReturnValues=ALL_OLD whether an item was created or removed
+#    and adds the changes up locally; they are flushed with one ADD per flush_every writes or flush_interval seconds.
+#    Cheaper, and the counter item stops being a hot key, but a crash loses the changes not flushed yet.
+# item_count is then a GetItem on the counter item (plus the local changes), O(1) whatever the size of the table.
+# *********************************************************************************************************************
+
+import atexit
+import threading
+import time
+
+import ddb_dal
+from boto3.dynamodb.conditions import Attr, ConditionBase, ConditionExpressionBuilder
+from botocore.exceptions import ClientError
+from ddb_iter import scan_pages
+
+COUNTS = "item_counts"
+
+
+def create_counter_table():
+    """Create the item_counts table, unless it exists."""
+    try:
+        ddb_dal.create_table(COUNTS, [("table_name", "HASH")], {"table_name": "S"})
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceInUseException":
+            raise
+
+
+def recount(table):
+    """Count the items of a table with a full scan (Select=COUNT)."""
+    return sum(page["Count"] for page in scan_pages(table, Select="COUNT"))
+
+
+def _condition_failed(error):
+    reasons = error.response.get("CancellationReasons", [])
+    return any(r.get("Code") == "ConditionalCheckFailed" for r in reasons)
+
+
+class CountedTable:
+    def __init__(self, table, buffered=False, flush_every=25, flush_interval=1.0):
+        self.table = table
+        self.buffered = buffered
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._initialized = False
+        # Buffered mode: changes not flushed to the counter item yet
+        self._pending = 0
+        self._pending_writes = 0
+        self._flushed = time.monotonic()
+        if buffered:
+            atexit.register(self.flush)
+
+    def __getattr__(self, name):
+        # Everything that does not change the number of items goes to the table
+        return getattr(self.table, name)
+
+    @property
+    def _counter_key(self):
+        return {"table_name": self.table.name}
+
+    @property
+    def _partition_key(self):
+        schema = self.table.key_schema
+        return next(k["AttributeName"] for k in schema if k["KeyType"] == "HASH")
+
+    def _initialize(self):
+        """Seed the counter of a table that already holds items, once."""
+        if self._initialized:
+            return
+        counts = ddb_dal.table(COUNTS)
+        try:
+            response = counts.get_item(Key=self._counter_key, ConsistentRead=True)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+                raise
+            create_counter_table()
+            response = {}
+        if "Item" not in response:
+            try:
+                counts.update_item(
+                    Key=self._counter_key,
+                    UpdateExpression="SET item_count = :n",
+                    ConditionExpression="attribute_not_exists(table_name)",
+                    ExpressionAttributeValues={":n": recount(self.table)},
+                )
+            except ClientError as e:
+                # Somebody else seeded it in the meantime
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        self._initialized = True
+
+    def _counter_update(self, delta):
+        return {
+            "Key": self._counter_key,
+            "UpdateExpression": "ADD item_count :n",
+            "ExpressionAttributeValues": {":n": delta},
+        }
+
+    @property
+    def item_count(self):
+        self._initialize()
+        counts = ddb_dal.table(COUNTS)
+        item = counts.get_item(Key=self._counter_key, ConsistentRead=True)
+        item = item.get("Item", {})
+        with self._lock:
+            return int(item.get("item_count", 0)) + self._pending
+
+    # Writes
+
+    def put_item(self, Item, **kwargs):
+        self._initialize()
+        if self.buffered:
+            return self._buffered_write(self.table.put_item, Item=Item, **kwargs)
+        # Only an item that did not exist yet changes the count
+        return self._transact("Put", "Item", Item, 1, self.table.put_item, kwargs)
+
+    def delete_item(self, Key, **kwargs):
+        self._initialize()
+        if self.buffered:
+            return self._buffered_write(self.table.delete_item, Key=Key, **kwargs)
+        return self._transact("Delete", "Key", Key, -1, self.table.delete_item, kwargs)
+
+    def _transact(self, action, field, value, delta, fallback, kwargs):
+        request = dict(kwargs, TableName=self.table.name, **{field: value})
+        # Neither is supported inside a transaction
+        request.pop("ReturnValues", None)
+        extra = {}
+        if "ReturnConsumedCapacity" in request:
+            extra["ReturnConsumedCapacity"] = request.pop("ReturnConsumedCapacity")
+        # The count only changes when a put creates an item or a delete removes one
+        caller = request.get("ConditionExpression")
+        if isinstance(caller, ConditionBase):
+            attribute = Attr(self._partition_key)
+            check = attribute.not_exists() if delta > 0 else attribute.exists()
+            # boto3 only expands condition objects at the top level of a request
+            built = ConditionExpressionBuilder().build_expression(caller & check)
+            request["ConditionExpression"] = built.condition_expression
+            for name, placeholders in (
+                ("ExpressionAttributeNames", built.attribute_name_placeholders),
+                ("ExpressionAttributeValues", built.attribute_value_placeholders),
+            ):
+                if placeholders:
+                    request[name] = dict(request.get(name, {}), **placeholders)
+        else:
+            check = "attribute_not_exists" if delta > 0 else "attribute_exists"
+            check = "{}(#cnt_pk)".format(check)
+            if caller:
+                check = "({}) AND {}".format(caller, check)
+            request["ConditionExpression"] = check
+            request["ExpressionAttributeNames"] = dict(
+                request.get("ExpressionAttributeNames", {}),
+                **{"#cnt_pk": self._partition_key}
+            )
+        counter = dict(self._counter_update(delta), TableName=COUNTS)
+        try:
+            # The service resource's client takes plain Python values
+            return ddb_dal.client().transact_write_items(
+                TransactItems=[{action: request}, {"Update": counter}], **extra
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+            if not _condition_failed(e):
+                raise
+        # The item already existed (put) or did not (delete), the count stays;
+        # the plain write applies the caller's own condition, if any
+        return fallback(**dict(kwargs, **{field: value}))
+
+    def _buffered_write(self, write, **kwargs):
+        asked = kwargs.get("ReturnValues", "NONE")
+        if asked not in ("NONE", "ALL_OLD"):
+            raise ValueError("Buffered counting needs ReturnValues=ALL_OLD")
+        kwargs["ReturnValues"] = "ALL_OLD"
+        response = write(**kwargs)
+        existed = "Attributes" in response
+        if "Item" in kwargs:
+            delta = 0 if existed else 1
+        else:
+            delta = -1 if existed else 0
+        if asked == "NONE":
+            response.pop("Attributes", None)
+        with self._lock:
+            self._pending += delta
+            self._pending_writes += 1
+            due = (
+                self._pending_writes >= self.flush_every
+                or time.monotonic() - self._flushed >= self.flush_interval
+            )
+        if due:
+            self.flush()
+        return response
+
+    def flush(self):
+        """Add the buffered changes to the counter item."""
+        with self._lock:
+            delta, self._pending = self._pending, 0
+            self._pending_writes = 0
+            self._flushed = time.monotonic()
+        if delta:
+            try:
+                ddb_dal.table(COUNTS).update_item(**self._counter_update(delta))
+            except Exception:
+                # Keep them for the next flush
+                with self._lock:
+                    self._pending += delta
+                raise
@@ -0,0 +1,241 @@
+# *********************************************************************************************************************
+# Data access layer shared by the week_4 scripts
+# One boto3 client per process, created lazily, with a connection pool sized for the threaded helpers (batch_get,
+# parallel scans, bulk loads), TCP keep-alive and explicit timeouts/retries. Clients are thread safe, resources are
+# not: every thread gets its own resource and Table handles on top of the shared client. Table handles are cached
+# per thread, so callers never pay for Table(...) and a cold connection more than once.
+#
+# Settings come from the environment (defaults in brackets):
+#   DDB_ENDPOINT_URL          [http://localhost:8000], empty to talk to AWS
+#   DDB_REGION                [AWS_DEFAULT_REGION or us-east-1]
+#   DDB_MAX_POOL_CONNECTIONS  [32]
+#   DDB_CONNECT_TIMEOUT       [2] seconds
+#   DDB_READ_TIMEOUT          [5] seconds
+#   DDB_MAX_ATTEMPTS          [5] total attempts, the first one included
+#   DDB_RETRY_MODE            [standard] or adaptive/legacy
+# *********************************************************************************************************************
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+from ddb_iter import scan_items
+
+ORDERS = "orders"
+INVENTORY = "inventory"
+
+_lock = threading.Lock()
+_settings = None
+_resource = None
+_raw_client = None
+# The calling thread's resource, the shared one it was made from, its Tables
+_local = threading.local()
+
+
+def _from_env():
+    return {
+        "endpoint_url": os.environ.get("DDB_ENDPOINT_URL", "http://localhost:8000"),
+        "region": os.environ.get(
+            "DDB_REGION", os.environ.get("AWS_DEFAULT_REGION", "us-east-1")
+        ),
+        "max_pool_connections": int(os.environ.get("DDB_MAX_POOL_CONNECTIONS", "32")),
+        "connect_timeout": float(os.environ.get("DDB_CONNECT_TIMEOUT", "2")),
+        "read_timeout": float(os.environ.get("DDB_READ_TIMEOUT", "5")),
+        "max_attempts": int(os.environ.get("DDB_MAX_ATTEMPTS", "5")),
+        "retry_mode": os.environ.get("DDB_RETRY_MODE", "standard"),
+    }
+
+
+def settings():
+    global _settings
+    with _lock:
+        if _settings is None:
+            _settings = _from_env()
+        return dict(_settings)
+
+
+def configure(**overrides):
+    """Override settings (e.g. from command line arguments) before first use.
+
+    None values are ignored. Handles created earlier keep working but are no
+    longer shared.
+    """
+    global _settings, _resource, _raw_client
+    current = settings()
+    current.update((k, v) for k, v in overrides.items() if v is not None)
+    unknown = set(current) - set(_from_env())
+    if unknown:
+        raise TypeError("Unknown settings " + ", ".join(sorted(unknown)))
+    with _lock:
+        _settings = current
+        _resource = None
+        _raw_client = None
+
+
+def client_config(s=None):
+    s = s or settings()
+    return Config(
+        max_pool_connections=s["max_pool_connections"],
+        tcp_keepalive=True,
+        connect_timeout=s["connect_timeout"],
+        read_timeout=s["read_timeout"],
+        retries={"total_max_attempts": s["max_attempts"], "mode": s["retry_mode"]},
+    )
+
+
+def _shared_resource():
+    global _resource
+    if _resource is None:
+        s = settings()
+        with _lock:
+            # Another thread may have won the race while we read the settings
+            if _resource is None:
+                # A private session, the default one is not thread safe
+                session = boto3.session.Session(region_name=s["region"])
+                _resource = session.resource(
+                    "dynamodb",
+                    endpoint_url=s["endpoint_url"] or None,
+                    config=client_config(s),
+                )
+    return _resource
+
+
+def resource():
+    """The DynamoDB service resource of the calling thread.
+
+    All of them share one low level client, and so its connection pool.
+    """
+    shared = _shared_resource()
+    if getattr(_local, "shared", None) is not shared:
+        # First use in this thread, or configure() was called since
+        _local.shared = shared
+        _local.resource = type(shared)(client=shared.meta.client)
+        _local.tables = {}
+    return _local.resource
+
+
+def client():
+    """The shared low level client; it takes and returns Python types, like
+    the resource it belongs to, and clients are thread safe."""
+    return _shared_resource().meta.client
+
+
+def raw_client():
+    """A plain client with the same settings, it takes and returns typed
+    ({"S": ...}) attribute values, with no conversion to Python types."""
+    global _raw_client
+    if _raw_client is None:
+        s = settings()
+        with _lock:
+            if _raw_client is None:
+                session = boto3.session.Session(region_name=s["region"])
+                _raw_client = session.client(
+                    "dynamodb",
+                    endpoint_url=s["endpoint_url"] or None,
+                    config=client_config(s),
+                )
+    return _raw_client
+
+
+def table(name):
+    """Cached Table handle of the calling thread."""
+    dynamodb = resource()
+    handle = _local.tables.get(name)
+    if handle is None:
+        handle = _local.tables[name] = dynamodb.Table(name)
+    return handle
+
+
+# Table definitions and the operations the scripts share
+
+
+def create_table(name, keys, attributes, indexes=None, read=1, write=1):
+    """Create a provisioned table and wait for it.
+
+    keys lists (attribute, "HASH" or "RANGE"), attributes maps every key
+    attribute (of the table and its indexes) to its type.
+    """
+    params = {
+        "TableName": name,
+        "KeySchema": [{"AttributeName": a, "KeyType": t} for a, t in keys],
+        "AttributeDefinitions": [
+            {"AttributeName": a, "AttributeType": t} for a, t in attributes.items()
+        ],
+        "ProvisionedThroughput": {
+            "ReadCapacityUnits": read,
+            "WriteCapacityUnits": write,
+        },
+    }
+    if indexes:
+        params["GlobalSecondaryIndexes"] = indexes
+    created = resource().create_table(**params)
+    created.meta.client.get_waiter("table_exists").wait(TableName=name)
+    return table(name)
+
+
+def create_orders(indexes=None, index_attributes=None):
+    attributes = {"user_id": "S", "order_id": "S"}
+    attributes.update(index_attributes or {})
+    return create_table(
+        ORDERS,
+        [("user_id", "HASH"), ("order_id", "RANGE")],
+        attributes,
+        indexes,
+    )
+
+
+def create_inventory():
+    # category is the PK ie hash and sku is the sort key
+    return create_table(
+        INVENTORY,
+        [("category", "HASH"), ("sku", "RANGE")],
+        {"category": "S", "sku": "S"},
+    )
+
+
+def order_item(user_id, order_id, address, city, order_details, price, tax=None):
+    item = {
+        "user_id": user_id,
+        "order_id": order_id,
+        "address": address,
+        "city": city,
+        "order_details": order_details,
+        "price": price,
+    }
+    if tax:
+        item["tax"] = tax
+    return item
+
+
+def insert_order(item, target=None):
+    """Put an order unless one with the same key exists, returns the response.
+
+    target is the orders table handle to write through (e.g. a CountedTable).
+    """
+    return (target or table(ORDERS)).put_item(
+        Item=item,
+        # Let us force a read before write - exercise caution wrt performance
+        ConditionExpression=(
+            "attribute_not_exists(user_id) AND attribute_not_exists(order_id)"
+        ),
+        ReturnConsumedCapacity="TOTAL",
+        ReturnValues="ALL_OLD",
+    )
+
+
+def inventory_item(category, sku, description, price, items):
+    return {
+        # The PK and the sort keys are mandatory
+        "category": category,
+        "sku": sku,
+        # Due to the schemaless nature the following keys are not required in the table definition
+        "description": description,
+        "price": price,
+        "items": items,
+    }
+
+
+def fetch_all(name, segments=1):
+    """Every item of a table, segments > 1 scans in parallel."""
+    return scan_items(table(name), segments=segments)
@@ -0,0 +1,339 @@
+# *********************************************************************************************************************
+# Client side throughput governor for provisioned DynamoDB tables
+# Every table (and GSI) gets a token bucket per read/write capacity, filled at the rate provisioned in describe_table.
+# Before a request goes out its cost in capacity units is estimated (1 KB per write unit, 4 KB per read unit) and the
+# caller waits until the bucket holds enough tokens, so a burst of writers queues up on the client instead of being
+# throttled by the table. The estimate is corrected with the ConsumedCapacity of the response.
+# The rate adapts AIMD style: halved on every throttle, grown back a little with every request that succeeds.
+#
+#   governor = install(dynamodb)
+#   ... use dynamodb as usual ...
+#   print(governor.rates())
+# *********************************************************************************************************************
+
+import base64
+import json
+import math
+import threading
+import time
+
+from ddb_metrics import CAPACITY_OPERATIONS, READ_OPERATIONS, THROTTLE_ERRORS
+
+# Size of a write / read capacity unit
+WRITE_UNIT_BYTES = 1024
+READ_UNIT_BYTES = 4096
+# Key of the per-call state kept in the botocore request context
+_CONTEXT_KEY = "ddb_governor"
+
+
+def value_size(value):
+    """Size DynamoDB bills for one typed ({"S": ...}) attribute value."""
+    kind, data = next(iter(value.items()))
+    if kind == "S":
+        return len(data.encode())
+    if kind == "N":
+        # Up to 38 significant digits, 2 per byte, plus one byte
+        digits = len(data.lstrip("-").replace(".", "").strip("0")) or 1
+        return int(math.ceil(digits / 2.0)) + 1
+    if kind == "B":
+        return len(base64.b64decode(data))
+    if kind in ("BOOL", "NULL"):
+        return 1
+    if kind == "SS":
+        return sum(len(s.encode()) for s in data)
+    if kind == "NS":
+        return sum(value_size({"N": n}) for n in data)
+    if kind == "BS":
+        return sum(len(base64.b64decode(b)) for b in data)
+    if kind == "L":
+        return 3 + sum(1 + value_size(v) for v in data)
+    if kind == "M":
+        return 3 + sum(1 + len(k.encode()) + value_size(v) for k, v in data.items())
+    return 0
+
+
+def item_size(item):
+    return sum(len(name.encode()) + value_size(v) for name, v in item.items())
+
+
+def write_units(item):
+    return max(1, int(math.ceil(item_size(item) / float(WRITE_UNIT_BYTES))))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst_seconds=1.0, min_rate=0.1, increase=0.05):
+        # The provisioned rate is the ceiling, AIMD moves between min_rate and it
+        self.ceiling = self.rate = float(rate)
+        self.burst_seconds = burst_seconds
+        self.min_rate = min(min_rate, self.ceiling)
+        # Fraction of the ceiling added back per second of throttle free traffic
+        self.increase = increase
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.throttles = 0
+        self.waited = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def capacity(self):
+        return max(1.0, self.rate * self.burst_seconds)
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        # Additive increase, proportional to the time spent without a throttle
+        grown = self.rate + elapsed * self.increase * self.ceiling
+        self.rate = min(self.ceiling, grown)
+
+    def acquire(self, cost):
+        """Block until cost tokens are available and take them.
+
+        A request larger than the bucket only waits for a full bucket and
+        leaves it in debt, which the following callers pay off.
+        """
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                self._refill(time.monotonic())
+                needed = min(cost, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= cost
+                    break
+                self._cond.wait((needed - self.tokens) / self.rate)
+            self.waited += time.monotonic() - started
+            # Let the next waiter re-check, it may need fewer tokens
+            self._cond.notify()
+
+    def adjust(self, cost):
+        """Charge (or refund, when negative) the error of an estimate."""
+        with self._cond:
+            self.tokens = min(self.capacity, self.tokens - cost)
+            self._cond.notify_all()
+
+    def throttled(self):
+        """Multiplicative decrease."""
+        with self._cond:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttles += 1
+
+
+class Governor:
+    def __init__(self, burst_seconds=1.0, min_rate=0.1, increase=0.05):
+        self.burst_seconds = burst_seconds
+        self.min_rate = min_rate
+        self.increase = increase
+        self._client = None
+        self._lock = threading.Lock()
+        # table -> {(index, "read" or "write"): TokenBucket}, {} when the table
+        # is on demand
+        self._tables = {}
+        # (operation, table, index) -> running average of the read units of a
+        # Query or Scan, whose cost cannot be known upfront
+        self._read_costs = {}
+
+    def install(self, dynamodb):
+        """Govern every call made through a boto3 resource or client."""
+        self._client = getattr(dynamodb.meta, "client", dynamodb)
+        events = self._client.meta.events
+        events.register("provide-client-params.dynamodb", self._on_params)
+        events.register("before-call.dynamodb", self._on_before_call)
+        events.register("request-created.dynamodb", self._on_request_created)
+        events.register("response-received.dynamodb", self._on_response)
+        events.register("after-call.dynamodb", self._on_after_call)
+        return self
+
+    def buckets(self, table):
+        """The token buckets of a table, read from describe_table once."""
+        with self._lock:
+            buckets = self._tables.get(table)
+        if buckets is not None:
+            return buckets
+        # Not under the lock: a slow or retried DescribeTable would hold up
+        # the calls to every other table. Callers racing here all describe
+        # the table, the first one stored wins.
+        buckets = self._describe(table)
+        with self._lock:
+            return self._tables.setdefault(table, buckets)
+
+    def forget(self, table):
+        """Re-read the provisioned throughput on next use (after an update)."""
+        with self._lock:
+            self._tables.pop(table, None)
+
+    def _describe(self, table):
+        description = self._client.describe_table(TableName=table)["Table"]
+        buckets = {}
+        sections = [("", description)] + [
+            (index["IndexName"], index)
+            for index in description.get("GlobalSecondaryIndexes", [])
+        ]
+        for index, section in sections:
+            throughput = section.get("ProvisionedThroughput", {})
+            for kind, field in (
+                ("read", "ReadCapacityUnits"),
+                ("write", "WriteCapacityUnits"),
+            ):
+                # 0 for on demand tables, nothing to govern there
+                if throughput.get(field):
+                    buckets[(index, kind)] = TokenBucket(
+                        throughput[field],
+                        self.burst_seconds,
+                        self.min_rate,
+                        self.increase,
+                    )
+        return buckets
+
+    def rates(self):
+        """{table: {"index/kind": current rate}} of the buckets in use."""
+        with self._lock:
+            tables = dict(self._tables)
+        return dict(
+            (
+                table,
+                dict(
+                    ("{}/{}".format(index or "table", kind), round(bucket.rate, 2))
+                    for (index, kind), bucket in buckets.items()
+                ),
+            )
+            for table, buckets in tables.items()
+        )
+
+    # Cost estimates, in capacity units per (table, index, kind)
+
+    def _costs(self, operation, request):
+        costs = {}
+
+        def add(table, index, kind, units):
+            key = (table, index, kind)
+            costs[key] = costs.get(key, 0.0) + units
+
+        def add_write(table, units):
+            # Every GSI of the table is written as well (at most as much)
+            add(table, "", "write", units)
+            for index, kind in self.buckets(table):
+                if index and kind == "write":
+                    add(table, index, "write", units)
+
+        def read_units(consistent):
+            return 1.0 if consistent else 0.5
+
+        if operation == "PutItem":
+            add_write(request["TableName"], write_units(request["Item"]))
+        elif operation in ("UpdateItem", "DeleteItem"):
+            # The size of the stored item is unknown, the response corrects it
+            add_write(request["TableName"], 1)
+        elif operation == "GetItem":
+            add(
+                request["TableName"],
+                "",
+                "read",
+                read_units(request.get("ConsistentRead")),
+            )
+        elif operation in ("Query", "Scan"):
+            table, index = request["TableName"], request.get("IndexName", "")
+            estimate = self._read_costs.get((operation, table, index), 1.0)
+            add(table, index, "read", estimate)
+        elif operation == "BatchWriteItem":
+            for table, requests in request["RequestItems"].items():
+                for r in requests:
+                    if "PutRequest" in r:
+                        add_write(table, write_units(r["PutRequest"]["Item"]))
+                    else:
+                        add_write(table, 1)
+        elif operation == "BatchGetItem":
+            for table, r in request["RequestItems"].items():
+                units = read_units(r.get("ConsistentRead")) * len(r["Keys"])
+                add(table, "", "read", units)
+        elif operation == "TransactWriteItems":
+            # Transactions cost twice the units of the plain operations
+            for action in request["TransactItems"]:
+                name, r = next(iter(action.items()))
+                units = write_units(r["Item"]) if name == "Put" else 1
+                add_write(r["TableName"], 2 * units)
+        elif operation == "TransactGetItems":
+            for action in request["TransactItems"]:
+                add(action["Get"]["TableName"], "", "read", 2.0)
+        return costs
+
+    def _charge(self, costs):
+        for (table, index, kind), units in costs.items():
+            bucket = self.buckets(table).get((index, kind))
+            if bucket is not None:
+                bucket.acquire(units)
+
+    # botocore event handlers
+
+    def _on_params(self, params, model, **kwargs):
+        if model.name in CAPACITY_OPERATIONS:
+            # Needed to correct the estimates
+            params.setdefault("ReturnConsumedCapacity", "INDEXES")
+
+    def _on_before_call(self, params, model, context, **kwargs):
+        if model.name not in CAPACITY_OPERATIONS:
+            return
+        request = json.loads(params["body"] or b"{}")
+        costs = self._costs(model.name, request)
+        context[_CONTEXT_KEY] = {
+            "operation": model.name,
+            "request": request,
+            "costs": costs,
+        }
+        # Queue here rather than get throttled by the table
+        self._charge(costs)
+
+    def _on_request_created(self, request, **kwargs):
+        # Emitted for every attempt, the first one was charged in before-call.
+        # Retries are only created when botocore does send them, so the last
+        # throttled attempt of a call does not wait for nothing
+        context = getattr(request, "context", None) or {}
+        call = context.get(_CONTEXT_KEY)
+        if call is not None and context.get("retries", {}).get("attempt", 1) > 1:
+            self._charge(call["costs"])
+
+    def _on_response(self, parsed_response, context, **kwargs):
+        call = context.get(_CONTEXT_KEY)
+        if call is None or parsed_response is None:
+            return
+        if parsed_response.get("Error", {}).get("Code") not in THROTTLE_ERRORS:
+            return
+        # The error does not tell which index throttled, slow down all of them
+        for table, index, kind in call["costs"]:
+            bucket = self.buckets(table).get((index, kind))
+            if bucket is not None:
+                bucket.throttled()
+
+    def _on_after_call(self, http_response, parsed, context, **kwargs):
+        call = context.get(_CONTEXT_KEY)
+        if call is None or http_response.status_code >= 300:
+            return
+        consumed = parsed.get("ConsumedCapacity")
+        if not consumed:
+            return
+        kind = "read" if call["operation"] in READ_OPERATIONS else "write"
+        actual = {}
+        for entry in consumed if isinstance(consumed, list) else [consumed]:
+            table = entry["TableName"]
+            sections = [("", entry.get("Table", entry))]
+            for section in ("GlobalSecondaryIndexes", "LocalSecondaryIndexes"):
+                sections.extend(entry.get(section, {}).items())
+            for index, units in sections:
+                actual[(table, index, kind)] = units.get("CapacityUnits", 0.0)
+        for key, units in actual.items():
+            table, index, _ = key
+            if call["operation"] in ("Query", "Scan"):
+                # Exponential moving average, the estimate of the next call
+                average = self._read_costs.get((call["operation"], table, index))
+                self._read_costs[(call["operation"], table, index)] = (
+                    units if average is None else 0.8 * average + 0.2 * units
+                )
+            bucket = self.buckets(table).get((index, kind))
+            if bucket is not None:
+                bucket.adjust(units - call["costs"].get(key, 0.0))
+
+
+def install(dynamodb, governor=None):
+    """Govern a boto3 DynamoDB resource or client, returns the Governor."""
+    return (governor or Governor()).install(dynamodb)
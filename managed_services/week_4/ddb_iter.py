@@ -0,0 +1,183 @@
+# *********************************************************************************************************************
+# Lazy, paginated reads (Scan and Query) for DynamoDB tables
+# A single Scan/Query call returns at most 1 MB; the generators below keep following LastEvaluatedKey and hand out
+# items as the pages arrive, so memory use does not depend on the size of the table.
+# *********************************************************************************************************************
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Signals that one segment of a parallel scan is exhausted
+_SEGMENT_DONE = object()
+
+
+def projection_args(attributes):
+    """ProjectionExpression for a list of attribute names.
+
+    Every name goes through ExpressionAttributeNames so that reserved words
+    (items, name, year...) can be projected as well. A name given twice is
+    projected once, DynamoDB rejects overlapping document paths.
+    """
+    unique = dict.fromkeys(attributes)
+    names = dict(("#p{}".format(i), name) for i, name in enumerate(unique))
+    return {
+        "ProjectionExpression": ", ".join(names),
+        "ExpressionAttributeNames": names,
+    }
+
+
+class ClientTable:
+    """The reads of a Table (or of a wrapper around one) through its low level
+    client. boto3 resources are not thread safe and clients are, threads share
+    one of these instead of the Table."""
+
+    def __init__(self, table):
+        self.name = table.name
+        self.client = table.meta.client
+
+    def scan(self, **kwargs):
+        return self.client.scan(TableName=self.name, **kwargs)
+
+    def query(self, **kwargs):
+        return self.client.query(TableName=self.name, **kwargs)
+
+
+def _read_args(projection, page_size, start_key, kwargs):
+    kwargs = dict(kwargs)
+    if projection:
+        extra = projection_args(projection)
+        kwargs["ProjectionExpression"] = extra["ProjectionExpression"]
+        kwargs["ExpressionAttributeNames"] = dict(
+            kwargs.get("ExpressionAttributeNames", {}),
+            **extra["ExpressionAttributeNames"]
+        )
+    if page_size:
+        kwargs["Limit"] = page_size
+    if start_key:
+        kwargs["ExclusiveStartKey"] = start_key
+    return kwargs
+
+
+def _pages(operation, kwargs):
+    while True:
+        page = operation(**kwargs)
+        yield page
+        if "LastEvaluatedKey" not in page:
+            return
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+def scan_pages(
+    table,
+    segment=None,
+    total_segments=None,
+    projection=None,
+    page_size=None,
+    start_key=None,
+    **kwargs
+):
+    """Yield the raw Scan responses of a table (or of one segment of it)."""
+    kwargs = _read_args(projection, page_size, start_key, kwargs)
+    if total_segments:
+        kwargs["Segment"] = segment
+        kwargs["TotalSegments"] = total_segments
+    return _pages(table.scan, kwargs)
+
+
+def scan_items(table, segments=1, projection=None, page_size=None, **kwargs):
+    """Yield every item of the table, following pagination lazily.
+
+    With segments > 1 the table is read as a parallel scan, one thread per
+    segment. Items are then yielded in the order the pages arrive, and at
+    most two pages per segment are buffered.
+    """
+    if segments <= 1:
+        for page in scan_pages(
+            table, projection=projection, page_size=page_size, **kwargs
+        ):
+            for item in page["Items"]:
+                yield item
+        return
+
+    pages = queue.Queue(maxsize=segments * 2)
+    stop = threading.Event()
+    reader = ClientTable(table)
+
+    def put(entry):
+        # Give up when the consumer went away instead of blocking forever
+        while not stop.is_set():
+            try:
+                pages.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_segment(segment):
+        try:
+            for page in scan_pages(
+                reader, segment, segments, projection, page_size, **kwargs
+            ):
+                if not put(page["Items"]):
+                    return
+        except Exception as e:
+            put(e)
+        put(_SEGMENT_DONE)
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        for segment in range(segments):
+            pool.submit(read_segment, segment)
+        try:
+            remaining = segments
+            while remaining:
+                entry = pages.get()
+                if entry is _SEGMENT_DONE:
+                    remaining -= 1
+                elif isinstance(entry, Exception):
+                    raise entry
+                else:
+                    for item in entry:
+                        yield item
+        finally:
+            stop.set()
+
+
+def query_items(
+    table,
+    key_condition,
+    index=None,
+    projection=None,
+    limit=None,
+    page_size=None,
+    **kwargs
+):
+    """Yield the items matching key_condition, following pagination lazily.
+
+    key_condition is a boto3 condition on the partition key, optionally
+    combined with a sort key range, e.g.
+        Key("user_id").eq("scotty") & Key("order_id").between("R1", "R5")
+        Key("category").eq("tv") & Key("sku").begins_with("sku0001")
+    limit stops after that many items without reading further pages.
+    """
+    kwargs = _read_args(projection, None, None, kwargs)
+    kwargs["KeyConditionExpression"] = key_condition
+    if index:
+        kwargs["IndexName"] = index
+    remaining = limit
+    while True:
+        if remaining is not None:
+            # Never let DynamoDB evaluate more items than we are going to use
+            kwargs["Limit"] = min(page_size or remaining, remaining)
+        elif page_size:
+            kwargs["Limit"] = page_size
+        page = table.query(**kwargs)
+        for item in page["Items"]:
+            yield item
+            if remaining is not None:
+                remaining -= 1
+                if remaining == 0:
+                    return
+        if "LastEvaluatedKey" not in page:
+            return
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
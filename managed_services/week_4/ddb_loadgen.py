@@ -0,0 +1,611 @@
+# *********************************************************************************************************************
+# Workload generator for the orders/inventory schemas, against DynamoDB Local only: the endpoint has to be a loopback
+# address or a host given with --allow-host, anything else (AWS included) needs --i-know-this-is-aws.
+# Builds a copy of the table (loadgen_orders or loadgen_inventory, same keys and city_idx as the scripts), fills its
+# key space and runs a weighted mix of single request operations on it:
+#   put, get, update, delete   one item
+#   query                      one page of a partition (the orders of a user, the skus of a category)
+#   query_city                 one page of city_idx (orders only)
+#   scan                       one page of a random segment
+# Keys are drawn uniformly, from a zipf distribution (a few keys get most of the traffic, spread over the partitions)
+# or hot-city style (hot_share of the traffic goes to the users of one city, or to one category).
+# Closed loop: --concurrency threads send the next request as soon as the previous one completes.
+# Open loop: requests are scheduled at --rate per second whether the previous ones completed or not, and latency is
+# measured from the scheduled start, so a stalled server shows up in the percentiles (no coordinated omission).
+# Results (throughput, latency percentiles, errors and throttles per operation, metrics of every call) are JSON.
+#
+#   python3 ddb_loadgen.py --mix get=80,put=20 --distribution zipf --concurrency 16 --duration 30
+#   python3 ddb_loadgen.py --rate 200 --duration 60 --orders-per-user 20 --output double.json
+#   python3 ddb_loadgen.py --table inventory --distribution hot-city --hot-share 0.9 --mix get=50,query=50
+# *********************************************************************************************************************
+
+import argparse
+import bisect
+import ipaddress
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import ddb_dal
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from ddb_batch import load
+from ddb_metrics import THROTTLE_ERRORS, install
+
+OPERATIONS = ("put", "get", "query", "query_city", "scan", "update", "delete")
+DEFAULT_MIX = "get=50,put=20,query=15,query_city=5,update=5,delete=4,scan=1"
+DISTRIBUTIONS = ("uniform", "zipf", "hot-city")
+# Segments the scan operation picks from, it reads one page of one of them
+SCAN_SEGMENTS = 16
+
+
+def parse_mix(text):
+    """"get=80,put=20" -> [("get", 80.0), ("put", 20.0)]."""
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation {!r}, use {}".format(name, OPERATIONS))
+        mix.append((name, float(weight or 1)))
+    if not mix or sum(w for _, w in mix) <= 0:
+        raise ValueError("The operation mix is empty")
+    return mix
+
+
+def is_local_endpoint(url, allowed_hosts=()):
+    """True when url points at the loopback interface or at one of
+    allowed_hosts (e.g. the name of a DynamoDB Local container)."""
+    host = urlsplit(url or "").hostname
+    if not host:
+        return False
+    if host == "localhost" or host in [h.lower() for h in allowed_hosts]:
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def percentile(ordered, pct):
+    """Nearest rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+# Schemas
+
+
+class OrdersWorkload:
+    """Key i is order i % orders_per_user of user i // orders_per_user, users
+    live in city user % cities."""
+
+    def __init__(self, table_name, users=1000, orders_per_user=10, cities=50):
+        self.table_name = table_name
+        self.users = users
+        self.orders_per_user = orders_per_user
+        self.groups = cities
+        self.size = users * orders_per_user
+        self.key_names = ["user_id", "order_id"]
+
+    def create(self, read, write):
+        index = {
+            "IndexName": "city_idx",
+            "KeySchema": [{"AttributeName": "city", "KeyType": "HASH"}],
+            "Projection": {
+                "ProjectionType": "INCLUDE",
+                "NonKeyAttributes": ["price", "tax"],
+            },
+            "ProvisionedThroughput": {
+                "ReadCapacityUnits": read,
+                "WriteCapacityUnits": write,
+            },
+        }
+        ddb_dal.create_table(
+            self.table_name,
+            [("user_id", "HASH"), ("order_id", "RANGE")],
+            {"user_id": "S", "order_id": "S", "city": "S"},
+            [index],
+            read,
+            write,
+        )
+
+    def group_of(self, i):
+        return (i // self.orders_per_user) % self.groups
+
+    def in_group(self, group, rng):
+        users = max(1, (self.users - group + self.groups - 1) // self.groups)
+        user = group + self.groups * rng.randrange(users)
+        return user * self.orders_per_user + rng.randrange(self.orders_per_user)
+
+    def key(self, i):
+        return {
+            "user_id": "user{:07d}".format(i // self.orders_per_user),
+            "order_id": "R{:07d}".format(i % self.orders_per_user),
+        }
+
+    def item(self, i, rng):
+        key = self.key(i)
+        return ddb_dal.order_item(
+            key["user_id"],
+            key["order_id"],
+            "#{} Load street".format(rng.randrange(1, 10000)),
+            "city{:04d}".format(self.group_of(i)),
+            "Load generated order",
+            rng.randrange(100, 10000),
+            rng.randrange(1, 500),
+        )
+
+    def partition(self, i):
+        return Key("user_id").eq(self.key(i)["user_id"])
+
+    def city(self, i):
+        return Key("city").eq("city{:04d}".format(self.group_of(i)))
+
+
+class InventoryWorkload:
+    """Key i is sku i of category i % categories."""
+
+    def __init__(self, table_name, skus=10000, categories=50):
+        self.table_name = table_name
+        self.groups = categories
+        self.size = skus
+        self.key_names = ["category", "sku"]
+
+    def create(self, read, write):
+        ddb_dal.create_table(
+            self.table_name,
+            [("category", "HASH"), ("sku", "RANGE")],
+            {"category": "S", "sku": "S"},
+            read=read,
+            write=write,
+        )
+
+    def group_of(self, i):
+        return i % self.groups
+
+    def in_group(self, group, rng):
+        skus = max(1, (self.size - group + self.groups - 1) // self.groups)
+        return group + self.groups * rng.randrange(skus)
+
+    def key(self, i):
+        return {
+            "category": "cat{:04d}".format(self.group_of(i)),
+            "sku": "sku{:08d}".format(i),
+        }
+
+    def item(self, i, rng):
+        key = self.key(i)
+        return ddb_dal.inventory_item(
+            key["category"],
+            key["sku"],
+            "Load generated sku",
+            rng.randrange(100, 100000),
+            rng.randrange(0, 1000),
+        )
+
+    def partition(self, i):
+        return Key("category").eq(self.key(i)["category"])
+
+    def city(self, i):
+        raise ValueError("query_city needs the orders table")
+
+
+# Key distributions
+
+
+class KeyChooser:
+    def __init__(self, workload, distribution, zipf_s=0.99, hot_share=0.5):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("Unknown distribution " + distribution)
+        self.workload = workload
+        self.distribution = distribution
+        self.hot_share = hot_share
+        if distribution == "zipf":
+            # Cumulative weights of the ranks 1..n, drawn with a bisection
+            total, self._cumulative = 0.0, []
+            for rank in range(1, workload.size + 1):
+                total += 1.0 / rank**zipf_s
+                self._cumulative.append(total)
+            # The hottest ranks would otherwise all be orders of the first user
+            self._stride = self._coprime_stride(workload.size)
+
+    @staticmethod
+    def _coprime_stride(n):
+        stride = int(n * 0.618) | 1
+        while math.gcd(stride, n) != 1:
+            stride += 2
+        return stride
+
+    def __call__(self, rng):
+        size = self.workload.size
+        if self.distribution == "zipf":
+            drawn = rng.random() * self._cumulative[-1]
+            rank = bisect.bisect_left(self._cumulative, drawn)
+            return (min(rank, size - 1) * self._stride) % size
+        if self.distribution == "hot-city":
+            if rng.random() < self.hot_share:
+                group = 0
+            else:
+                group = rng.randrange(self.workload.groups)
+            return self.workload.in_group(group, rng)
+        return rng.randrange(size)
+
+
+# Execution
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = dict((op, 0) for op in OPERATIONS)
+        self.throttled = dict((op, 0) for op in OPERATIONS)
+        self.error_codes = {}
+        self.max_lag = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, op, latency, error=None, lag=0.0):
+        with self._lock:
+            self.max_lag = max(self.max_lag, lag)
+            if error is None:
+                self.latencies[op].append(latency)
+                return
+            if error in THROTTLE_ERRORS:
+                self.throttled[op] += 1
+            else:
+                self.errors[op] += 1
+            self.error_codes[error] = self.error_codes.get(error, 0) + 1
+
+    def results(self, elapsed):
+        operations = {}
+        total = []
+        for op in OPERATIONS:
+            ordered = sorted(self.latencies[op])
+            total.extend(ordered)
+            if not ordered and not self.errors[op] and not self.throttled[op]:
+                continue
+            operations[op] = dict(
+                count=len(ordered),
+                errors=self.errors[op],
+                throttled=self.throttled[op],
+                ops_per_sec=len(ordered) / elapsed,
+                **self._latency(ordered)
+            )
+        total.sort()
+        return {
+            "elapsed": elapsed,
+            "ops": len(total),
+            "ops_per_sec": len(total) / elapsed,
+            "errors": sum(self.errors.values()),
+            "throttled": sum(self.throttled.values()),
+            "error_codes": self.error_codes,
+            "latency_ms": self._latency(total),
+            "max_start_lag_ms": self.max_lag * 1000,
+            "operations": operations,
+        }
+
+    @staticmethod
+    def _latency(ordered):
+        return {
+            "p50_ms": percentile(ordered, 50) * 1000,
+            "p90_ms": percentile(ordered, 90) * 1000,
+            "p99_ms": percentile(ordered, 99) * 1000,
+            "p999_ms": percentile(ordered, 99.9) * 1000,
+            "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+        }
+
+
+class LoadGenerator:
+    def __init__(self, workload, chooser, mix, page_size=25):
+        self.workload = workload
+        self.chooser = chooser
+        self.operations = [op for op, _ in mix]
+        weights, total = [], 0.0
+        for _, weight in mix:
+            total += weight
+            weights.append(total)
+        self._weights = weights
+        self.page_size = page_size
+
+    def _pick(self, rng):
+        drawn = rng.random() * self._weights[-1]
+        return self.operations[bisect.bisect_right(self._weights, drawn)]
+
+    def execute(self, op, rng):
+        """Run one operation, returns the error code or None."""
+        i = self.chooser(rng)
+        # Table handles are per thread, the workers must not share one
+        table = ddb_dal.table(self.workload.table_name)
+        try:
+            if op == "put":
+                table.put_item(Item=self.workload.item(i, rng))
+            elif op == "get":
+                table.get_item(Key=self.workload.key(i))
+            elif op == "query":
+                table.query(
+                    KeyConditionExpression=self.workload.partition(i),
+                    Limit=self.page_size,
+                )
+            elif op == "query_city":
+                table.query(
+                    IndexName="city_idx",
+                    KeyConditionExpression=self.workload.city(i),
+                    Limit=self.page_size,
+                )
+            elif op == "scan":
+                table.scan(
+                    Segment=rng.randrange(SCAN_SEGMENTS),
+                    TotalSegments=SCAN_SEGMENTS,
+                    Limit=self.page_size,
+                )
+            elif op == "update":
+                table.update_item(
+                    Key=self.workload.key(i),
+                    UpdateExpression="SET price = :p ADD revision :one",
+                    ExpressionAttributeValues={
+                        ":p": rng.randrange(100, 10000),
+                        ":one": 1,
+                    },
+                )
+            else:
+                table.delete_item(Key=self.workload.key(i))
+        except ClientError as e:
+            return e.response["Error"]["Code"]
+        except Exception as e:
+            # Timeouts, connection errors... after botocore gave up retrying
+            return type(e).__name__
+        return None
+
+    def closed_loop(self, concurrency, duration, warmup=0.0, seed=None):
+        """concurrency threads, each sending requests back to back."""
+        recorder = Recorder()
+        started = time.perf_counter()
+        measure_from = started + warmup
+        deadline = measure_from + duration
+
+        def worker(number):
+            rng = random.Random(None if seed is None else seed + number)
+            while True:
+                begin = time.perf_counter()
+                if begin >= deadline:
+                    return
+                op = self._pick(rng)
+                error = self.execute(op, rng)
+                if begin >= measure_from:
+                    recorder.record(op, time.perf_counter() - begin, error)
+
+        self._run(worker, concurrency)
+        return recorder.results(duration)
+
+    def open_loop(
+        self, rate, concurrency, duration, warmup=0.0, seed=None, poisson=True
+    ):
+        """Requests start on a fixed schedule of rate per second, served by up
+        to concurrency threads; latency counts from the scheduled start."""
+        recorder = Recorder()
+        lock = threading.Lock()
+        arrivals = random.Random(seed)
+        started = time.perf_counter()
+        measure_from = started + warmup
+        deadline = measure_from + duration
+        schedule = [started]
+
+        def next_start():
+            with lock:
+                start = schedule[0]
+                if start >= deadline:
+                    return None
+                # Poisson arrivals, or evenly spaced ones
+                gap = arrivals.expovariate(rate) if poisson else 1.0 / rate
+                schedule[0] = start + gap
+                return start
+
+        def worker(number):
+            rng = random.Random(None if seed is None else seed + number)
+            while True:
+                start = next_start()
+                if start is None:
+                    return
+                delay = start - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                op = self._pick(rng)
+                # How late the request leaves, all threads busy with slow ones
+                lag = max(0.0, -delay)
+                error = self.execute(op, rng)
+                if start >= measure_from:
+                    recorder.record(op, time.perf_counter() - start, error, lag)
+
+        self._run(worker, concurrency)
+        results = recorder.results(duration)
+        results["target_ops_per_sec"] = rate
+        return results
+
+    @staticmethod
+    def _run(worker, threads):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for future in [pool.submit(worker, n) for n in range(threads)]:
+                future.result()
+
+
+def prepare(workload, fresh=False, read=10000, write=10000, workers=8, seed=None):
+    """Create the table and fill its key space, unless it exists already."""
+    client = ddb_dal.client()
+    if fresh:
+        try:
+            client.delete_table(TableName=workload.table_name)
+            client.get_waiter("table_not_exists").wait(TableName=workload.table_name)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+                raise
+    try:
+        workload.create(read, write)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceInUseException":
+            raise
+        print("Using the existing table " + workload.table_name)
+        return
+    rng = random.Random(seed)
+    load(
+        ddb_dal.resource(),
+        workload.table_name,
+        (workload.item(i, rng) for i in range(workload.size)),
+        workload.key_names,
+        workers=workers,
+    )
+
+
+def summary(results):
+    lines = [
+        "{:12} {:>9} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+            "operation", "ops", "errs", "thrtl", "ops/s", "p50 ms", "p99 ms", "max ms"
+        )
+    ]
+    rows = sorted(results["operations"].items())
+    rows.append(
+        (
+            "total",
+            dict(
+                count=results["ops"],
+                errors=results["errors"],
+                throttled=results["throttled"],
+                ops_per_sec=results["ops_per_sec"],
+                **results["latency_ms"]
+            ),
+        )
+    )
+    for op, r in rows:
+        lines.append(
+            "{:12} {:9} {:6} {:6} {:9.0f} {:9.1f} {:9.1f} {:9.1f}".format(
+                op,
+                r["count"],
+                r["errors"],
+                r["throttled"],
+                r["ops_per_sec"],
+                r["p50_ms"],
+                r["p99_ms"],
+                r["max_ms"],
+            )
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DynamoDB Local load generator")
+    parser.add_argument("--endpoint-url", help="default $DDB_ENDPOINT_URL or local")
+    parser.add_argument("--table", choices=("orders", "inventory"), default="orders")
+    parser.add_argument("--table-name", help="default loadgen_<table>")
+    parser.add_argument("--fresh", action="store_true", help="recreate the table")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--orders-per-user", type=int, default=10)
+    parser.add_argument("--skus", type=int, default=10000)
+    parser.add_argument(
+        "--groups", type=int, default=50, help="cities of orders, inventory categories"
+    )
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--zipf-s", type=float, default=0.99)
+    parser.add_argument("--hot-share", type=float, default=0.5)
+    parser.add_argument(
+        "--rate", type=float, help="open loop at this many ops/s, else closed loop"
+    )
+    parser.add_argument(
+        "--even", action="store_true", help="evenly spaced open loop arrivals"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--page-size", type=int, default=25)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="write the results here, default stdout")
+    parser.add_argument(
+        "--allow-host",
+        action="append",
+        default=[],
+        help="DynamoDB Local host besides the loopback ones, can be repeated",
+    )
+    parser.add_argument(
+        "--i-know-this-is-aws",
+        action="store_true",
+        help="run against any endpoint, including DynamoDB itself",
+    )
+    args = parser.parse_args()
+
+    ddb_dal.configure(
+        endpoint_url=args.endpoint_url,
+        max_pool_connections=max(
+            ddb_dal.settings()["max_pool_connections"], args.concurrency
+        ),
+    )
+    endpoint_url = ddb_dal.settings()["endpoint_url"]
+    if not (
+        args.i_know_this_is_aws or is_local_endpoint(endpoint_url, args.allow_host)
+    ):
+        parser.error(
+            "the load generator only runs against DynamoDB Local, {!r} is not a "
+            "loopback or --allow-host endpoint (see --i-know-this-is-aws)".format(
+                endpoint_url or "AWS"
+            )
+        )
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    table_name = args.table_name or "loadgen_" + args.table
+    if args.table == "orders":
+        workload = OrdersWorkload(
+            table_name, args.users, args.orders_per_user, args.groups
+        )
+    else:
+        if any(op == "query_city" for op, _ in mix):
+            parser.error("query_city needs the orders table")
+        workload = InventoryWorkload(table_name, args.skus, args.groups)
+
+    prepare(workload, fresh=args.fresh, seed=args.seed)
+    chooser = KeyChooser(workload, args.distribution, args.zipf_s, args.hot_share)
+    generator = LoadGenerator(workload, chooser, mix, args.page_size)
+    # Measure the run only, not the preload
+    metrics = install(ddb_dal.resource())
+    mode = "open loop at {} ops/s".format(args.rate) if args.rate else "closed loop"
+    print(
+        "{} on {} ({} keys, {}), {} threads, {}s".format(
+            mode,
+            table_name,
+            workload.size,
+            args.distribution,
+            args.concurrency,
+            args.duration,
+        )
+    )
+    if args.rate:
+        results = generator.open_loop(
+            args.rate,
+            args.concurrency,
+            args.duration,
+            args.warmup,
+            args.seed,
+            poisson=not args.even,
+        )
+    else:
+        results = generator.closed_loop(
+            args.concurrency, args.duration, args.warmup, args.seed
+        )
+    results["config"] = dict(vars(args), table_name=table_name, keys=workload.size)
+    results["ddb"] = metrics.snapshot()
+    print(summary(results))
+    document = json.dumps(results, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(document + "\n")
+    else:
+        print(document)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+# *********************************************************************************************************************
+# Consumed capacity, latency and throttling metrics for every DynamoDB call
+# install() hooks into the botocore event system of a resource or client, so table.put_item, scan_items, batch_get...
+# are measured without changing the calling code. ReturnConsumedCapacity=INDEXES is added to every request that
+# supports it, and the capacity is added up per table and per index. This gives the numbers needed to size the
+# provisioned throughput of a table and of its GSIs.
+#
+#   metrics = install(dynamodb)
+#   ... use dynamodb as usual ...
+#   print(metrics.summary())
+#   open("ddb.prom", "w").write(metrics.prometheus())
+# *********************************************************************************************************************
+
+import bisect
+import json
+import threading
+import time
+
+# Operations that accept ReturnConsumedCapacity
+CAPACITY_OPERATIONS = {
+    "GetItem",
+    "PutItem",
+    "UpdateItem",
+    "DeleteItem",
+    "Query",
+    "Scan",
+    "BatchGetItem",
+    "BatchWriteItem",
+    "TransactGetItems",
+    "TransactWriteItems",
+}
+READ_OPERATIONS = {"GetItem", "Query", "Scan", "BatchGetItem", "TransactGetItems"}
+THROTTLE_ERRORS = (
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+)
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    float("inf"),
+)
+# Key of the per-call state kept in the botocore request context
+_CONTEXT_KEY = "ddb_metrics"
+
+
+def _table_names(params):
+    if "TableName" in params:
+        return params["TableName"]
+    if "RequestItems" in params:
+        return ",".join(sorted(params["RequestItems"]))
+    if "TransactItems" in params:
+        names = set()
+        for action in params["TransactItems"]:
+            for request in action.values():
+                names.add(request["TableName"])
+        return ",".join(sorted(names))
+    return ""
+
+
+def _item_count(operation, params, parsed):
+    if operation in ("Query", "Scan"):
+        return parsed.get("Count", 0)
+    if operation == "GetItem":
+        return 1 if "Item" in parsed else 0
+    if operation == "BatchGetItem":
+        return sum(len(items) for items in parsed.get("Responses", {}).values())
+    if operation == "TransactGetItems":
+        return sum(1 for response in parsed.get("Responses", []) if "Item" in response)
+    if operation in ("PutItem", "UpdateItem", "DeleteItem"):
+        return 1
+    if operation == "BatchWriteItem":
+        sent = sum(len(requests) for requests in params["RequestItems"].values())
+        unprocessed = parsed.get("UnprocessedItems", {}).values()
+        return sent - sum(len(requests) for requests in unprocessed)
+    if operation == "TransactWriteItems":
+        return len(params["TransactItems"])
+    return 0
+
+
+class _OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.items = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the pct-th percentile latency."""
+        rank = pct / 100.0 * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "throttles": self.throttles,
+            "retries": self.retries,
+            "items": self.items,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency_sum": self.latency_sum,
+            "latency_p50": self.percentile(50),
+            "latency_p99": self.percentile(99),
+        }
+
+
+class Metrics:
+    def __init__(self, return_consumed_capacity="INDEXES"):
+        self.return_consumed_capacity = return_consumed_capacity
+        self._lock = threading.Lock()
+        # (operation, table) -> _OperationStats
+        self._operations = {}
+        # (table, index, "read" or "write") -> capacity units, index "" is the
+        # base table
+        self._capacity = {}
+
+    def install(self, dynamodb):
+        """Measure every call made through a boto3 resource or client."""
+        # A service resource keeps its client in meta.client
+        client = getattr(dynamodb.meta, "client", dynamodb)
+        events = client.meta.events
+        events.register("provide-client-params.dynamodb", self._on_params)
+        events.register("before-call.dynamodb", self._on_before_call)
+        events.register("response-received.dynamodb", self._on_response)
+        events.register("after-call.dynamodb", self._on_after_call)
+        events.register("after-call-error.dynamodb", self._on_after_call_error)
+        return self
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+            self._capacity.clear()
+
+    # botocore event handlers
+
+    def _on_params(self, params, model, context, **kwargs):
+        if model.name in CAPACITY_OPERATIONS and self.return_consumed_capacity:
+            # An explicit setting of the caller wins
+            params.setdefault("ReturnConsumedCapacity", self.return_consumed_capacity)
+        context[_CONTEXT_KEY] = {
+            "operation": model.name,
+            "table": _table_names(params),
+            "params": params,
+            "throttles": 0,
+            "bytes_received": 0,
+            "started": time.perf_counter(),
+        }
+
+    def _on_before_call(self, params, context, **kwargs):
+        call = context.get(_CONTEXT_KEY)
+        if call is not None:
+            call["bytes_sent"] = len(params.get("body") or b"")
+
+    def _on_response(self, response_dict, parsed_response, context, **kwargs):
+        # Once per attempt, retries included
+        call = context.get(_CONTEXT_KEY)
+        if call is None or response_dict is None:
+            return
+        call["bytes_received"] += len(response_dict.get("body") or b"")
+        error = (parsed_response or {}).get("Error", {}).get("Code")
+        if error in THROTTLE_ERRORS:
+            call["throttles"] += 1
+
+    def _on_after_call(self, http_response, parsed, context, **kwargs):
+        call = context.get(_CONTEXT_KEY)
+        if call is None:
+            return
+        failed = http_response.status_code >= 300
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        items = 0 if failed else _item_count(call["operation"], call["params"], parsed)
+        self._record(call, failed, retries, items)
+        if not failed:
+            self._record_capacity(call["operation"], parsed.get("ConsumedCapacity"))
+
+    def _on_after_call_error(self, context, **kwargs):
+        # The request never got a response (connection error, timeout...)
+        call = context.get(_CONTEXT_KEY)
+        if call is not None:
+            self._record(call, True, 0, 0)
+
+    # Aggregation
+
+    def _record(self, call, failed, retries, items):
+        latency = time.perf_counter() - call["started"]
+        key = (call["operation"], call["table"])
+        with self._lock:
+            stats = self._operations.get(key)
+            if stats is None:
+                stats = self._operations[key] = _OperationStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.throttles += call["throttles"]
+            stats.retries += retries
+            stats.items += items
+            stats.bytes_sent += call.get("bytes_sent", 0)
+            stats.bytes_received += call["bytes_received"]
+            stats.latency_sum += latency
+            stats.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def _record_capacity(self, operation, consumed):
+        if not consumed:
+            return
+        kind = "read" if operation in READ_OPERATIONS else "write"
+        # A dict for single item operations, a list (one per table) for the rest
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        with self._lock:
+            for entry in consumed:
+                table = entry["TableName"]
+                if "Table" in entry:
+                    self._add_capacity(table, "", kind, entry["Table"])
+                    for section in ("GlobalSecondaryIndexes", "LocalSecondaryIndexes"):
+                        for index, units in entry.get(section, {}).items():
+                            self._add_capacity(table, index, kind, units)
+                else:
+                    # ReturnConsumedCapacity=TOTAL, no breakdown per index
+                    self._add_capacity(table, "", kind, entry)
+
+    def _add_capacity(self, table, index, kind, units):
+        key = (table, index, kind)
+        self._capacity[key] = self._capacity.get(key, 0.0) + units.get(
+            "CapacityUnits", 0.0
+        )
+
+    # Queries
+
+    def capacity(self, table, index=""):
+        """Capacity units consumed so far, {"read": ..., "write": ...}."""
+        with self._lock:
+            return dict(
+                (kind, self._capacity.get((table, index, kind), 0.0))
+                for kind in ("read", "write")
+            )
+
+    def operation(self, operation, table):
+        with self._lock:
+            stats = self._operations.get((operation, table))
+            return stats.as_dict() if stats else None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "operations": [
+                    dict(operation=op, table=table, **stats.as_dict())
+                    for (op, table), stats in sorted(self._operations.items())
+                ],
+                "capacity": [
+                    {"table": table, "index": index, "kind": kind, "units": units}
+                    for (table, index, kind), units in sorted(self._capacity.items())
+                ],
+            }
+
+    # Exports
+
+    def json_lines(self):
+        """One JSON object per series, ready to append to a log file."""
+        now = time.time()
+        snapshot = self.snapshot()
+        lines = []
+        for entry in snapshot["operations"]:
+            lines.append(json.dumps(dict(metric="ddb_operation", ts=now, **entry)))
+        for entry in snapshot["capacity"]:
+            lines.append(json.dumps(dict(metric="ddb_capacity", ts=now, **entry)))
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def prometheus(self):
+        """Prometheus text exposition format."""
+        with self._lock:
+            operations = sorted(self._operations.items())
+            capacity = sorted(self._capacity.items())
+        lines = []
+
+        def labels(**values):
+            return ",".join(
+                '{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                for k, v in values.items()
+            )
+
+        counters = [
+            ("ddb_requests_total", "calls", "DynamoDB calls"),
+            ("ddb_request_errors_total", "errors", "Calls that failed"),
+            ("ddb_throttles_total", "throttles", "Throttled attempts"),
+            ("ddb_retries_total", "retries", "Retried attempts"),
+            ("ddb_items_total", "items", "Items read or written"),
+            ("ddb_sent_bytes_total", "bytes_sent", "Request body bytes"),
+            ("ddb_received_bytes_total", "bytes_received", "Response body bytes"),
+        ]
+        for name, field, text in counters:
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} counter".format(name))
+            for (op, table), stats in operations:
+                lines.append(
+                    "{}{{{}}} {}".format(
+                        name, labels(operation=op, table=table), getattr(stats, field)
+                    )
+                )
+
+        name = "ddb_request_duration_seconds"
+        lines.append("# HELP {} Latency of calls, retries included".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for (op, table), stats in operations:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.latency_buckets):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    "{}_bucket{{{}}} {}".format(
+                        name, labels(operation=op, table=table, le=le), cumulative
+                    )
+                )
+            series = labels(operation=op, table=table)
+            lines.append("{}_sum{{{}}} {}".format(name, series, stats.latency_sum))
+            lines.append("{}_count{{{}}} {}".format(name, series, stats.calls))
+
+        name = "ddb_consumed_capacity_units_total"
+        lines.append("# HELP {} Consumed read/write capacity units".format(name))
+        lines.append("# TYPE {} counter".format(name))
+        for (table, index, kind), units in capacity:
+            lines.append(
+                "{}{{{}}} {}".format(
+                    name, labels(table=table, index=index, kind=kind), units
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Prometheus text to a .prom path, JSON lines to anything else."""
+        with open(path, "w") as f:
+            f.write(self.prometheus() if path.endswith(".prom") else self.json_lines())
+
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = [
+            "{:16} {:12} {:>6} {:>6} {:>6} {:>7} {:>9} {:>9}".format(
+                "operation",
+                "table",
+                "calls",
+                "thrtl",
+                "retry",
+                "items",
+                "p50 ms",
+                "p99 ms",
+            )
+        ]
+        for e in snapshot["operations"]:
+            lines.append(
+                "{:16} {:12} {:6} {:6} {:6} {:7} {:9.1f} {:9.1f}".format(
+                    e["operation"],
+                    e["table"],
+                    e["calls"],
+                    e["throttles"],
+                    e["retries"],
+                    e["items"],
+                    e["latency_p50"] * 1000,
+                    e["latency_p99"] * 1000,
+                )
+            )
+        for e in snapshot["capacity"]:
+            lines.append(
+                " {} {}{} {:.1f} capacity units".format(
+                    e["table"],
+                    e["index"] + " " if e["index"] else "",
+                    e["kind"],
+                    e["units"],
+                )
+            )
+        return "\n".join(lines)
+
+
+def install(dynamodb, metrics=None):
+    """Instrument a boto3 DynamoDB resource or client, returns the Metrics."""
+    return (metrics or Metrics()).install(dynamodb)
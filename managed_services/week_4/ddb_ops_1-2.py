@@ -5,45 +5,37 @@
 #   https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/ReservedWords.html
 # *********************************************************************************************************************
 
-import boto3
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
-
-# Get the service resource on the cloud
-dynamodb = boto3.resource(
-    "dynamodb", region_name="us-east-1", endpoint_url="http://localhost:8000"
+import ddb_dal
+from ddb_batch import MISSING, batch_get
+from ddb_cache import CachedTable
+from ddb_counter import CountedTable
+from ddb_metrics import install
+
+# The shared service resource runs against localhost by default; ensure you have the CLI done with the credentials file
+# in .aws folder. The nature of the credentials for localhost does not matter; type in any junk for accesskey and secret
+# To use the service resource on the cloud: export DDB_ENDPOINT_URL= DDB_REGION=us-west-2
+dynamodb = ddb_dal.resource()
+
+# Capacity, latency and throttles of every call made through dynamodb
+metrics = install(dynamodb)
+
+# Read-through cache for single items; the writes below go through it as well so that they never read back stale data.
+# Underneath, the number of items is kept in a counter item, updated in the same transaction as each insert/delete
+inventory = CachedTable(
+    CountedTable(ddb_dal.table("inventory")), key_names=["category", "sku"]
 )
-# dynamodb = boto3.resource("dynamodb", region_name="us-west-2")
-
-# Get the service resource running on localhost; ensure you have the CLI done with the credentials file in .aws folder
-# The nature of the credentials for localhost does not matter; type in any junk for accesskey and secret
-# dynamodb = boto3.resource('dynamodb', region_name='us-west-2', endpoint_url='http://localhost:8000')
 
 
 def create_table():
     print("\n*************************************************************************")
     print("Creating table inventory")
     try:
-        table = dynamodb.create_table(
-            # This is the table that we want to create
-            TableName="inventory",
-            # category is the PK ie hash and sku is the sort key
-            # these two together will uniquely identify a record/row
-            KeySchema=[
-                {"AttributeName": "category", "KeyType": "HASH"},
-                {"AttributeName": "sku", "KeyType": "RANGE"},
-            ],
-            # Specifying the data types for the PK and Sort keys respectively
-            # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/DynamoDBMapper.DataTypes.html
-            AttributeDefinitions=[
-                {"AttributeName": "category", "AttributeType": "S"},
-                {"AttributeName": "sku", "AttributeType": "S"},
-            ],
-            # Planning for capacity units
-            ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
-        )
-        # Wait until the table exists.
-        table.meta.client.get_waiter("table_exists").wait(TableName="inventory")
+        # category is the PK ie hash and sku is the sort key, these two together will uniquely identify a record/row
+        # Data types of the keys: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/DynamoDBMapper.DataTypes.html
+        # Waits until the table exists
+        ddb_dal.create_inventory()
         print(" DONE")
 
     except ClientError as e:
@@ -54,54 +46,52 @@ def create_table():
 def insert_data(category, sku, description, price, items):
     print("\n*************************************************************************")
     print("Inserting data in the table")
-    # Instantiate a table resource object without actually creating a DynamoDB table.
-    # Note that the attributes of this table are lazy-loaded: a request is not made nor are the attribute
-    # values populated until the attributes on the table resource are accessed or its load() method is called.
-    table = dynamodb.Table("inventory")
-    table.put_item(
-        Item={
-            # The PK and the sort keys are mandatory
-            "category": category,
-            "sku": sku,
-            # Due to the schemaless nature the following keys are not required in the table definition
-            "description": description,
-            "price": price,
-            "items": items,
-        }
+    inventory.put_item(
+        Item=ddb_dal.inventory_item(category, sku, description, price, items)
     )
-    # Print out some data about the table.
-    print("Total items in the table are ", table.item_count)
+    # Print out some data about the table; item_count reads the counter item, not DescribeTable
+    print("Total items in the table are ", inventory.item_count)
 
 
-def fetch_all():
+def fetch_all(segments=1):
     print("\n*************************************************************************")
     print("Getting all data from the table (not suited for production envs)")
-    table = dynamodb.Table("inventory")
-    response = table.scan()
-    print("Total items in the table are ", response["Count"])
-    for item in response["Items"]:
+    # Follows LastEvaluatedKey page by page, segments > 1 scans in parallel
+    count = 0
+    for item in ddb_dal.fetch_all("inventory", segments):
         print(item)
+        count += 1
+    print("Total items in the table are ", count)
 
 
-def fetch_pk(category):
+def fetch_pk(category, sku_range=None, sku_prefix=None, attributes=None, limit=None):
     print("\n*************************************************************************")
     print("Getting data from the table based on the PK")
-    table = dynamodb.Table("inventory")
     # Different query conditions and select criteria are possible, an example is below
     # ProjectionExpression="#yr, title, info.genres, info.actors[0]",
     # ExpressionAttributeNames={ "#yr": "year" }, # Expression Attribute Names for Projection Expression only.
     # KeyConditionExpression=Key('year').eq(1992) & Key('title').between('A', 'L')
-    response = table.query(KeyConditionExpression=Key("category").eq(category))
-    print(" Total items for this PK is ", response["Count"])
-    for item in response["Items"]:
+    sort_condition = None
+    # Sort key ranges are resolved by DynamoDB, only the matching items are read
+    if sku_range:
+        sort_condition = Key("sku").between(*sku_range)
+    elif sku_prefix:
+        sort_condition = Key("sku").begins_with(sku_prefix)
+    count = 0
+    # Served from the cache when the same query ran recently, and not since a write
+    for item in inventory.query(
+        category, sort_condition, projection=attributes, limit=limit
+    ):
         print(item)
+        count += 1
+    print(" Total items for this PK is ", count)
 
 
 def fetch_data(category, sku):
     print("\n*************************************************************************")
     print("Getting an individual record from the table based on the PK+Sort key")
-    table = dynamodb.Table("inventory")
-    response = table.get_item(Key={"category": category, "sku": sku})
+    # Served from the cache when the item (or its absence) was seen recently
+    response = inventory.get_item(Key={"category": category, "sku": sku})
     try:
         item = response["Item"]
         print(item)
@@ -110,11 +100,24 @@ def fetch_data(category, sku):
         print(response)
 
 
+def fetch_many(keys):
+    print("\n*************************************************************************")
+    print("Getting several records from the table based on the PK+Sort key")
+    # One BatchGetItem round trip per 100 keys instead of one get_item per key
+    items = batch_get(
+        dynamodb, "inventory", [{"category": c, "sku": s} for c, s in keys]
+    )
+    for (category, sku), item in zip(keys, items):
+        if item is MISSING:
+            print(" No data for ", category, sku)
+        else:
+            print(item)
+
+
 def update_data(category, sku, price):
     print("\n*************************************************************************")
     print("Updating data in the table")
-    table = dynamodb.Table("inventory")
-    table.update_item(
+    inventory.update_item(
         Key={"category": category, "sku": sku},
         UpdateExpression="SET price = :val1",
         ExpressionAttributeValues={":val1": price},
@@ -125,9 +128,8 @@ def update_data(category, sku, price):
 def delete_data(category, sku):
     print("\n*************************************************************************")
     print("Deleting data in the table")
-    table = dynamodb.Table("inventory")
-    table.delete_item(Key={"category": category, "sku": sku})
-    print("Items left in the table are ", table.item_count)
+    inventory.delete_item(Key={"category": category, "sku": sku})
+    print("Items left in the table are ", inventory.item_count)
 
 
 def main():
@@ -153,11 +155,20 @@ def main():
     insert_data("laptops", "sku00010", "Dell vostro 3000", 45000, 500)
     insert_data("laptops", "sku00011", "Dell lattitude 5000", 40000, 400)
     insert_data("laptops", "sku00012", "HP pavilion 4500", 42000, 600)
+    # Fetch several records, in the order asked for, in one round trip
+    fetch_many([("laptops", "sku00012"), ("tv", "sku00001"), ("tv", "sku00002")])
     # Fetch based on only the partition key
     fetch_pk("laptops")
+    # Only a range of the sort key, and only some of the attributes
+    fetch_pk("laptops", sku_range=("sku00011", "sku00012"), attributes=["sku", "price"])
+    # Stop after the first item
+    fetch_pk("laptops", sku_prefix="sku0001", limit=1)
 
     # Fetch the complete data set
     fetch_all()
 
+    print("\nCache statistics ", inventory.stats())
+    print("\nDynamoDB metrics\n" + metrics.summary())
+
 
 main()
@@ -3,34 +3,25 @@
 # This script will operate on AWS DynamoDB to showcase alternate fetch criteria using index
 # *********************************************************************************************************************
 
-import boto3
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
+import ddb_dal
+from ddb_counter import CountedTable
+from ddb_metrics import install
 
+# The shared resource talks to DynamoDB local, export DDB_ENDPOINT_URL= to use AWS
+# Capacity, latency and throttles of every call made through it
+metrics = install(ddb_dal.resource())
 
-dynamodb = boto3.resource(
-    "dynamodb", region_name="us-east-1", endpoint_url="http://localhost:8000"
-)
-# dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
+# Keeps the number of orders in a counter item, updated in the same transaction as each insert
+orders = CountedTable(ddb_dal.table("orders"))
 
 
 def create_table():
     print("\n*************************************************************************")
     print("Creating table orders")
     try:
-        table = dynamodb.create_table(
-            TableName="orders",
-            KeySchema=[
-                {"AttributeName": "user_id", "KeyType": "HASH"},
-                {"AttributeName": "order_id", "KeyType": "RANGE"},
-            ],
-            AttributeDefinitions=[
-                {"AttributeName": "user_id", "AttributeType": "S"},
-                {"AttributeName": "order_id", "AttributeType": "S"},
-            ],
-            ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
-        )
-        table.meta.client.get_waiter("table_exists").wait(TableName="orders")
+        ddb_dal.create_orders()
         print(" DONE")
 
     except ClientError as e:
@@ -43,42 +34,29 @@ def insert_data(user_id, order_id, address, city, order_details, price, tax=None
     print("\n*************************************************************************")
     print("Inserting data in the table")
     # A map which contains all the KV that represents the data to be inserted
-    order_data = {
-        "user_id": user_id,
-        "order_id": order_id,
-        "address": address,
-        "city": city,
-        "order_details": order_details,
-        "price": price,
-    }
-    if tax:
-        order_data["tax"] = tax
-
-    table = dynamodb.Table("orders")
+    order_data = ddb_dal.order_item(
+        user_id, order_id, address, city, order_details, price, tax
+    )
     try:
-        ret_val = table.put_item(
-            Item=order_data,
-            # Let us force a read before write - exercise caution wrt performance
-            ConditionExpression="attribute_not_exists(user_id) AND attribute_not_exists(order_id)",
-            ReturnConsumedCapacity="TOTAL",
-            ReturnValues="ALL_OLD",
-        )
+        ret_val = ddb_dal.insert_order(order_data, orders)
         print(ret_val)
     except ClientError as e:
         print(" Skipped due to exception ", e.response["Error"]["Code"])
         print(" Reason ", e.response["Error"]["Message"])
 
-    print("Total items in the table are ", table.item_count)
+    # A GetItem on the counter, rather than DescribeTable and a count up to 6 hours old
+    print("Total items in the table are ", orders.item_count)
 
 
-def fetch_all():
+def fetch_all(segments=1):
     print("\n*************************************************************************")
     print("Getting all data from the table (not suited for production envs)")
-    table = dynamodb.Table("orders")
-    response = table.scan()
-    print("Total items in the table are ", response["Count"])
-    for item in response["Items"]:
+    # Follows LastEvaluatedKey page by page, segments > 1 scans in parallel
+    count = 0
+    for item in ddb_dal.fetch_all("orders", segments):
         print(item)
+        count += 1
+    print("Total items in the table are ", count)
 
 
 def main():
@@ -124,5 +102,7 @@ def main():
 
     fetch_all()
 
+    print("\nDynamoDB metrics\n" + metrics.summary())
+
 
 main()
@@ -0,0 +1,119 @@
+# *********************************************************************************************************************
+# Write sharding for low cardinality index keys
+# A GSI keyed on an attribute with few distinct values (city in the orders table) puts all writes for a popular value
+# on one index partition. Writing the key as "<value>#<n>", with n derived from a stable hash of the item key, spreads
+# a value over N partitions; reads then query all N shards in parallel and merge the results.
+#
+# The analyzer samples a table and recommends a shard count from the key distribution:
+#   python3 ddb_shard.py orders city --sample 10000 --write-rate 800
+# *********************************************************************************************************************
+
+import argparse
+import math
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import ddb_dal
+from boto3.dynamodb.conditions import Key
+from ddb_iter import ClientTable, query_items, scan_items
+
+# Write capacity a single DynamoDB partition sustains
+PARTITION_WCU = 1000
+
+
+def shard_of(item_key, shards):
+    """Stable shard number for an item key (a tuple of its key values).
+
+    crc32 rather than hash(), which is salted per Python process.
+    """
+    return zlib.crc32("|".join(str(v) for v in item_key).encode()) % shards
+
+
+def sharded_value(value, shard):
+    return "{}#{}".format(value, shard)
+
+
+def query_shards(table, index, attribute, value, shards, limit=None, **kwargs):
+    """Query every shard of value in parallel, returns the merged items.
+
+    With a limit no shard reads more than limit items, and the first limit of
+    the merged items are returned.
+    """
+
+    # One Table shared by the threads would not be thread safe, its client is
+    reader = ClientTable(table)
+
+    def query(shard):
+        condition = Key(attribute).eq(sharded_value(value, shard))
+        return list(query_items(reader, condition, index=index, limit=limit, **kwargs))
+
+    with ThreadPoolExecutor(max_workers=shards) as pool:
+        items = [item for part in pool.map(query, range(shards)) for item in part]
+    return items[:limit] if limit is not None else items
+
+
+def analyze(table, attribute, sample=10000, write_rate=None, headroom=0.5):
+    """Sample attribute values and recommend a shard count.
+
+    Enough shards to bring the hottest value down to the share of an average
+    value, and, with a write rate (WCU/s for the whole index), enough to keep
+    the hottest shard under headroom of what one partition sustains.
+    """
+    counts = Counter()
+    for item in scan_items(table, projection=[attribute]):
+        if attribute in item:
+            counts[item[attribute]] += 1
+            if sum(counts.values()) >= sample:
+                break
+    if not counts:
+        return None
+    sampled = sum(counts.values())
+    hot_value, hot_count = counts.most_common(1)[0]
+    hot_share = hot_count / sampled
+    # The share each value would have with a perfectly even distribution
+    even_share = 1.0 / len(counts)
+    shards = max(1, math.ceil(hot_share / even_share))
+    if write_rate:
+        hot_rate = hot_share * write_rate
+        shards = max(shards, math.ceil(hot_rate / (PARTITION_WCU * headroom)))
+    return {
+        "sampled": sampled,
+        "distinct": len(counts),
+        "hot_value": hot_value,
+        "hot_share": hot_share,
+        "top": counts.most_common(10),
+        "shards": shards,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommend a GSI shard count")
+    parser.add_argument("table")
+    parser.add_argument("attribute")
+    parser.add_argument("--sample", type=int, default=10000)
+    parser.add_argument(
+        "--write-rate", type=float, help="expected writes/sec (WCU) on the index"
+    )
+    parser.add_argument("--endpoint-url", help="default $DDB_ENDPOINT_URL or local")
+    parser.add_argument("--region", help="default $DDB_REGION or us-east-1")
+    args = parser.parse_args()
+
+    ddb_dal.configure(endpoint_url=args.endpoint_url, region=args.region)
+    report = analyze(
+        ddb_dal.table(args.table), args.attribute, args.sample, args.write_rate
+    )
+    if report is None:
+        print("No item of {} has {}".format(args.table, args.attribute))
+        return
+    print("Sampled items        ", report["sampled"])
+    print("Distinct values      ", report["distinct"])
+    print("Hottest value        ", report["hot_value"])
+    print("Hottest value share   {:.1%}".format(report["hot_share"]))
+    for value, count in report["top"]:
+        print("   {:20} {:6.1%}".format(str(value), count / report["sampled"]))
+    print("Recommended shards   ", report["shards"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+# *********************************************************************************************************************
+# Table snapshots: parallel export to compressed files and restore through batched writes
+# export scans the table as a parallel scan, one part file per segment. Items are kept as DynamoDB JSON
+# ({"S": ...}, binaries in base64), one per line, straight from a plain client: nothing is converted to Python types
+# and back, and a restore gives back exactly the types that were exported. Every scanned page becomes one zstd frame
+# (gzip member when zstandard is not installed); concatenated frames read back as a single stream.
+# manifest.json records, per part, the offset in the file after the last complete page and the LastEvaluatedKey to
+# continue from, so --resume truncates whatever a crash left half written and carries on where the scan stopped.
+# restore streams the parts back in batches of 25 through BatchWriteItem, one writer per part, and checkpoints the
+# lines written per part in restore-<table>.json.
+#
+#   python3 ddb_snapshot.py export orders snapshots/orders --segments 8
+#   python3 ddb_snapshot.py export inventory snapshots/inv --attributes description,price
+#   python3 ddb_snapshot.py export orders snapshots/orders --segments 8 --resume
+#   python3 ddb_snapshot.py restore snapshots/orders
+#   python3 ddb_snapshot.py restore snapshots/orders --table orders_copy --resume
+# *********************************************************************************************************************
+
+import argparse
+import base64
+import gzip
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ddb_dal
+from ddb_batch import BATCH_SIZE, write_batch
+from ddb_governor import install as install_governor
+from ddb_iter import scan_pages
+from ddb_metrics import install
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST = "manifest.json"
+# Seconds between two saves of the restore checkpoint
+CHECKPOINT_INTERVAL = 1.0
+MB = 1024.0 * 1024.0
+
+
+def default_codec():
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def compress(data, codec):
+    """One self contained zstd frame or gzip member."""
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def open_part(path, codec):
+    """Read every frame of a part file as one stream of lines."""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Snapshot is zstd compressed, pip install zstandard")
+        raw = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.TextIOWrapper(raw, encoding="utf-8")
+    return gzip.open(path, "rt", encoding="utf-8")
+
+
+def _encode_binary(value):
+    # The only thing the plain client returns that JSON cannot hold
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError("Cannot serialize {!r}".format(value))
+
+
+def decode(value):
+    """Turn the base64 binaries of a typed value (or item) back into bytes."""
+    if isinstance(value, dict):
+        if len(value) == 1:
+            kind, data = next(iter(value.items()))
+            if kind == "B":
+                return {"B": base64.b64decode(data)}
+            if kind == "BS":
+                return {"BS": [base64.b64decode(b) for b in data]}
+            if kind == "L":
+                return {"L": [decode(v) for v in data]}
+            if kind == "M":
+                return {"M": dict((k, decode(v)) for k, v in data.items())}
+            if kind in ("S", "N", "SS", "NS", "BOOL", "NULL"):
+                return value
+        # An item: attribute name -> typed value
+        return dict((name, decode(v)) for name, v in value.items())
+    return value
+
+
+def dumps(item):
+    return json.dumps(item, default=_encode_binary, separators=(",", ":"))
+
+
+class Throughput:
+    def __init__(self, every=5.0):
+        self.every = every
+        self.items = 0
+        # JSON lines, before compression / as stored in the part files
+        self.bytes = 0
+        self.stored = 0
+        self.started = self.reported = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, items, size, stored):
+        with self._lock:
+            self.items += items
+            self.bytes += size
+            self.stored += stored
+            now = time.monotonic()
+            if now - self.reported >= self.every:
+                self.reported = now
+                print(" {} items, {}".format(self.items, self.rates()))
+
+    def elapsed(self):
+        return max(time.monotonic() - self.started, 1e-9)
+
+    def rates(self):
+        elapsed = self.elapsed()
+        return "{:.0f} items/sec, {:.2f} MB/sec".format(
+            self.items / elapsed, self.bytes / MB / elapsed
+        )
+
+    def report(self, action, table):
+        print(
+            "{} {} items of {} in {:.1f}s, {} ({:.2f} MB of JSON, {:.2f} MB "
+            "compressed)".format(
+                action,
+                self.items,
+                table,
+                self.elapsed(),
+                self.rates(),
+                self.bytes / MB,
+                self.stored / MB,
+            )
+        )
+
+
+class Checkpoint:
+    """A JSON document saved atomically, shared by the worker threads."""
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, default=None):
+        if not os.path.exists(path):
+            if default is None:
+                raise RuntimeError("No checkpoint at " + path)
+            return cls(path, default)
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    def update(self, section, key, **values):
+        with self._lock:
+            self.data[section][key].update(values)
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.data, f, indent=1, default=_encode_binary)
+        # A crash leaves either the previous or the new checkpoint, never half
+        os.replace(temporary, self.path)
+
+
+# Export
+
+
+def _new_manifest(client, table_name, segments, attributes, codec):
+    description = client.describe_table(TableName=table_name)["Table"]
+    key_names = [k["AttributeName"] for k in description["KeySchema"]]
+    if attributes:
+        # Without its key an item cannot be restored
+        attributes = key_names + [a for a in attributes if a not in key_names]
+    return {
+        "table": table_name,
+        "key_names": key_names,
+        "segments": segments,
+        "attributes": attributes or None,
+        "codec": codec,
+        "parts": dict(
+            (
+                str(segment),
+                {
+                    "file": "part-{:05d}.jsonl.{}".format(
+                        segment, "zst" if codec == "zstd" else "gz"
+                    ),
+                    "offset": 0,
+                    "items": 0,
+                    "bytes": 0,
+                    "last_key": None,
+                    "done": False,
+                },
+            )
+            for segment in range(segments)
+        ),
+    }
+
+
+def _export_segment(client, directory, manifest, segment, page_size, throughput):
+    data = manifest.data
+    part = data["parts"][str(segment)]
+    if part["done"]:
+        return
+    path = os.path.join(directory, part["file"])
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        # Drop a page written after the last checkpoint, it is scanned again
+        f.truncate(part["offset"])
+        f.seek(part["offset"])
+        pages = scan_pages(
+            client,
+            segment,
+            data["segments"],
+            projection=data["attributes"],
+            page_size=page_size,
+            start_key=decode(part["last_key"]) if part["last_key"] else None,
+            TableName=data["table"],
+        )
+        items, size = part["items"], part["bytes"]
+        for page in pages:
+            lines = "".join(dumps(item) + "\n" for item in page["Items"])
+            lines = lines.encode("utf-8")
+            stored = 0
+            if lines:
+                frame = compress(lines, data["codec"])
+                f.write(frame)
+                f.flush()
+                os.fsync(f.fileno())
+                stored = len(frame)
+            items += len(page["Items"])
+            size += len(lines)
+            manifest.update(
+                "parts",
+                str(segment),
+                offset=f.tell(),
+                items=items,
+                bytes=size,
+                last_key=page.get("LastEvaluatedKey"),
+                done="LastEvaluatedKey" not in page,
+            )
+            throughput.add(len(page["Items"]), len(lines), stored)
+
+
+def export(
+    client,
+    table_name,
+    directory,
+    segments=4,
+    attributes=None,
+    resume=False,
+    page_size=None,
+    codec=None,
+):
+    """Export a table to directory, one part file per scan segment.
+
+    Returns the manifest. With resume the segments not finished yet continue
+    from the checkpoint, with the settings of the interrupted export.
+    """
+    path = os.path.join(directory, MANIFEST)
+    if os.path.exists(path):
+        if not resume:
+            raise RuntimeError(
+                "{} holds a snapshot already, use --resume".format(directory)
+            )
+        manifest = Checkpoint.load(path)
+        if manifest.data["table"] != table_name:
+            raise RuntimeError(
+                "{} is a snapshot of {}".format(directory, manifest.data["table"])
+            )
+    else:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest = Checkpoint(
+            path,
+            _new_manifest(
+                client, table_name, segments, attributes, codec or default_codec()
+            ),
+        )
+        manifest.save()
+    throughput = Throughput()
+    parts = manifest.data["parts"]
+    with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+        futures = [
+            pool.submit(
+                _export_segment,
+                client,
+                directory,
+                manifest,
+                int(segment),
+                page_size,
+                throughput,
+            )
+            for segment in parts
+        ]
+        for future in futures:
+            future.result()
+    throughput.report("Exported", table_name)
+    return manifest.data
+
+
+# Restore
+
+
+def _restore_part(
+    client, table_name, path, codec, attributes, checkpoint, name, throughput
+):
+    done = checkpoint.data["parts"][name]["lines"]
+    stored = os.path.getsize(path)
+    with open_part(path, codec) as lines:
+        batch, size, written = [], 0, done
+        saved = time.monotonic()
+        for number, line in enumerate(lines):
+            # Written before the restore was interrupted
+            if number < done:
+                continue
+            item = decode(json.loads(line))
+            if attributes:
+                item = dict((k, v) for k, v in item.items() if k in attributes)
+            batch.append(item)
+            size += len(line)
+            if len(batch) == BATCH_SIZE:
+                write_batch(client, table_name, batch)
+                written += len(batch)
+                throughput.add(len(batch), size, 0)
+                batch, size = [], 0
+                if time.monotonic() - saved >= CHECKPOINT_INTERVAL:
+                    checkpoint.update("parts", name, lines=written)
+                    saved = time.monotonic()
+        if batch:
+            write_batch(client, table_name, batch)
+            written += len(batch)
+            throughput.add(len(batch), size, 0)
+    throughput.add(0, 0, stored)
+    checkpoint.update("parts", name, lines=written, done=True)
+
+
+def restore(client, directory, table_name=None, attributes=None, resume=False):
+    """Write a snapshot back to its table (or to table_name, which must exist).
+
+    Parts are restored in parallel, one writer each; export with more
+    segments for a faster restore. Returns the number of items written.
+    """
+    manifest = Checkpoint.load(os.path.join(directory, MANIFEST)).data
+    table_name = table_name or manifest["table"]
+    unfinished = [p for p in manifest["parts"].values() if not p["done"]]
+    if unfinished:
+        raise RuntimeError(
+            "The export of {} did not finish, resume it first".format(directory)
+        )
+    if attributes:
+        description = client.describe_table(TableName=table_name)["Table"]
+        attributes = set(attributes)
+        attributes.update(k["AttributeName"] for k in description["KeySchema"])
+    path = os.path.join(directory, "restore-{}.json".format(table_name))
+    empty = {
+        "parts": dict((p, {"lines": 0, "done": False}) for p in manifest["parts"])
+    }
+    if os.path.exists(path) and not resume:
+        os.remove(path)
+    checkpoint = Checkpoint.load(path, default=empty)
+    throughput = Throughput()
+    with ThreadPoolExecutor(max_workers=len(manifest["parts"])) as pool:
+        futures = [
+            pool.submit(
+                _restore_part,
+                client,
+                table_name,
+                os.path.join(directory, part["file"]),
+                manifest["codec"],
+                attributes,
+                checkpoint,
+                name,
+                throughput,
+            )
+            for name, part in manifest["parts"].items()
+            if not checkpoint.data["parts"][name]["done"]
+        ]
+        for future in futures:
+            future.result()
+    throughput.report("Restored", table_name)
+    return throughput.items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DynamoDB table snapshots")
+    parser.add_argument("--endpoint-url", help="default $DDB_ENDPOINT_URL or local")
+    parser.add_argument("--region", help="default $DDB_REGION or us-east-1")
+    parser.add_argument(
+        "--metrics", help="write call metrics here (.prom for Prometheus text)"
+    )
+    parser.add_argument(
+        "--governor",
+        action="store_true",
+        help="pace requests to the provisioned throughput of the table",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_cmd = commands.add_parser("export", help="scan a table into a snapshot")
+    export_cmd.add_argument("table")
+    export_cmd.add_argument("directory")
+    export_cmd.add_argument("--segments", type=int, default=4)
+    export_cmd.add_argument("--page-size", type=int)
+    export_cmd.add_argument("--codec", choices=("zstd", "gzip"))
+    restore_cmd = commands.add_parser("restore", help="write a snapshot back")
+    restore_cmd.add_argument("directory")
+    restore_cmd.add_argument("--table", help="default the table exported")
+    for command in (export_cmd, restore_cmd):
+        command.add_argument(
+            "--attributes", default="", help="comma separated attributes to keep"
+        )
+        command.add_argument(
+            "--resume", action="store_true", help="continue from the checkpoint"
+        )
+    args = parser.parse_args()
+
+    workers = args.segments if args.command == "export" else 0
+    if args.command == "restore":
+        with open(os.path.join(args.directory, MANIFEST)) as f:
+            workers = len(json.load(f)["parts"])
+    ddb_dal.configure(
+        endpoint_url=args.endpoint_url,
+        region=args.region,
+        max_pool_connections=max(ddb_dal.settings()["max_pool_connections"], workers),
+    )
+    # Typed values in and out, no conversion to Python types
+    client = ddb_dal.raw_client()
+    metrics = install(client)
+    governor = install_governor(client) if args.governor else None
+    attributes = [a for a in args.attributes.split(",") if a]
+    if args.command == "export":
+        if args.codec == "zstd" and zstandard is None:
+            parser.error("--codec zstd needs the zstandard package")
+        export(
+            client,
+            args.table,
+            args.directory,
+            segments=args.segments,
+            attributes=attributes,
+            resume=args.resume,
+            page_size=args.page_size,
+            codec=args.codec,
+        )
+    else:
+        restore(client, args.directory, args.table, attributes, args.resume)
+    print(metrics.summary())
+    if governor is not None:
+        print("Governed rates ", governor.rates())
+    if args.metrics:
+        metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# *********************************************************************************************************************
+# Tests of the batch reads' projections. DynamoDB Local and moto accept overlapping document paths in a
+# ProjectionExpression, the real service does not, so the requests are checked as they are sent.
+#
+#   python3 -m pytest test_ddb_batch.py
+# *********************************************************************************************************************
+
+import asyncio
+import unittest
+
+import ddb_async
+import ddb_batch
+from ddb_iter import projection_args
+
+
+def projected(request):
+    names = request["ExpressionAttributeNames"]
+    return [names[p.strip()] for p in request["ProjectionExpression"].split(",")]
+
+
+class RecordingClient:
+    """Answers batch_get_item with the keys it was asked for."""
+
+    def __init__(self):
+        self.requests = []
+
+    def batch_get_item(self, RequestItems):
+        [(table, request)] = RequestItems.items()
+        self.requests.append(request)
+        return {"Responses": {table: [dict(k) for k in request["Keys"]]}}
+
+
+class ProjectionTest(unittest.TestCase):
+    def test_names_given_twice_are_projected_once(self):
+        args = projection_args(["category", "sku", "sku", "price"])
+        self.assertEqual(
+            sorted(args["ExpressionAttributeNames"].values()),
+            ["category", "price", "sku"],
+        )
+        self.assertEqual(args["ProjectionExpression"], "#p0, #p1, #p2")
+
+    def test_get_batch_projection_naming_a_key(self):
+        client = RecordingClient()
+        keys = [{"category": "tv", "sku": "sku00001"}]
+        found = ddb_batch.get_batch(
+            client, "inventory", keys, projection=["sku", "price"]
+        )
+        self.assertEqual(list(found), [("tv", "sku00001")])
+        self.assertEqual(projected(client.requests[0]), ["category", "sku", "price"])
+
+    def test_async_get_batch_projection_naming_a_key(self):
+        client = RecordingClient()
+        dynamodb = ddb_async.AsyncDynamoDB()
+
+        async def call(operation, **params):
+            return getattr(client, operation)(**params)
+
+        dynamodb.call = call
+        keys = [{"category": "tv", "sku": "sku00001"}]
+        found = asyncio.run(
+            dynamodb._get_batch("inventory", keys, ["sku", "price"], False)
+        )
+        self.assertEqual(list(found), [("tv", "sku00001")])
+        self.assertEqual(projected(client.requests[0]), ["category", "sku", "price"])
+
+
+if __name__ == "__main__":
+    unittest.main()
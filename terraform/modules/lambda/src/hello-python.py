@@ -1,6 +1,29 @@
+import time
+
+_init_started = time.perf_counter()
+
+import json
+
+_import_ms = (time.perf_counter() - _init_started) * 1000
+_init_finished = time.perf_counter()
+_cold_start = True
+
+
 def lambda_handler(event, context):
+   global _cold_start
+   started = time.perf_counter()
    message = 'Hello {} !'.format(event['key1'])
+   if _cold_start:
+      # One structured line per execution environment
+      _cold_start = False
+      print(json.dumps({
+          'metric': 'cold_start',
+          'function': getattr(context, 'function_name', None),
+          'import_ms': round(_import_ms, 1),
+          'init_ms': round((_init_finished - _init_started) * 1000, 1),
+          'init_to_invoke_ms': round((started - _init_finished) * 1000, 1),
+          'first_invocation_ms': round((time.perf_counter() - started) * 1000, 1),
+      }))
    return {
        'message' : message
    }
-